@@ -0,0 +1,216 @@
+"""Microbenchmarks for hot paths in main.py.
+
+    python benchmark.py summary [--iterations 200] [--filler 3000]
+    python benchmark.py calendar [--iterations 20000]
+    python benchmark.py replay ARCHIVE [--iterations 5] [--time-scale 1 0]
+"""
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import time
+from collections import Counter
+from datetime import timedelta
+
+from ethiopian_date import EthiopianDateConverter
+
+import main
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def timed(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+async def timed_async(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def report(name, samples, baseline=None):
+    mean = statistics.fmean(samples)
+    p95 = sorted(samples)[int(0.95 * (len(samples) - 1))]
+    speedup = f"  x{baseline / mean:.1f}" if baseline else ""
+    print(f"{name:<44} mean {mean:8.3f}ms  p95 {p95:8.3f}ms{speedup}")
+    return mean
+
+
+def synthetic_summary_page(filler):
+    # Roughly the shape of the portal's confirmation page: a large SPA shell with
+    # one small summary card.
+    rows = "".join(
+        f'<div class="row"><div class="col"><p class="text-muted">Notice {i}</p>'
+        f'<a href="/info/{i}">Read more about requirement {i}</a></div></div>'
+        for i in range(filler)
+    )
+    summary = (
+        '<div class="col-md-4 order-md-2 mb-4 mt-5"><ul class="list-group mb-3">'
+        '<li class="list-group-item"><h6>Your Appointment</h6></li>'
+        '<li class="list-group-item"><h6>Application Number</h6><span>AAL 1234 5678</span></li>'
+        '<li class="list-group-item"><h6>Appointment Date</h6><span>November 21, 2026</span></li>'
+        '<li class="list-group-item"><h6>Office</h6><span>Addis Ababa Main Office</span></li>'
+        '<li class="list-group-item"><h6>Amount</h6><strong>600 ETB</strong></li>'
+        '</ul></div>'
+    )
+    return f'<html><head><title>ePassport</title></head><body><div id="root">{rows}{summary}</div></body></html>'
+
+
+def bench_summary(args):
+    page_html = synthetic_summary_page(args.filler)
+    start = page_html.index('<div class="col-md-4 order-md-2 mb-4 mt-5">')
+    container_html = page_html[start:page_html.index("</ul></div>", start) + len("</ul></div>")]
+    print(f"page {len(page_html) / 1024:.0f} KiB, summary container {len(container_html)} bytes, "
+          f"fast parser: {main.SUMMARY_HTML_PARSER}")
+
+    expected = main.parse_summary_html(page_html, "html.parser")
+    assert main.parse_summary_html(container_html) == expected
+
+    baseline = report(
+        "full page, html.parser (previous path)",
+        timed(lambda: main.parse_summary_html(page_html, "html.parser"), args.iterations),
+    )
+    report(
+        f"container only, {main.SUMMARY_HTML_PARSER}",
+        timed(lambda: main.parse_summary_html(container_html), args.iterations),
+        baseline,
+    )
+    asyncio.run(bench_summary_in_page(page_html, expected, args.iterations))
+
+
+async def bench_summary_in_page(page_html, expected, iterations):
+    try:
+        async with main.async_playwright() as playwright:
+            browser = await playwright.chromium.launch(headless=True)
+            page = await browser.new_page()
+            await page.set_content(page_html)
+
+            async def content_and_parse():
+                main.parse_summary_html(await page.content(), "html.parser")
+
+            async def evaluate():
+                return dict(await page.evaluate(main.SUMMARY_EXTRACT_JS, main.SUMMARY_CONTAINER_SELECTOR))
+
+            assert await evaluate() == expected
+            baseline = report("page.content() + full parse (previous path)", await timed_async(content_and_parse, iterations))
+            report("single in-page evaluate", await timed_async(evaluate, iterations), baseline)
+            await browser.close()
+    except Exception as e:
+        print(f"in-page benchmark skipped: {str(e).splitlines()[0]}")
+
+
+def bench_calendar(args):
+    calendar = main.ethiopian_calendar
+    started = time.perf_counter()
+    calendar._tables()
+    print(f"table build {(time.perf_counter() - started) * 1000:.1f}ms, "
+          f"{len(calendar._by_day)} days, {calendar._by_day.itemsize * len(calendar._by_day) / 1024:.0f} KiB")
+
+    span = (calendar.LAST_DAY - calendar.FIRST_DAY).days
+    days = [calendar.FIRST_DAY + timedelta(random.randrange(span)) for _ in range(args.iterations)]
+    ethiopian = [calendar.to_ethiopian(day) for day in days]
+    library = EthiopianDateConverter
+    disagreements = sum(library.to_gregorian(*date) != day for date, day in zip(ethiopian, days))
+    print(f"library to_gregorian disagrees on {disagreements}/{len(days)} sampled dates")
+
+    def library_to_gregorian():
+        for year, month, day in ethiopian:
+            library.to_gregorian(year, month, day)
+
+    def table_to_gregorian():
+        for year, month, day in ethiopian:
+            calendar.to_gregorian(year, month, day)
+
+    def library_to_ethiopian():
+        for day in days:
+            try:
+                library.date_to_ethiopian(day)
+            except ValueError:
+                pass
+
+    def table_to_ethiopian():
+        for day in days:
+            calendar.to_ethiopian(day)
+
+    baseline = report(f"library to_gregorian x{len(days)}", timed(library_to_gregorian, 5))
+    report(f"table to_gregorian x{len(days)}", timed(table_to_gregorian, 5), baseline)
+    baseline = report(f"library date_to_ethiopian x{len(days)}", timed(library_to_ethiopian, 5))
+    report(f"table to_ethiopian x{len(days)}", timed(table_to_ethiopian, 5), baseline)
+
+    labels = [(calendar.FIRST_DAY + timedelta(45000 + i)).strftime(main.PORTAL_DATE_FORMAT) for i in range(30)]
+    calendar._labels.clear()
+    report("dual_labels, 30 dates, first request", timed(lambda: calendar.dual_labels(labels), 1))
+    report("dual_labels, 30 dates, cached", timed(lambda: calendar.dual_labels(labels), 200))
+
+
+def bench_replay(args):
+    entries = main.load_network_archive(args.archive)
+    body_bytes = sum(len(entry["_body"]) for entry in entries)
+    recorded_s = sum(entry["time"] for entry in entries) / 1000
+    print(f"{len(entries)} requests, {body_bytes / 1024:.0f} KiB of bodies, {recorded_s:.1f}s of recorded response time")
+    by_type = Counter(entry.get("_resourceType", "other") for entry in entries)
+    print("by resource type: " + ", ".join(f"{name}={count}" for name, count in by_type.most_common()))
+    asyncio.run(bench_start_path(args))
+
+
+async def bench_start_path(args):
+    # start() up to the booking form, entirely from the archive
+    main.PORTAL_REPLAY_ARCHIVE = args.archive
+
+    async def start_path():
+        playwright, browser, page = await main.launch_browser_page()
+        try:
+            await main.open_appointment_page(page)
+            await main.accept_appointment_terms(page)
+            await main.open_booking_form(page)
+        finally:
+            await browser.close()
+            await playwright.stop()
+
+    try:
+        baseline = None
+        for scale in args.time_scale:
+            main.PORTAL_REPLAY_TIME_SCALE = scale
+            mean = report(f"start path, time scale {scale:g}", await timed_async(start_path, args.iterations), baseline)
+            baseline = baseline or mean
+        print(f"replayed {main.network_counters['replayed']}, missed {main.network_counters['replay_missed']}")
+    except Exception as e:
+        print(f"replay benchmark skipped: {str(e).splitlines()[0]}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the passport bot")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    summary = subparsers.add_parser("summary", help="booking summary extraction")
+    summary.add_argument("--iterations", type=int, default=200)
+    summary.add_argument("--filler", type=int, default=3000, help="filler rows around the summary card")
+    summary.set_defaults(func=bench_summary)
+
+    calendar = subparsers.add_parser("calendar", help="Ethiopian/Gregorian conversion table")
+    calendar.add_argument("--iterations", type=int, default=20000, help="dates converted per run")
+    calendar.set_defaults(func=bench_calendar)
+
+    replay = subparsers.add_parser("replay", help="start path served from a recorded portal archive")
+    replay.add_argument("archive", help="archive file or directory written with PORTAL_RECORD_DIR")
+    replay.add_argument("--iterations", type=int, default=5)
+    replay.add_argument("--time-scale", type=float, nargs="+", default=[1.0, 0.0],
+                        help="recorded timings are multiplied by each of these in turn")
+    replay.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main_cli()
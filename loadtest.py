@@ -0,0 +1,959 @@
+"""Load test for the conversation layer against a local fake Telegram Bot API.
+
+Starts a stand-in Bot API server, points the bot's Application at it through
+TELEGRAM_API_BASE_URL and replays scripted booking and status conversations
+for many virtual chats. The portal is replaced by a lightweight stub so the
+numbers reflect update handling, not Chromium.
+
+    python loadtest.py --chats 2000 --status-ratio 0.5 --latency-ms 40 --flood-rate 0.01
+
+With --webhook the bot runs its embedded webhook server and the fake API
+pushes updates to it instead of answering getUpdates. With --workers N the
+bot runs as a sharded supervisor whose worker processes use the same stub
+portal. With --portal-archive the bot drives a real headless Chromium whose
+traffic is served from a recorded portal archive (see PORTAL_RECORD_DIR in
+main.py), so full handler paths can be timed offline. With --restart-at-s
+the bot is drained and restarted mid-run, the way a rolling deploy would.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import math
+import os
+import random
+import re
+import shlex
+import sys
+import time
+from collections import Counter, defaultdict
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl
+
+import httpx
+
+logger = logging.getLogger("loadtest")
+
+FAKE_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "PassportBot", "username": "passport_loadtest_bot"}
+# Methods that count against Telegram's flood limits and may be answered with a 429
+FLOODABLE_METHODS = {
+    "sendMessage", "editMessageText", "editMessageReplyMarkup", "sendDocument",
+    "answerCallbackQuery", "answerInlineQuery",
+}
+FAKE_PDF = b"%PDF-1.4\n% load test stub\n%%EOF\n"
+# Large enough that city/office/branch keyboards span several pages
+SELECT_OPTION_COUNT = 20
+SLOTS_PER_SESSION = 6
+SUMMARY_PAIRS = [("Application Number", "BK123456"), ("Appointment Date", "November 21, 2026")]
+SUMMARY_HTML = '<ul class="list-group mb-3"><li class="list-group-item"><h6>Summary</h6></li>' + "".join(
+    f'<li class="list-group-item"><h6>{key}</h6><span>{value}</span></li>' for key, value in SUMMARY_PAIRS
+) + "</ul>"
+
+# Scripted virtual users. Each rule reacts to one bot message (sent or edited):
+# "match" is a regex on the message text, "button" a callback_data prefix that
+# must be present in its inline keyboard.
+BOOKING_SCRIPT = [
+    {"button": "book_appointment", "action": "press"},
+    {"button": "region_", "action": "press"},
+    {"button": "city_", "action": "press"},
+    {"button": "office_", "action": "press"},
+    {"button": "page_branch_1", "action": "press"},
+    {"button": "branch_", "action": "press"},
+    {"button": "date_", "action": "press"},
+    {"button": "slot_", "action": "press"},
+    {"match": r"^Enter your First Name:", "action": "text", "value": "Abebe"},
+    {"match": r"^Enter your Middle Name:", "action": "text", "value": "Kebede"},
+    {"match": r"^Enter your Last Name:", "action": "text", "value": "Tesfaye"},
+    {"match": r"^Enter your First Name in Amharic", "action": "text", "value": "አበበ"},
+    {"match": r"^Enter your Middle Name in Amharic", "action": "text", "value": "ከበደ"},
+    {"match": r"^Enter your Last Name in Amharic", "action": "text", "value": "ተስፋዬ"},
+    {"match": r"^Enter your Birth Place", "action": "text", "value": "Addis Ababa"},
+    {"match": r"Enter your Phone Number", "action": "text", "value": "0912345678"},
+    {"match": r"^Enter your Date of Birth", "action": "text", "value": "05/21/1990"},
+    {"button": "dropdown_", "action": "press"},
+    {"button": "upload_id", "action": "press"},
+    {"match": r"Valid Resident/Gov Employee ID", "action": "document", "value": "id.pdf"},
+    {"button": "upload_birth", "action": "press"},
+    {"match": r"Authenticated Birth Certificate", "action": "document", "value": "birth.pdf"},
+    {"button": "payment_", "action": "press"},
+    {"match": r"^✅ All done!", "action": "finish"},
+]
+INTAKE_PROFILE = "\n".join([
+    "First name: Abebe", "Middle name: Kebede", "Last name: Tesfaye",
+    "First name (Amharic): አበበ", "Middle name (Amharic): ከበደ", "Last name (Amharic): ተስፋዬ",
+    "Birth place: Addis Ababa", "Phone: 0912345678", "Date of birth: 05/21/1990",
+    "Gender: Option 1", "Marital Status: Option 2",
+])
+# Same booking, but all personal details arrive in one pasted profile
+INTAKE_SCRIPT = [
+    {"match": r"^Enter your First Name:", "action": "text", "value": INTAKE_PROFILE} if "First Name:" in rule.get("match", "")
+    else rule
+    for rule in BOOKING_SCRIPT
+    if not rule.get("match", "").startswith((r"^Enter your Middle", r"^Enter your Last", r"^Enter your Birth",
+                                             r"Enter your Phone", r"^Enter your Date", r"^Enter your First Name in"))
+    and rule.get("button") != "dropdown_"
+]
+STATUS_SCRIPT = [
+    {"button": "passport_status", "action": "press"},
+    {"match": r"Application Number to get started", "action": "text", "value": "BK123456"},
+    {"match": r"^✅ All done!", "action": "finish"},
+]
+# Inline chats query one of a few application numbers so lookups coalesce and hit the cache
+INLINE_NUMBERS = [f"BK{100000 + i}" for i in range(5)]
+# While the portal is down, users come back and try /start again
+OUTAGE_RETRY = {
+    "match": r"currently unavailable|not responding right now|restarting for an update", "action": "text", "value": "/start"
+}
+FAILURE_PATTERN = re.compile(r"🔧 System encountered an error|❌ Error initializing|❌ Session expired")
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class FakeElement:
+    """Stand-in for ElementHandle / Locator objects returned by the stub portal."""
+
+    def __init__(self, portal, selector="", index=0):
+        self.portal = portal
+        self.selector = selector
+        self.index = index
+
+    def nth(self, index):
+        return FakeElement(self.portal, self.selector, index)
+
+    def locator(self, selector):
+        return FakeElement(self.portal, f"{self.selector} {selector}", self.index)
+
+    def get_by_role(self, role, name=None):
+        return FakeElement(self.portal, f"{role}:{name}")
+
+    def or_(self, other):
+        return FakeElement(self.portal, f"{self.selector} >> or >> {other.selector}")
+
+    def filter(self, has_text=None):
+        return FakeElement(self.portal, f"{self.selector}:has-text({has_text})", self.index)
+
+    @property
+    def first(self):
+        return self.nth(0)
+
+    async def all(self):
+        await self.portal.step()
+        if "option" in self.selector:
+            count = 4
+        elif "react-calendar__month-view__days" in self.selector:
+            count = 3
+        elif "btn_select" in self.selector:
+            count = 2
+        else:
+            count = 0
+        return [FakeElement(self.portal, self.selector, i) for i in range(count)]
+
+    async def count(self):
+        return len(await self.all())
+
+    async def get_attribute(self, name):
+        await self.portal.step()
+        if name == "aria-label":
+            return f"November {21 + self.index}, 2026"
+        return str(self.index + 1)
+
+    async def inner_text(self):
+        await self.portal.step()
+        if "card--link" in self.selector:
+            return "Application Number: BK123456\nStatus: Approved\nAppointment: November 21, 2026"
+        return f"Option {self.index + 1}"
+
+    async def inner_html(self):
+        await self.portal.step()
+        return SUMMARY_HTML
+
+    async def is_visible(self):
+        await self.portal.step()
+        return "Data not Found" not in self.selector
+
+    async def query_selector(self, selector):
+        await self.portal.step()
+        return FakeElement(self.portal, f"{self.selector} {selector}")
+
+    def __getattr__(self, name):
+        # click, wait_for, select_option, fill, ... all succeed after one portal round trip
+        async def portal_action(*args, **kwargs):
+            await self.portal.step()
+        return portal_action
+
+
+class FakePage:
+    def __init__(self, portal):
+        self.portal = portal
+        self.closed = False
+
+    def set_default_timeout(self, timeout):
+        pass
+
+    def set_default_navigation_timeout(self, timeout):
+        pass
+
+    def is_closed(self):
+        return self.closed
+
+    def on(self, event, callback):
+        pass
+
+    def locator(self, selector):
+        return FakeElement(self.portal, selector)
+
+    def get_by_role(self, role, name=None):
+        return FakeElement(self.portal, f"{role}:{name}")
+
+    def get_by_text(self, text):
+        return FakeElement(self.portal, f"text:{text}")
+
+    async def query_selector(self, selector):
+        await self.portal.step()
+        return FakeElement(self.portal, selector)
+
+    async def title(self):
+        await self.portal.step()
+        return "Service Unavailable" if self.portal.down() else "Ethiopian Passport Services"
+
+    async def wait_for_timeout(self, timeout):
+        await asyncio.sleep(timeout / 1000 * self.portal.wait_scale)
+
+    async def evaluate(self, script, *args):
+        await self.portal.step()
+        if "select.form-control" in script and "options" in script:
+            return [[str(i), f"Option {i}"] for i in range(1, SELECT_OPTION_COUNT + 1)]
+        if "selectors.map" in script:
+            return [[[str(i), f"Option {i}"] for i in range(1, 4)] for _ in args[0]]
+        if "list-group-item" in script:
+            return [list(pair) for pair in SUMMARY_PAIRS]
+        if "findIndex" in script:
+            return args[0][2]
+        if "btn_select" in script:
+            return [
+                {"table": table, "session": session, "index": i, "time": f"{hour + i}:30", "capacity": SLOTS_PER_SESSION - i}
+                for (table, session), hour in zip(args[0], (8, 14)) for i in range(SLOTS_PER_SESSION)
+            ]
+        return None
+
+    async def content(self):
+        await self.portal.step()
+        return f'<html><body><div class="col-md-4 order-md-2 mb-4 mt-5">{SUMMARY_HTML}</div></body></html>'
+
+    async def pdf(self, path=None, **kwargs):
+        await self.portal.step()
+        if path:
+            with open(path, "wb") as pdf_file:
+                pdf_file.write(FAKE_PDF)
+        return FAKE_PDF
+
+    async def close(self):
+        self.closed = True
+
+    def __getattr__(self, name):
+        async def portal_action(*args, **kwargs):
+            await self.portal.step()
+        return portal_action
+
+
+class FakeBrowserContext:
+    def __init__(self, portal):
+        self.portal = portal
+
+    async def new_page(self):
+        return FakePage(self.portal)
+
+    async def close(self):
+        pass
+
+    def __getattr__(self, name):
+        async def noop(*args, **kwargs):
+            pass
+        return noop
+
+
+class FakeBrowser:
+    def __init__(self, portal):
+        self.portal = portal
+        self.contexts = []
+        self.connected = True
+        self.disconnect_callbacks = []
+
+    async def new_context(self, **kwargs):
+        context = FakeBrowserContext(self.portal)
+        self.contexts.append(context)
+        return context
+
+    async def new_page(self, **kwargs):
+        return FakePage(self.portal)
+
+    def is_connected(self):
+        return self.connected
+
+    def on(self, event, callback):
+        if event != "disconnected":
+            return
+        self.disconnect_callbacks.append(callback)
+        if random.random() < self.portal.crash_rate:
+            # Stub pages keep answering after the crash, so a step already in flight completes
+            delay = random.uniform(0, self.portal.crash_within_s)
+            asyncio.get_running_loop().call_later(delay, self.crash)
+
+    def crash(self):
+        if not self.connected:
+            return
+        self.connected = False
+        self.portal.crashes += 1
+        for callback in self.disconnect_callbacks:
+            callback(self)
+
+    async def close(self):
+        self.crash()
+
+
+class FakeChromium:
+    def __init__(self, portal):
+        self.portal = portal
+
+    async def launch(self, **kwargs):
+        await asyncio.sleep(self.portal.launch_ms / 1000)
+        return FakeBrowser(self.portal)
+
+
+class FakePlaywright:
+    def __init__(self, portal):
+        self.chromium = FakeChromium(portal)
+
+    async def stop(self):
+        pass
+
+
+class StubPortal:
+    """Replaces `async_playwright` in the bot module with an in-process fake portal."""
+
+    def __init__(self, step_ms=2.0, launch_ms=50.0, wait_scale=0.01, crash_rate=0.0, crash_within_s=5.0):
+        self.step_ms = step_ms
+        self.launch_ms = launch_ms
+        self.wait_scale = wait_scale
+        self.crash_rate = crash_rate
+        self.crash_within_s = crash_within_s
+        self.steps = 0
+        self.crashes = 0
+        self.down_until = 0.0
+
+    def down(self):
+        return time.monotonic() < self.down_until
+
+    async def step(self):
+        self.steps += 1
+        if self.step_ms:
+            await asyncio.sleep(random.expovariate(1 / self.step_ms) / 1000)
+
+    def async_playwright(self):
+        portal = self
+
+        class _Starter:
+            async def start(self):
+                return FakePlaywright(portal)
+
+        return _Starter()
+
+
+class VirtualChat:
+    def __init__(self, driver, chat_id, kind, script):
+        self.driver = driver
+        self.chat_id = chat_id
+        self.kind = kind
+        self.script = script
+        self.user = {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"}
+        self.chat = {"id": chat_id, "type": "private", "first_name": f"User{chat_id}"}
+        self.fired = set()
+        self.done = asyncio.Event()
+        self.failed = False
+        self.started_at = None
+        self.finished_at = None
+        self.actions = 0
+
+    async def run(self, timeout):
+        self.started_at = time.perf_counter()
+        if self.kind == "inline":
+            self.driver.server.push_inline_query(self, random.choice(INLINE_NUMBERS))
+        else:
+            self.driver.server.push_message(self, text="/start")
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.failed = True
+        self.finished_at = time.perf_counter()
+
+    def on_bot_message(self, message):
+        if self.done.is_set():
+            return
+        text = message.get("text") or message.get("caption") or ""
+        if FAILURE_PATTERN.search(text):
+            self.failed = True
+            self.done.set()
+            return
+        buttons = [
+            button.get("callback_data", "")
+            for row in (message.get("reply_markup") or {}).get("inline_keyboard", [])
+            for button in row
+        ]
+        for number, rule in enumerate(self.script):
+            if "match" in rule and not re.search(rule["match"], text):
+                continue
+            if "button" in rule:
+                matching = [data for data in buttons if data.startswith(rule["button"])]
+                if not matching:
+                    continue
+            key = (number, message["message_id"], text)
+            if key in self.fired:
+                continue
+            self.fired.add(key)
+            if rule["action"] == "finish":
+                self.done.set()
+                return
+            asyncio.get_running_loop().create_task(self.act(rule, message, buttons))
+            return
+
+    def on_inline_answer(self, results):
+        self.actions += 1
+        if results and results[0]["id"].startswith("pending:"):
+            # Picking the placeholder; the bot edits it once the lookup is done
+            self.driver.server.push_chosen_inline_result(self, results[0]["id"], f"inline-{self.chat_id}")
+            return
+        self.failed = not results or not results[0]["id"].startswith("status:")
+        self.done.set()
+
+    def on_inline_edit(self, text):
+        self.failed = "Passport status" not in text
+        self.done.set()
+
+    async def act(self, rule, message, buttons):
+        if self.driver.think_ms:
+            await asyncio.sleep(random.expovariate(1 / self.driver.think_ms) / 1000)
+        self.actions += 1
+        if rule["action"] == "press":
+            data = next(data for data in buttons if data.startswith(rule["button"]))
+            self.driver.server.push_callback(self, message, data)
+        elif rule["action"] == "text":
+            self.driver.server.push_message(self, text=rule["value"])
+        elif rule["action"] == "document":
+            self.driver.server.push_message(self, document=rule["value"])
+
+
+class FakeBotApi:
+    """Minimal HTTP/1.1 server speaking enough of the Bot API for the bot's handlers."""
+
+    def __init__(self, host, port, latency_ms, flood_rate, flood_retry_after):
+        self.host = host
+        self.port = port
+        self.latency_ms = latency_ms
+        self.flood_rate = flood_rate
+        self.flood_retry_after = flood_retry_after
+        self.server = None
+        self.connections = set()
+        self.chats = {}
+        self.pending = []
+        self.next_update_id = 1
+        self.updates_available = asyncio.Event()
+        self.message_ids = defaultdict(int)
+        self.messages = {}
+        self.delivered_at = {}
+        self.awaiting_response = {}
+        self.inline_chats = {}
+        self.portal = None
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.webhook_client = None
+        self.webhook_tasks = set()
+        self.handler_latencies = []
+        self.calls = Counter()
+        self.floods = 0
+        self.updates_delivered = 0
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.webhook_client:
+            await self.webhook_client.aclose()
+        self.server.close()
+        for writer in list(self.connections):
+            writer.close()
+        await self.server.wait_closed()
+
+    # -- virtual user side -------------------------------------------------
+
+    def _enqueue(self, chat, payload):
+        update = {"update_id": self.next_update_id, **payload}
+        self.next_update_id += 1
+        if self.webhook_url:
+            task = asyncio.create_task(self.push_webhook(update))
+            self.webhook_tasks.add(task)
+            task.add_done_callback(self.webhook_tasks.discard)
+            return
+        self.pending.append(update)
+        self.updates_available.set()
+
+    def _new_message(self, chat, **fields):
+        self.message_ids[chat.chat_id] += 1
+        return {
+            "message_id": self.message_ids[chat.chat_id],
+            "date": int(time.time()),
+            "chat": chat.chat,
+            **fields,
+        }
+
+    def push_message(self, chat, text=None, document=None):
+        if text is not None:
+            fields = {"from": chat.user, "text": text}
+            if text.startswith("/"):
+                fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        else:
+            file_id = f"doc-{chat.chat_id}-{document}"
+            fields = {
+                "from": chat.user,
+                "document": {
+                    "file_id": file_id,
+                    "file_unique_id": file_id,
+                    "file_name": document,
+                    "mime_type": "application/pdf",
+                    "file_size": len(FAKE_PDF),
+                },
+            }
+        self._enqueue(chat, {"message": self._new_message(chat, **fields)})
+
+    def push_callback(self, chat, message, data):
+        self._enqueue(chat, {
+            "callback_query": {
+                "id": f"{chat.chat_id}-{time.monotonic_ns()}",
+                "from": chat.user,
+                "chat_instance": str(chat.chat_id),
+                "message": message,
+                "data": data,
+            }
+        })
+
+    def push_inline_query(self, chat, query):
+        query_id = f"{chat.chat_id}-{time.monotonic_ns()}"
+        self.inline_chats[query_id] = chat
+        self._enqueue(chat, {
+            "inline_query": {"id": query_id, "from": chat.user, "query": query, "offset": ""}
+        })
+
+    def push_chosen_inline_result(self, chat, result_id, inline_message_id):
+        self.inline_chats[inline_message_id] = chat
+        self._enqueue(chat, {
+            "chosen_inline_result": {
+                "result_id": result_id, "from": chat.user, "query": "", "inline_message_id": inline_message_id,
+            }
+        })
+
+    # -- HTTP side ---------------------------------------------------------
+
+    async def handle_connection(self, reader, writer):
+        self.connections.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, content_type, payload = await self.dispatch(method, target, headers, body)
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\nConnection: keep-alive\r\n\r\n".encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    def parse_params(self, headers, body):
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("multipart/form-data"):
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body
+            )
+            raw = {
+                part.get_param("name", header="content-disposition"): part.get_content()
+                for part in message.iter_parts()
+                if not part.get_filename()
+            }
+        else:
+            raw = dict(parse_qsl(body.decode("utf-8"), keep_blank_values=True))
+        params = {}
+        for key, value in raw.items():
+            if isinstance(value, bytes):
+                value = value.decode("utf-8")
+            try:
+                params[key] = json.loads(value)
+            except (TypeError, ValueError):
+                params[key] = value
+        return params
+
+    async def dispatch(self, http_method, target, headers, body):
+        if target.startswith("/file/"):
+            return "200 OK", "application/octet-stream", FAKE_PDF
+        if target.startswith("/portal"):
+            self.calls["portalProbe"] += 1
+            if self.portal and self.portal.down():
+                return "503 Service Unavailable", "text/html", b"<title>Service Unavailable</title>"
+            return "200 OK", "text/html", b"<title>Ethiopian Passport Services</title>"
+        api_method = target.rsplit("/", 1)[-1]
+        params = self.parse_params(headers, body)
+        self.calls[api_method] += 1
+        if api_method == "getUpdates":
+            result = await self.get_updates(params)
+            return self.ok(result)
+
+        if self.latency_ms:
+            await asyncio.sleep(random.lognormvariate(math.log(self.latency_ms), 0.5) / 1000)
+        chat_id = params.get("chat_id")
+        inline_chat = self.inline_chats.get(params.get("inline_query_id") or params.get("inline_message_id"))
+        if inline_chat:
+            chat_id = inline_chat.chat_id
+        if chat_id in self.awaiting_response:
+            self.handler_latencies.append(time.perf_counter() - self.awaiting_response.pop(chat_id))
+        if api_method in FLOODABLE_METHODS and random.random() < self.flood_rate:
+            self.floods += 1
+            return "429 Too Many Requests", "application/json", json.dumps({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.flood_retry_after}",
+                "parameters": {"retry_after": self.flood_retry_after},
+            }).encode()
+        return self.ok(self.respond(api_method, params))
+
+    def ok(self, result):
+        return "200 OK", "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+    async def get_updates(self, params):
+        offset = params.get("offset") or 0
+        self.pending = [update for update in self.pending if update["update_id"] >= offset]
+        if not self.pending:
+            self.updates_available.clear()
+            try:
+                await asyncio.wait_for(self.updates_available.wait(), float(params.get("timeout") or 0) or 0.05)
+            except asyncio.TimeoutError:
+                return []
+        batch = self.pending[: int(params.get("limit") or 100)]
+        for update in batch:
+            self._mark_delivered(update)
+        return batch
+
+    def _mark_delivered(self, update):
+        now = time.perf_counter()
+        if update["update_id"] not in self.delivered_at:
+            self.delivered_at[update["update_id"]] = now
+            self.updates_delivered += 1
+            if "message" in update or "callback_query" in update:
+                chat = (update.get("message") or update["callback_query"]["message"])["chat"]["id"]
+            else:
+                chat = (update.get("inline_query") or update["chosen_inline_result"])["from"]["id"]
+            self.awaiting_response.setdefault(chat, now)
+
+    async def push_webhook(self, update):
+        if self.webhook_client is None:
+            self.webhook_client = httpx.AsyncClient(timeout=30)
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret} if self.webhook_secret else {}
+        self._mark_delivered(update)
+        for _ in range(5):
+            try:
+                response = await self.webhook_client.post(self.webhook_url, json=update, headers=headers)
+                if response.status_code == 200:
+                    return
+                logger.warning(f"webhook answered {response.status_code}, redelivering")
+            except httpx.HTTPError as e:
+                logger.warning(f"webhook delivery failed: {e!r}")
+            await asyncio.sleep(0.5)
+
+    def respond(self, api_method, params):
+        chat_id = params.get("chat_id")
+        chat = self.chats.get(chat_id)
+        if api_method == "getMe":
+            return BOT_USER
+        if api_method == "setWebhook":
+            self.webhook_url = params["url"]
+            self.webhook_secret = params.get("secret_token")
+            return True
+        if api_method == "deleteWebhook":
+            self.webhook_url = None
+            return True
+        if api_method == "getFile":
+            return {
+                "file_id": params["file_id"],
+                "file_unique_id": params["file_id"],
+                "file_size": len(FAKE_PDF),
+                "file_path": f"documents/{params['file_id']}.pdf",
+            }
+        if api_method in ("sendMessage", "sendDocument") and chat:
+            fields = {"from": BOT_USER}
+            if api_method == "sendMessage":
+                fields["text"] = params.get("text", "")
+            else:
+                fields["caption"] = params.get("caption", "")
+                fields["document"] = {"file_id": "out", "file_unique_id": "out", "file_name": "out.pdf"}
+            if isinstance(params.get("reply_markup"), dict):
+                fields["reply_markup"] = params["reply_markup"]
+            message = self._new_message(chat, **fields)
+            self.messages[(chat_id, message["message_id"])] = message
+            chat.on_bot_message(message)
+            return message
+        if api_method == "answerInlineQuery":
+            self.inline_chats.pop(params["inline_query_id"]).on_inline_answer(params.get("results") or [])
+            return True
+        if api_method == "editMessageText" and params.get("inline_message_id") in self.inline_chats:
+            self.inline_chats.pop(params["inline_message_id"]).on_inline_edit(params.get("text", ""))
+            return True
+        if api_method in ("editMessageText", "editMessageReplyMarkup") and chat:
+            message = dict(self.messages.get((chat_id, params.get("message_id")), {}))
+            message.update({"message_id": params.get("message_id"), "date": int(time.time()), "chat": chat.chat})
+            if "text" in params:
+                message["text"] = params["text"]
+            message.pop("reply_markup", None)
+            if isinstance(params.get("reply_markup"), dict):
+                message["reply_markup"] = params["reply_markup"]
+            self.messages[(chat_id, message["message_id"])] = message
+            chat.on_bot_message(message)
+            return message
+        return True
+
+
+class LoadDriver:
+    def __init__(self, args):
+        self.args = args
+        self.think_ms = args.think_ms
+        self.server = FakeBotApi(args.host, args.port, args.latency_ms, args.flood_rate, args.flood_retry_after)
+
+    async def run(self):
+        args = self.args
+        await self.server.start()
+        os.environ["TELEGRAM_BOT_TOKEN"] = FAKE_TOKEN
+        os.environ["TELEGRAM_API_BASE_URL"] = self.server.base_url
+        os.environ["WEBHOOK_LISTEN"] = args.host
+        os.environ["WEBHOOK_PORT"] = str(args.webhook_port)
+        os.environ["PORTAL_PROBE_URL"] = f"{self.server.base_url}/portal"
+        os.environ.setdefault("PORTAL_PROBE_INTERVAL_S", "1")
+        os.environ.setdefault("BREAKER_OPEN_S", "2")
+        if args.webhook:
+            os.environ["WEBHOOK_URL"] = f"http://{args.host}:{args.webhook_port}"
+            os.environ["WEBHOOK_SECRET_TOKEN"] = "loadtest-secret"
+        if args.workers:
+            os.environ["BOT_WORKERS"] = str(args.workers)
+            os.environ["WORKER_BASE_PORT"] = str(args.webhook_port + 1)
+            os.environ["WORKER_COMMAND"] = shlex.join([
+                sys.executable, os.path.abspath(__file__), "--serve-worker",
+                "--bot-module", args.bot_module, "--bot-log-level", args.bot_log_level,
+                "--portal-step-ms", str(args.portal_step_ms), "--portal-launch-ms", str(args.portal_launch_ms),
+                "--portal-wait-scale", str(args.portal_wait_scale), "--portal-archive", args.portal_archive,
+            ])
+        if args.portal_archive:
+            os.environ["PORTAL_REPLAY_ARCHIVE"] = args.portal_archive
+            os.environ["PORTAL_REPLAY_TIME_SCALE"] = str(args.replay_time_scale)
+        if args.inline_wait_s is not None:
+            os.environ["INLINE_STATUS_WAIT_S"] = str(args.inline_wait_s)
+        bot = importlib.import_module(args.bot_module)
+        logging.getLogger().setLevel(getattr(logging, args.bot_log_level))
+        portal = StubPortal(
+            args.portal_step_ms, args.portal_launch_ms, args.portal_wait_scale, args.crash_rate, args.crash_within_s
+        )
+        portal.down_until = time.monotonic() + args.portal_down_s
+        self.server.portal = portal
+        if not args.portal_archive:
+            bot.async_playwright = portal.async_playwright
+
+        if args.workers:
+            supervisor = bot.Supervisor(args.workers)
+            await supervisor.start()
+        else:
+            await self.start_bot(bot)
+            if args.restart_at_s:
+                asyncio.create_task(self.restart_bot(bot, args.restart_at_s))
+
+        chats = []
+        for i in range(args.chats):
+            kind = "status" if random.random() < args.status_ratio else "booking"
+            if random.random() < args.inline_ratio:
+                kind = "inline"
+            elif kind == "booking" and random.random() < args.intake_ratio:
+                kind = "intake"
+            scripts = {"booking": BOOKING_SCRIPT, "intake": INTAKE_SCRIPT, "status": STATUS_SCRIPT, "inline": []}
+            chat = VirtualChat(self, 10_000 + i, kind, [OUTAGE_RETRY] + scripts[kind])
+            self.server.chats[chat.chat_id] = chat
+            chats.append(chat)
+
+        started = time.perf_counter()
+        tasks = []
+        for chat in chats:
+            tasks.append(asyncio.create_task(chat.run(args.conversation_timeout)))
+            if args.ramp_up:
+                await asyncio.sleep(args.ramp_up / max(1, args.chats))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+        if args.workers:
+            cluster = await supervisor.metrics()
+            await supervisor.stop()
+            print(f"\nworkers: {cluster['supervisor']['workers']}")
+            print(f"cluster outbound: {cluster['total'].get('outbound')}")
+        else:
+            await self.stop_bot(bot)
+        await self.server.close()
+        self.report(chats, elapsed, portal)
+        if not args.workers:
+            print(f"status cache: {bot.status_cache.stats()}")
+            print(f"portal breaker: {bot.portal_breaker.stats()}")
+            print(f"browser crashes: {portal.crashes}, booking recovery: {bot.booking_recovery.stats()}")
+            if self.args.restart_at_s:
+                print(f"restart: {bot.shutdown_controller.stats()}")
+            print("portal timeouts: " + ", ".join(
+                f"{operation}={values['timeout_ms']}ms (n={values['samples']}, p99={values['p99_ms']})"
+                for operation, values in bot.timeout_policy.stats().items()
+            ))
+
+    async def start_bot(self, bot):
+        self.application = bot.build_application()
+        await self.application.initialize()
+        if self.application.post_init:
+            await self.application.post_init(self.application)
+        await self.application.start()
+        if self.args.webhook:
+            self.webhook = await bot.start_webhook(self.application)
+        else:
+            await self.application.updater.start_polling(poll_interval=0.0, timeout=10)
+
+    async def stop_bot(self, bot, drain=False):
+        if drain:
+            async def stop_ingress():
+                if self.args.webhook:
+                    self.webhook.ready = False
+                    self.webhook.draining = True
+                else:
+                    await self.application.updater.stop()
+
+            await bot.shutdown_controller.drain(self.application, stop_ingress)
+        elif not self.args.webhook:
+            await self.application.updater.stop()
+        if self.args.webhook:
+            await self.webhook.close()
+        if self.application.running:
+            await self.application.stop()
+        await self.application.shutdown()
+
+    async def restart_bot(self, bot, delay):
+        # A rolling restart inside one process: drain, then a fresh application picks up the saved bookings
+        await asyncio.sleep(delay)
+        started = time.perf_counter()
+        await self.stop_bot(bot, drain=True)
+        bot.shutdown_controller.draining = False
+        await self.start_bot(bot)
+        print(f"restarted in {time.perf_counter() - started:.2f}s")
+
+    def report(self, chats, elapsed, portal):
+        server = self.server
+        print(f"\n=== Load test: {len(chats)} virtual chats in {elapsed:.1f}s ===")
+        for kind in ("booking", "intake", "status", "inline"):
+            group = [chat for chat in chats if chat.kind == kind]
+            if not group:
+                continue
+            completed = [chat.finished_at - chat.started_at for chat in group if not chat.failed]
+            print(
+                f"{kind:>8}: {len(completed)}/{len(group)} completed, "
+                f"conversation p50 {percentile(completed, 50):.2f}s p95 {percentile(completed, 95):.2f}s "
+                f"max {max(completed, default=0):.2f}s, "
+                f"{sum(chat.actions for chat in group) / len(group):.1f} user updates/chat"
+            )
+        latencies = [latency * 1000 for latency in server.handler_latencies]
+        print(f"updates delivered: {server.updates_delivered} ({server.updates_delivered / elapsed:.1f} updates/s)")
+        print(
+            f"handler latency (update -> first reply): p50 {percentile(latencies, 50):.1f}ms "
+            f"p95 {percentile(latencies, 95):.1f}ms p99 {percentile(latencies, 99):.1f}ms "
+            f"max {max(latencies, default=0):.1f}ms"
+        )
+        steps = "in worker processes" if self.args.workers else "replayed archive" if self.args.portal_archive else portal.steps
+        print(f"injected 429s: {server.floods}, portal steps: {steps}")
+        print("Bot API calls: " + ", ".join(f"{name}={count}" for name, count in server.calls.most_common()))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the bot's conversation layer with a fake Bot API")
+    parser.add_argument("--chats", type=int, default=200, help="number of virtual chats")
+    parser.add_argument("--status-ratio", type=float, default=0.5, help="share of chats running the status script")
+    parser.add_argument("--intake-ratio", type=float, default=0.0,
+                        help="share of booking chats sending all personal details in one message")
+    parser.add_argument("--inline-ratio", type=float, default=0.0, help="share of chats doing an inline status lookup")
+    parser.add_argument("--inline-wait-s", type=float, default=None,
+                        help="override INLINE_STATUS_WAIT_S; 0 forces the placeholder path")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="seconds over which chats are started")
+    parser.add_argument("--think-ms", type=float, default=50.0, help="mean virtual user think time")
+    parser.add_argument("--latency-ms", type=float, default=40.0, help="median injected Bot API latency")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="probability of a 429 on send/edit calls")
+    parser.add_argument("--flood-retry-after", type=int, default=1, help="retry_after sent with injected 429s")
+    parser.add_argument("--conversation-timeout", type=float, default=300.0)
+    parser.add_argument("--portal-step-ms", type=float, default=2.0, help="mean latency of one stub portal action")
+    parser.add_argument("--portal-launch-ms", type=float, default=50.0, help="stub browser launch time")
+    parser.add_argument("--portal-wait-scale", type=float, default=0.01, help="scale applied to page.wait_for_timeout")
+    parser.add_argument("--portal-down-s", type=float, default=0.0,
+                        help="stub portal answers 'Service Unavailable' for this many seconds after start")
+    parser.add_argument("--crash-rate", type=float, default=0.0,
+                        help="probability that a session browser crashes some time after launch")
+    parser.add_argument("--crash-within-s", type=float, default=5.0, help="crashes happen within this many seconds")
+    parser.add_argument("--portal-archive", default="",
+                        help="replay this recorded portal archive (file or directory) in real Chromium instead of the stub")
+    parser.add_argument("--replay-time-scale", type=float, default=1.0,
+                        help="scale applied to recorded response times; 0 answers at once")
+    parser.add_argument("--restart-at-s", type=float, default=0.0,
+                        help="drain and restart the bot this many seconds in, as a rolling deploy would")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--webhook", action="store_true", help="deliver updates through the bot's webhook server")
+    parser.add_argument("--webhook-port", type=int, default=18443)
+    parser.add_argument("--workers", type=int, default=0, help="run the bot as a supervisor with N worker processes")
+    parser.add_argument("--serve-worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--bot-module", default="main")
+    parser.add_argument("--bot-log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    return parser.parse_args()
+
+
+def serve_worker(args):
+    # Entry point for supervisor workers: the real webhook worker with the stub portal
+    bot = importlib.import_module(args.bot_module)
+    logging.getLogger().setLevel(getattr(logging, args.bot_log_level))
+    if not args.portal_archive:
+        bot.async_playwright = StubPortal(args.portal_step_ms, args.portal_launch_ms, args.portal_wait_scale).async_playwright
+    asyncio.run(bot.run_webhook(bot.build_application()))
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    if arguments.serve_worker:
+        serve_worker(arguments)
+    else:
+        asyncio.run(LoadDriver(arguments).run())
@@ -1,39 +1,1000 @@
+import array
 import asyncio
+import atexit
+import base64
+import contextlib
+import contextvars
+import functools
+import hashlib
+import heapq
+import hmac
+import importlib.util
+import itertools
+import ipaddress
+import json
 import logging
+import logging.handlers
+import mimetypes
 import os
-from datetime import datetime, timedelta
-from collections import defaultdict
+import queue
+import random
+import secrets
+import shlex
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+import traceback
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from collections import Counter, OrderedDict, defaultdict, deque
 import re
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+# Cold-start clock, taken before the third-party imports
+PROCESS_STARTED = time.perf_counter()
+import httpx
+from telegram import (
+    Bot,
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+)
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    BasePersistence,
+    BaseRateLimiter,
+    ChosenInlineResultHandler,
     CommandHandler,
     ConversationHandler,
     InlineQueryHandler,
     CallbackQueryHandler,
     MessageHandler,
     ContextTypes,
+    PersistenceInput,
+    TypeHandler,
     filters
 )
-from bs4 import BeautifulSoup
-from playwright.async_api import async_playwright
-from ethiopian_date import EthiopianDateConverter
 import dotenv
+IMPORTS_FINISHED = time.perf_counter()
+
+# Playwright, BeautifulSoup and ethiopian_date are imported on first use (or by the
+# startup warm-up) so the process can build the application and answer health
+# checks while they load.
+def async_playwright():
+    from playwright.async_api import async_playwright as playwright_factory
+    return playwright_factory()
+
+def is_playwright_timeout(error):
+    # Nothing Playwright raised can exist before the module is loaded
+    module = sys.modules.get("playwright.async_api")
+    return module is not None and isinstance(error, module.TimeoutError)
 
-# Configure logging
+# Configure logging. Records are handed to a background thread so the file and
+# console writes never block the event loop.
+# Sharded workers tag their lines and write their own file.
+WORKER_INDEX = os.getenv("WORKER_INDEX")
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter(
+    '%(asctime)s [%(levelname)s] ' + (f'[worker {WORKER_INDEX}] ' if WORKER_INDEX else '') + '%(message)s'
+))
+_log_file_handler = logging.FileHandler(os.getenv("BOT_LOG_FILE", 'passport_bot.log'))
+_log_file_handler.setFormatter(_log_handler.formatter)
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_file_handler, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.FileHandler('passport_bot.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[_log_queue_handler]
 )
 logger = logging.getLogger(__name__)
 
 dotenv.load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-active_sessions = defaultdict(dict)
+# Optional Bot API endpoint override (e.g. a local Bot API server or the load-test stand-in)
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "").rstrip("/")
+
+# Browser sessions. Live Playwright objects stay in this process; their metadata
+# goes to a pluggable store indexed by state, age and browser so expiry, admission
+# and metrics never scan every session.
+SESSION_STORE = os.getenv("SESSION_STORE", "memory").lower()
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", f"sessions.worker{WORKER_INDEX}.db" if WORKER_INDEX else "sessions.db")
+SESSION_IDLE_TIMEOUT_S = int(os.getenv("SESSION_IDLE_TIMEOUT_S", str(30 * 60)))
+
+class BrowserSession:
+    def __init__(self, chat_id: int, playwright, browser, page, state: str = "starting"):
+        self.chat_id = chat_id
+        self.playwright = playwright
+        self.browser = browser
+        self.page = page
+        self.state = state
+        self.browser_id = f"{os.getpid()}:{id(browser):x}"
+        self.created_at = time.time()
+        self.last_active = self.created_at
+        self.leases = 0
+        self.uploads = {}
+
+    def metadata(self) -> dict:
+        return {
+            "chat_id": self.chat_id,
+            "state": self.state,
+            "browser_id": self.browser_id,
+            "created_at": self.created_at,
+            "last_active": self.last_active,
+        }
+
+class MemorySessionStore:
+    def __init__(self):
+        self.rows = {}
+        self.by_state = defaultdict(set)
+        self.by_browser = defaultdict(set)
+        # (last_active, chat_id) heap; entries made stale by later touches are skipped
+        self._age = []
+
+    def put(self, row: dict) -> None:
+        self.delete(row["chat_id"])
+        self.rows[row["chat_id"]] = dict(row)
+        self.by_state[row["state"]].add(row["chat_id"])
+        self.by_browser[row["browser_id"]].add(row["chat_id"])
+        self._push_age(row["last_active"], row["chat_id"])
+
+    def touch(self, chat_id: int, last_active: float, state: str = None) -> None:
+        row = self.rows.get(chat_id)
+        if row is None:
+            return
+        if state and state != row["state"]:
+            self.by_state[row["state"]].discard(chat_id)
+            self.by_state[state].add(chat_id)
+            row["state"] = state
+        row["last_active"] = last_active
+        self._push_age(last_active, chat_id)
+
+    def delete(self, chat_id: int) -> None:
+        row = self.rows.pop(chat_id, None)
+        if row:
+            self.by_state[row["state"]].discard(chat_id)
+            self.by_browser[row["browser_id"]].discard(chat_id)
+            if not self.by_browser[row["browser_id"]]:
+                del self.by_browser[row["browser_id"]]
+
+    def get(self, chat_id: int):
+        return self.rows.get(chat_id)
+
+    def chats_in_state(self, state: str) -> list:
+        return list(self.by_state.get(state, ()))
+
+    def chats_on_browser(self, browser_id: str) -> list:
+        return list(self.by_browser.get(browser_id, ()))
+
+    def idle_since(self, cutoff: float) -> list:
+        idle = []
+        while self._age and self._age[0][0] < cutoff:
+            last_active, chat_id = heapq.heappop(self._age)
+            row = self.rows.get(chat_id)
+            if row and row["last_active"] == last_active:
+                idle.append((last_active, chat_id))
+        for entry in idle:
+            heapq.heappush(self._age, entry)
+        return [chat_id for _, chat_id in idle]
+
+    def counts(self) -> dict:
+        return {state: len(chats) for state, chats in self.by_state.items() if chats}
+
+    def _push_age(self, last_active, chat_id):
+        heapq.heappush(self._age, (last_active, chat_id))
+        if len(self._age) > 2 * len(self.rows) + 64:
+            self._age = [(row["last_active"], key) for key, row in self.rows.items()]
+            heapq.heapify(self._age)
+
+    def close(self) -> None:
+        pass
+
+class SQLiteSessionStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "chat_id INTEGER PRIMARY KEY, state TEXT NOT NULL, browser_id TEXT NOT NULL, "
+            "created_at REAL NOT NULL, last_active REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS sessions_state ON sessions(state)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS sessions_last_active ON sessions(last_active)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS sessions_browser ON sessions(browser_id)")
+        # Rows left by a previous process have no live browser behind them
+        self.db.execute("DELETE FROM sessions")
+        # Touches come with every page access; they are written in one batch before the next read
+        self.pending = {}
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        touches = [(last_active, state, chat_id) for chat_id, (last_active, state) in self.pending.items()]
+        self.pending.clear()
+        self.db.execute("BEGIN")
+        self.db.executemany("UPDATE sessions SET last_active = ?, state = COALESCE(?, state) WHERE chat_id = ?", touches)
+        self.db.execute("COMMIT")
+
+    def put(self, row: dict) -> None:
+        self.pending.pop(row["chat_id"], None)
+        self.db.execute(
+            "INSERT OR REPLACE INTO sessions (chat_id, state, browser_id, created_at, last_active) "
+            "VALUES (:chat_id, :state, :browser_id, :created_at, :last_active)",
+            row,
+        )
+
+    def touch(self, chat_id: int, last_active: float, state: str = None) -> None:
+        previous = self.pending.get(chat_id)
+        self.pending[chat_id] = (last_active, state or (previous[1] if previous else None))
+
+    def delete(self, chat_id: int) -> None:
+        self.pending.pop(chat_id, None)
+        self.db.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+
+    def get(self, chat_id: int):
+        self.flush()
+        row = self.db.execute("SELECT * FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+        return dict(row) if row else None
+
+    def chats_in_state(self, state: str) -> list:
+        self.flush()
+        return [row[0] for row in self.db.execute("SELECT chat_id FROM sessions WHERE state = ?", (state,))]
+
+    def chats_on_browser(self, browser_id: str) -> list:
+        self.flush()
+        return [row[0] for row in self.db.execute("SELECT chat_id FROM sessions WHERE browser_id = ?", (browser_id,))]
+
+    def idle_since(self, cutoff: float) -> list:
+        self.flush()
+        return [
+            row[0] for row in
+            self.db.execute("SELECT chat_id FROM sessions WHERE last_active < ? ORDER BY last_active", (cutoff,))
+        ]
+
+    def counts(self) -> dict:
+        self.flush()
+        return dict(self.db.execute("SELECT state, COUNT(*) FROM sessions GROUP BY state").fetchall())
+
+    def close(self) -> None:
+        self.flush()
+        self.db.close()
+
+class SessionRegistry:
+    def __init__(self, store):
+        self.store = store
+        self.sessions = {}
+        self.locks = {}
+        self.counters = Counter()
+
+    def __contains__(self, chat_id):
+        return chat_id in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, chat_id: int):
+        return self.sessions.get(chat_id)
+
+    def lock(self, chat_id: int) -> asyncio.Lock:
+        return self.locks.setdefault(chat_id, asyncio.Lock())
+
+    def page(self, chat_id: int):
+        session = self.sessions[chat_id]
+        self.touch(chat_id)
+        return session.page
+
+    def touch(self, chat_id: int, state: str = None) -> None:
+        session = self.sessions.get(chat_id)
+        if session is None:
+            return
+        session.last_active = time.time()
+        if state:
+            session.state = state
+        self.store.touch(chat_id, session.last_active, state)
+
+    def register(self, session: BrowserSession) -> None:
+        self.sessions[session.chat_id] = session
+        self.store.put(session.metadata())
+        self.counters["registered"] += 1
+
+    @contextlib.asynccontextmanager
+    async def lease(self, chat_id: int, state: str = None):
+        # A leased session is never expired. Conversation steps run under one (see
+        # leased()); take one around work that outlives a handler step as well
+        session = self.sessions.get(chat_id)
+        if session is None:
+            yield None
+            return
+        session.leases += 1
+        self.counters["leases"] += 1
+        self.touch(chat_id, state)
+        try:
+            yield session
+        finally:
+            session.leases -= 1
+            self.touch(chat_id)
+
+    async def release(self, chat_id: int, reason: str) -> bool:
+        lock = self.lock(chat_id)
+        async with lock:
+            session = self.sessions.pop(chat_id, None)
+            self.store.delete(chat_id)
+            if session is None:
+                return False
+            await self._close(chat_id, session, reason)
+        if not lock.locked() and chat_id not in self.sessions:
+            self.locks.pop(chat_id, None)
+        return True
+
+    async def _close(self, chat_id: int, session: BrowserSession, reason: str) -> None:
+        session.state = "closing"
+        logger.info(f"[SessionRegistry:Release] Closing session for chat_id {chat_id} ({reason})")
+        for name, close in (
+            ("page", session.page.close), ("browser", functools.partial(close_browser, session.browser)),
+            ("playwright", session.playwright.stop),
+        ):
+            try:
+                await close()
+            except Exception as e:
+                logger.error(f"[SessionRegistry:CloseError] Error closing {name} for chat_id {chat_id}: {str(e)}")
+        self.counters[f"released_{reason}"] += 1
+
+    async def close_all(self, reason: str) -> int:
+        # Shutdown path: skips the per-chat locks (a handler cut off by the drain
+        # deadline may still hold one) and closes every session at once
+        sessions = list(self.sessions.items())
+        self.sessions.clear()
+        for chat_id, _ in sessions:
+            self.store.delete(chat_id)
+        await asyncio.gather(*(self._close(chat_id, session, reason) for chat_id, session in sessions))
+        return len(sessions)
+
+    async def expire(self, max_idle_s: float) -> int:
+        expired = 0
+        for chat_id in self.store.idle_since(time.time() - max_idle_s):
+            session = self.sessions.get(chat_id)
+            if session is None:
+                self.store.delete(chat_id)
+            elif not session.leases:
+                logger.info(f"[SessionRegistry:Expire] Found inactive session for chat_id {chat_id}")
+                expired += await self.release(chat_id, "idle")
+        return expired
+
+    async def browser_lost(self, browser_id: str) -> list:
+        lost = []
+        for chat_id in self.store.chats_on_browser(browser_id):
+            logger.error(f"[SessionRegistry:BrowserLost] Browser {browser_id} disconnected under chat_id {chat_id}")
+            if await self.release(chat_id, "browser_lost"):
+                lost.append(chat_id)
+        return lost
+
+    def stats(self) -> dict:
+        return {
+            "live": len(self.sessions),
+            "leased": sum(1 for session in self.sessions.values() if session.leases),
+            "by_state": self.store.counts(),
+            **self.counters,
+        }
+
+session_registry = SessionRegistry(
+    SQLiteSessionStore(SESSION_DB_PATH) if SESSION_STORE == "sqlite" else MemorySessionStore()
+)
+
+def leased(callback):
+    # Holds the chat's session lease for a whole handler step, so the idle sweep
+    # never closes a page a handler is still driving
+    @functools.wraps(callback)
+    async def step(update, context):
+        chat = update.effective_chat
+        if chat is None:
+            return await callback(update, context)
+        async with session_registry.lease(chat.id):
+            return await callback(update, context)
+    return step
+
+# Thread pool for parsing, file-system and PDF post-processing work
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "4"))
+BLOCKING_QUEUE_LIMIT = int(os.getenv("BLOCKING_QUEUE_LIMIT", "64"))
+
+class BlockingExecutor:
+    def __init__(self, max_workers, queue_limit, name="blocking"):
+        self.max_workers = max_workers
+        self.queue_limit = queue_limit
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = None
+        self.in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.backpressure_waits = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self.calls_by_label = Counter()
+
+    def _timed_call(self, submitted_at, func, args, kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs), started - submitted_at, time.perf_counter() - started, None
+        except Exception as e:
+            return None, started - submitted_at, time.perf_counter() - started, e
+
+    async def run(self, label, func, *args, **kwargs):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers + self.queue_limit)
+        if self._slots.locked():
+            logger.warning(f"[BlockingExecutor:Backpressure] Queue full, {label} waiting for a slot")
+            self.backpressure_waits += 1
+        async with self._slots:
+            self.submitted += 1
+            self.in_flight += 1
+            self.calls_by_label[label] += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            loop = asyncio.get_running_loop()
+            try:
+                result, waited, ran, error = await loop.run_in_executor(
+                    self._executor,
+                    functools.partial(self._timed_call, time.perf_counter(), func, args, kwargs)
+                )
+            finally:
+                self.in_flight -= 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self.total_run += ran
+        if error is not None:
+            self.failed += 1
+            raise error
+        self.completed += 1
+        return result
+
+    @property
+    def queue_depth(self):
+        return max(0, self.in_flight - self.max_workers)
+
+    def stats(self):
+        finished = max(1, self.completed + self.failed)
+        return {
+            "workers": self.max_workers,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "backpressure_waits": self.backpressure_waits,
+            "avg_wait_ms": round(self.total_wait / finished * 1000, 2),
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+            "avg_run_ms": round(self.total_run / finished * 1000, 2),
+            "by_label": dict(self.calls_by_label),
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+blocking_executor = BlockingExecutor(BLOCKING_WORKERS, BLOCKING_QUEUE_LIMIT)
+
+# Admin-only commands are restricted to these chat ids (comma separated)
+ADMIN_CHAT_IDS = {int(chat_id) for chat_id in os.getenv("ADMIN_CHAT_IDS", "").replace(" ", "").split(",") if chat_id}
+
+def is_admin(update: Update) -> bool:
+    return bool(update.effective_chat) and update.effective_chat.id in ADMIN_CHAT_IDS
+
+# Event-loop lag monitoring
+LOOP_LAG_INTERVAL_MS = int(os.getenv("LOOP_LAG_INTERVAL_MS", "100"))
+LOOP_LAG_THRESHOLD_MS = int(os.getenv("LOOP_LAG_THRESHOLD_MS", "250"))
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+class LoopLagMonitor:
+    def __init__(self, interval_ms, threshold_ms):
+        self.interval = interval_ms / 1000
+        self.threshold = threshold_ms / 1000
+        self.samples = deque(maxlen=3000)
+        self.incidents = deque(maxlen=50)
+        self.blocked_by = Counter()
+        self.last_beat = time.perf_counter()
+        self.loop = None
+        self.loop_thread_id = None
+        self._stall_captured = False
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.perf_counter()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+        logger.info(f"[LoopLagMonitor:Start] Monitoring loop lag every {self.interval * 1000:.0f}ms, threshold {self.threshold * 1000:.0f}ms")
+
+    def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            lag = max(0.0, now - expected)
+            self.samples.append(lag)
+            self.last_beat = now
+            if lag >= self.threshold:
+                incident = self.incidents[-1] if self._stall_captured and self.incidents else None
+                where = incident["handler"] if incident else "unknown (stall shorter than watchdog tick)"
+                logger.warning(f"[LoopLagMonitor:Lag] Event loop lagged {lag * 1000:.0f}ms, blocked in {where}")
+                if incident:
+                    incident["lag_ms"] = round(lag * 1000)
+                else:
+                    self.blocked_by[where] += 1
+            self._stall_captured = False
+
+    def _watch(self):
+        # Runs in its own thread so it can sample the loop thread while it is blocked
+        while not self._stopped.wait(self.interval):
+            stalled_for = time.perf_counter() - self.last_beat - self.interval
+            if stalled_for >= self.threshold and not self._stall_captured:
+                self._stall_captured = True
+                self._capture(stalled_for)
+
+    def _capture(self, stalled_for):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return
+        stack = traceback.extract_stack(frame)
+        handler = next(
+            (f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})"
+             for entry in reversed(stack) if entry.filename == __file__),
+            f"{stack[-1].name} ({os.path.basename(stack[-1].filename)}:{stack[-1].lineno})" if stack else "unknown"
+        )
+        task = asyncio.current_task(self.loop) if self.loop else None
+        task_name = task.get_name() if task else None
+        coroutine = getattr(task.get_coro(), "__qualname__", None) if task else None
+        self.blocked_by[handler] += 1
+        self.incidents.append({
+            "at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "lag_ms": round(stalled_for * 1000),
+            "handler": handler,
+            "task": f"{task_name} ({coroutine})" if task else None,
+            "stack": traceback.format_list(stack[-12:]),
+        })
+        logger.warning(
+            f"[LoopLagMonitor:Blocked] Event loop blocked for {stalled_for * 1000:.0f}ms+ in {handler}, "
+            f"task {task_name}\n{''.join(traceback.format_list(stack[-12:]))}"
+        )
+
+    def summary(self, top=5):
+        lags_ms = [lag * 1000 for lag in self.samples]
+        lines = [
+            "⏱ Event loop lag",
+            f"samples: {len(lags_ms)} (every {self.interval * 1000:.0f}ms)",
+            f"p50 {percentile(lags_ms, 50):.1f}ms, p95 {percentile(lags_ms, 95):.1f}ms, "
+            f"p99 {percentile(lags_ms, 99):.1f}ms, max {max(lags_ms, default=0):.1f}ms",
+            f"stalls over {self.threshold * 1000:.0f}ms: {sum(self.blocked_by.values())}",
+        ]
+        for handler, count in self.blocked_by.most_common(top):
+            lines.append(f"  {count}× {handler}")
+        if self.incidents:
+            last = self.incidents[-1]
+            lines.append(f"last stall {last['at']}: {last['lag_ms']}ms in {last['handler']}, task {last['task']}")
+            lines.append("".join(last["stack"][-4:]).rstrip())
+        return "\n".join(lines)
+
+loop_lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL_MS, LOOP_LAG_THRESHOLD_MS)
+
+# On-demand profiling (/profile). While a profile runs, a thread samples the event
+# loop thread's stack every PROFILE_INTERVAL_MS, optionally with tracemalloc on;
+# while it is off nothing is installed. Stacks are written in the folded format
+# read by flamegraph.pl, inferno and speedscope.
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DEFAULT_S = float(os.getenv("PROFILE_DEFAULT_S", "30"))
+PROFILE_MAX_S = float(os.getenv("PROFILE_MAX_S", "600"))
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "10"))
+# tracemalloc's cost grows with traceback depth, and asyncio stacks are deep; raise
+# this only when the allocating line alone is not enough
+PROFILE_ALLOC_FRAMES = int(os.getenv("PROFILE_ALLOC_FRAMES", "1"))
+# Runs after every other handler group, so an update is counted once it was handled.
+# Updates stopped by drain_gate or recovery_gate never get there and are not counted.
+PROFILE_HANDLER_GROUP = 100
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    def __init__(self, interval_ms):
+        self.interval = interval_ms / 1000
+        self.stacks = Counter()
+        self.loop_thread_id = None
+        self.started_at = None
+        self.track_allocations = False
+        self.finished = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, track_allocations=False):
+        self.stacks = Counter()
+        self.loop_thread_id = threading.get_ident()
+        self.started_at = time.perf_counter()
+        self.track_allocations = track_allocations
+        self.finished = asyncio.Event()
+        if track_allocations:
+            tracemalloc.start(PROFILE_ALLOC_FRAMES)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._sample, name="handler-profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"[SamplingProfiler:Start] Sampling every {self.interval * 1000:g}ms, allocations {track_allocations}")
+
+    def _sample(self):
+        # Code objects only; labels are built once the profile is over
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        snapshot = None
+        if self.track_allocations:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        elapsed = time.perf_counter() - self.started_at
+        logger.info(f"[SamplingProfiler:Stop] {sum(self.stacks.values())} samples in {elapsed:.1f}s")
+        return {"elapsed_s": elapsed, "stacks": self.stacks, "snapshot": snapshot}
+
+def is_idle_stack(stack):
+    # The loop waiting in epoll/select for I/O
+    return stack[-1].co_filename.endswith("selectors.py")
+
+def write_profile(profile, directory):
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    paths = [os.path.join(directory, f"cpu-{stamp}.folded")]
+    with open(paths[0], "w", encoding="utf-8") as folded:
+        for stack, count in profile["stacks"].items():
+            folded.write(";".join(frame_label(code) for code in stack) + f" {count}\n")
+    if profile["snapshot"] is not None:
+        paths.append(os.path.join(directory, f"alloc-{stamp}.txt"))
+        with open(paths[1], "w", encoding="utf-8") as alloc:
+            for stat in profile["snapshot"].statistics("traceback")[:200]:
+                alloc.write(f"{stat.size / 1024:.1f} KiB in {stat.count} blocks\n")
+                alloc.write("\n".join(stat.traceback.format()) + "\n\n")
+    return paths
+
+def profile_summary(profile, top, paths, updates):
+    busy = Counter()
+    inclusive = Counter()
+    idle = 0
+    for stack, count in profile["stacks"].items():
+        if is_idle_stack(stack):
+            idle += count
+            continue
+        busy[frame_label(stack[-1])] += count
+        for label in {frame_label(code) for code in stack}:
+            inclusive[label] += count
+    total = sum(profile["stacks"].values())
+    busy_total = max(1, total - idle)
+    lines = [
+        f"🔥 Profile: {profile['elapsed_s']:.1f}s, {updates} updates handled, {total} samples, "
+        f"loop idle {idle / max(1, total):.0%}",
+        f"Top {top} by own time (share of busy samples):",
+    ]
+    lines += [f"  {count / busy_total:5.1%} {label}" for label, count in busy.most_common(top)]
+    lines.append(f"Top {top} including callees:")
+    lines += [f"  {count / busy_total:5.1%} {label}" for label, count in inclusive.most_common(top)]
+    if profile["snapshot"] is not None:
+        lines.append(f"Top {top} allocation sites (live at the end):")
+        for stat in profile["snapshot"].statistics("lineno")[:top]:
+            frame = stat.traceback[0]
+            lines.append(f"  {stat.size / 1024:8.1f} KiB {os.path.basename(frame.filename)}:{frame.lineno}")
+    lines.append("Files: " + ", ".join(paths))
+    return "\n".join(lines)
+
+handler_profiler = SamplingProfiler(PROFILE_INTERVAL_MS)
+
+# Outbound Bot API scheduling. Defaults follow Telegram's published limits:
+# ~30 messages/s overall, ~1 message/s per private chat, 20 messages/min per group.
+RATE_LIMIT_GLOBAL_PER_S = float(os.getenv("RATE_LIMIT_GLOBAL_PER_S", "30"))
+RATE_LIMIT_CHAT_PER_S = float(os.getenv("RATE_LIMIT_CHAT_PER_S", "1"))
+RATE_LIMIT_CHAT_BURST = float(os.getenv("RATE_LIMIT_CHAT_BURST", "3"))
+RATE_LIMIT_GROUP_PER_MIN = float(os.getenv("RATE_LIMIT_GROUP_PER_MIN", "20"))
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "3"))
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+# Endpoints that answer a user action directly and do not count against chat limits
+UNTHROTTLED_PER_CHAT_ENDPOINTS = {"answerCallbackQuery", "answerInlineQuery"}
+
+_outbound_priority = contextvars.ContextVar("outbound_priority", default=PRIORITY_INTERACTIVE)
+
+@contextlib.contextmanager
+def outbound_priority(priority):
+    # Message shortcuts (reply_text, edit_text, ...) don't forward rate_limit_args,
+    # so callers mark bulk sends with this context instead
+    token = _outbound_priority.set(priority)
+    try:
+        yield
+    finally:
+        _outbound_priority.reset(token)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self):
+        # Takes a token now (possibly going negative) and returns how long to wait for it
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def blocked_for(self):
+        return max(0.0, self.blocked_until - time.monotonic())
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    @property
+    def idle(self):
+        now = time.monotonic()
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class OutboundRateLimiter(BaseRateLimiter):
+    def __init__(self):
+        self.global_bucket = TokenBucket(RATE_LIMIT_GLOBAL_PER_S, RATE_LIMIT_GLOBAL_PER_S)
+        self.chat_buckets = {}
+        self._queue = []
+        self._sequence = 0
+        self._wakeup = None
+        self._dispatcher = None
+        self.chat_waiting = 0
+        self.sent = Counter()
+        self.throttled = 0
+        self.throttle_wait = 0.0
+        self.retry_after_hits = 0
+        self.retry_after_seconds = 0
+        self.gave_up = 0
+
+    async def initialize(self) -> None:
+        if self._dispatcher is not None and not self._dispatcher.done():
+            return
+        logger.info("[OutboundRateLimiter:Initialize] Starting outbound dispatcher")
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        logger.info("[OutboundRateLimiter:Shutdown] Stopping outbound dispatcher")
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._dispatcher
+            self._dispatcher = None
+        for _, _, future in self._queue:
+            if not future.done():
+                future.set_result(None)
+        self._queue.clear()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(RATE_LIMIT_GROUP_PER_MIN / 60, RATE_LIMIT_GROUP_PER_MIN / 60 * 3)
+            else:
+                bucket = TokenBucket(RATE_LIMIT_CHAT_PER_S, RATE_LIMIT_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+            if len(self.chat_buckets) > 10000:
+                for idle_chat in [key for key, value in self.chat_buckets.items() if value.idle]:
+                    del self.chat_buckets[idle_chat]
+        return bucket
+
+    async def _dispatch(self):
+        # Releases queued requests in priority order, one global token at a time
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            wait = self.global_bucket.reserve()
+            if wait > 0:
+                self.throttled += 1
+                self.throttle_wait += wait
+                await asyncio.sleep(wait)
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+
+    async def _wait_for_global_slot(self, priority):
+        if self._dispatcher is None:
+            await self.initialize()
+        future = asyncio.get_running_loop().create_future()
+        self._sequence += 1
+        heapq.heappush(self._queue, (priority, self._sequence, future))
+        self._wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = _outbound_priority.get()
+        if isinstance(rate_limit_args, dict) and "priority" in rate_limit_args:
+            priority = PRIORITY_BULK if rate_limit_args["priority"] in ("bulk", PRIORITY_BULK) else PRIORITY_INTERACTIVE
+        chat_id = data.get("chat_id")
+
+        for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+            if chat_id is not None and endpoint not in UNTHROTTLED_PER_CHAT_ENDPOINTS:
+                # Only bulk sends are paced per chat; a reply to the user waits only
+                # while Telegram has the chat blocked
+                bucket = self._chat_bucket(chat_id)
+                wait = bucket.reserve() if priority == PRIORITY_BULK else bucket.blocked_for()
+                if wait > 0:
+                    self.throttled += 1
+                    self.throttle_wait += wait
+                    self.chat_waiting += 1
+                    try:
+                        await asyncio.sleep(wait)
+                    finally:
+                        self.chat_waiting -= 1
+            await self._wait_for_global_slot(priority)
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent[endpoint] += 1
+                return result
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                self.retry_after_hits += 1
+                self.retry_after_seconds += retry_after
+                logger.warning(f"[OutboundRateLimiter:RetryAfter] {endpoint} for chat {chat_id} flood-limited, retrying in {retry_after}s (attempt {attempt + 1})")
+                # The retry waits in the blocked bucket: the chat's, or the global one the dispatcher holds back
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).block(retry_after)
+                else:
+                    self.global_bucket.block(retry_after)
+                if attempt == RATE_LIMIT_MAX_RETRIES:
+                    self.gave_up += 1
+                    raise
+
+    @property
+    def queue_depth(self):
+        return len(self._queue) + self.chat_waiting
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "global_queue": len(self._queue),
+            "chat_waiting": self.chat_waiting,
+            "tracked_chats": len(self.chat_buckets),
+            "sent": sum(self.sent.values()),
+            "throttled": self.throttled,
+            "throttle_wait_s": round(self.throttle_wait, 2),
+            "retry_after_hits": self.retry_after_hits,
+            "retry_after_s": self.retry_after_seconds,
+            "gave_up": self.gave_up,
+        }
+
+outbound_rate_limiter = OutboundRateLimiter()
+
+# Updates are handled concurrently so one chat waiting on its send budget doesn't
+# stall the others; each chat's own updates still run one at a time, in order
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+
+class ChatOrderedApplication(Application):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.chat_locks = {}
+
+    async def process_update(self, update):
+        # Inline queries carry no chat and are left to the inline debounce
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            return await super().process_update(update)
+        key = chat.id
+        entry = self.chat_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await super().process_update(update)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chat_locks[key]
+
+# Status message edits are coalesced to at most one per interval per message
+PROGRESS_EDIT_INTERVAL_S = float(os.getenv("PROGRESS_EDIT_INTERVAL_S", "1.0"))
+
+class ProgressReporter:
+    def __init__(self, message, text=None, interval=PROGRESS_EDIT_INTERVAL_S):
+        self.message = message
+        self.interval = interval
+        self.edits = 0
+        self.coalesced = 0
+        self._shown = (text, {})
+        self._pending = None
+        self._last_edit = 0.0
+        self._flusher = None
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    async def send(cls, reply_to, text, **kwargs):
+        message = await reply_to.reply_text(text, **kwargs)
+        return cls(message, text)
+
+    async def update(self, text, **kwargs):
+        # Returns immediately; the newest text wins when the interval elapses
+        if self._pending is not None:
+            self.coalesced += 1
+        self._pending = (text, kwargs)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def finish(self, text, **kwargs):
+        # The final state is always delivered, bypassing the interval
+        if self._flusher and not self._flusher.done():
+            self._flusher.cancel()
+        self._pending = (text, kwargs)
+        await self._flush()
+
+    async def _flush_later(self):
+        try:
+            delay = self._last_edit + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            with outbound_priority(PRIORITY_BULK):
+                await self._flush()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"[ProgressReporter:FlushError] Error editing progress message: {e}")
+
+    async def _flush(self):
+        async with self._lock:
+            if self._pending is None:
+                return
+            pending, self._pending = self._pending, None
+            if pending == self._shown:
+                logger.info("[ProgressReporter:Skip] Progress text unchanged, skipping edit")
+                return
+            text, kwargs = pending
+            try:
+                await self.message.edit_text(text, **kwargs)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+            self.edits += 1
+            self._shown = pending
+            self._last_edit = time.monotonic()
 
 # Conversation states
 (
@@ -76,6 +1037,9 @@ active_sessions = defaultdict(dict)
     SEND_PAYMENT_INSTRUCTION
 ) = range(30, 35)
 
+# Follows the location and date states 0-4
+TIME_SLOT_STATE = 5
+
 MAIN_MENU = 100
 HELP_MENU = 1000
 AFTER_START = 2000
@@ -86,22 +1050,942 @@ DROPDOWN_SEQUENCE = [
     ('select[name="martialStatus"]', "Marital Status", 3),
 ]
 
+# Portal configuration
+PORTAL_URL = "https://www.ethiopianpassportservices.gov.et"
+PAGE_TIMEOUT_MS = 120000
+BROWSER_LAUNCH_ARGS = [
+    '--no-sandbox',
+    '--disable-setuid-sandbox',
+    '--disable-dev-shm-usage',
+    '--single-process',
+    '--disable-gpu',
+    '--no-zygote',
+    '--disable-accelerated-2d-canvas',
+    '--disable-gpu-rasterization'
+]
+STATUS_NOT_FOUND_TEXT = "Data not Found. Please Make sure You have Paid the Request."
+
+# Portal network record/replay for repeatable, offline runs. With PORTAL_RECORD_DIR
+# every browser context writes a HAR-like archive of its traffic there, with personal
+# fields, labelled values on rendered pages, phone numbers, e-mail addresses and
+# cookies redacted; multipart and other binary request bodies are never written. PORTAL_REPLAY_ARCHIVE
+# (one archive or a directory of them) answers every request from the recording
+# instead of the network, each after its recorded time times PORTAL_REPLAY_TIME_SCALE
+# (1 = original timing, 0 = instant). Requests missing from the archive are aborted.
+PORTAL_RECORD_DIR = os.getenv("PORTAL_RECORD_DIR", "")
+PORTAL_REPLAY_ARCHIVE = os.getenv("PORTAL_REPLAY_ARCHIVE", "")
+PORTAL_REPLAY_TIME_SCALE = float(os.getenv("PORTAL_REPLAY_TIME_SCALE", "1"))
+REDACTED = "[redacted]"
+PII_FIELD_RE = re.compile(
+    r"(first|middle|last|full|father|mother|given|sur|applicant)_?name|^applicant|phone|mobile|e_?mail|birth|^dob$"
+    r"|(application|app|passport|request)_?(number|no)$|national_?id"
+    r"|address|house_?(number|no)|street|kebele|woreda|p_?o_?box",
+    re.IGNORECASE,
+)
+PII_TEXT_RES = [
+    re.compile(r"(?<!\d)(?:\+?251|0)[79]\d{8}(?!\d)"),
+    re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"),
+]
+# Rendered pages (the booking summary, the status result) show personal values as
+# "<h6>Full Name</h6><span>...</span>"; the text after such a label is redacted, and
+# so is the value attribute of form fields named like a personal field
+PII_LABEL_PATTERN = (
+    r"(?:(?:full|first|middle|last|given|father'?s|mother'?s|applicant'?s?)\s+)?name"
+    r"|date\s+of\s+birth|(?:place\s+of\s+)?birth(?:\s*(?:place|date|certificate(?:\s*(?:no|number))?))?"
+    r"|phone(?:\s+number)?|mobile(?:\s+number)?|e-?mail(?:\s+address)?|address|house\s*(?:no|number)|street"
+    r"|kebele|woreda|p\.?\s*o\.?\s*box|(?:application|passport|request)\s*(?:no|number)|national\s*id"
+)
+HTML_VALUE_TAGS = r"(?:</?(?:span|strong|b|p|div|td|th|dt|dd|li|h[1-6])\b[^>]*>\s*)"
+PII_HTML_LABEL_RE = re.compile(
+    r"(>\s*(?:" + PII_LABEL_PATTERN + r")\.?\s*(?::\s*" + HTML_VALUE_TAGS + r"*|" + HTML_VALUE_TAGS + r"+))([^<\s][^<]*)",
+    re.IGNORECASE,
+)
+HTML_FIELD_TAG_RE = re.compile(r"<(?:input|textarea|option)\b[^>]*>", re.IGNORECASE)
+HTML_FIELD_NAME_RE = re.compile(r"\b(?:name|id|formcontrolname)\s*=\s*[\"']([^\"']*)[\"']", re.IGNORECASE)
+HTML_VALUE_RE = re.compile(r"(\bvalue\s*=\s*)([\"'])[^\"']*\2", re.IGNORECASE)
+SECRET_HEADERS = {"cookie", "set-cookie", "authorization"}
+TEXT_MIME_MARKERS = ("json", "html", "text/plain", "x-www-form-urlencoded")
+
+def redact_json(value):
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if PII_FIELD_RE.search(key) and isinstance(item, (str, int, float)) and item != "" else redact_json(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact_json(item) for item in value]
+    return value
+
+def redact_html_field(match):
+    tag = match.group(0)
+    if any(PII_FIELD_RE.search(name) for name in HTML_FIELD_NAME_RE.findall(tag)):
+        tag = HTML_VALUE_RE.sub(lambda value: f"{value.group(1)}{value.group(2)}{REDACTED}{value.group(2)}", tag)
+    return tag
+
+def redact_text(text, mime_type=""):
+    if "json" in mime_type:
+        with contextlib.suppress(ValueError):
+            text = json.dumps(redact_json(json.loads(text)), ensure_ascii=False)
+    elif "x-www-form-urlencoded" in mime_type:
+        text = urlencode([(key, REDACTED if PII_FIELD_RE.search(key) else value) for key, value in parse_qsl(text, keep_blank_values=True)])
+    elif "html" in mime_type:
+        text = PII_HTML_LABEL_RE.sub(lambda match: match.group(1) + REDACTED, text)
+        text = HTML_FIELD_TAG_RE.sub(redact_html_field, text)
+    for pattern in PII_TEXT_RES:
+        text = pattern.sub(REDACTED, text)
+    return text
+
+def redact_url(url):
+    parts = urlsplit(url)
+    if not parts.query:
+        return url
+    return urlunsplit(parts._replace(query=redact_text(parts.query, "x-www-form-urlencoded")))
+
+def har_headers(headers):
+    return [{"name": name, "value": REDACTED if name.lower() in SECRET_HEADERS else value} for name, value in headers.items()]
+
+def har_entry(request, response, body):
+    timing = request.timing or {}
+    mime_type = response.headers.get("content-type", "")
+    content = {"size": len(body), "mimeType": mime_type}
+    if any(marker in mime_type for marker in TEXT_MIME_MARKERS):
+        content["text"] = redact_text(body.decode("utf-8", "replace"), mime_type)
+    else:
+        content["text"], content["encoding"] = base64.b64encode(body).decode("ascii"), "base64"
+    request_entry = {"method": request.method, "url": redact_url(request.url), "headers": har_headers(request.headers)}
+    post_body = request.post_data_buffer
+    if post_body:
+        post_mime = request.headers.get("content-type", "")
+        if any(marker in post_mime for marker in TEXT_MIME_MARKERS):
+            request_entry["postData"] = {"mimeType": post_mime, "text": redact_text(post_body.decode("utf-8", "replace"), post_mime)}
+        else:
+            # Multipart uploads carry form fields and ID scans; only their size and hash are kept
+            request_entry["postData"] = {"mimeType": post_mime, "text": "", "_size": len(post_body), "_sha256": hashlib.sha256(post_body).hexdigest()}
+    started_ms = timing.get("startTime") or time.time() * 1000
+    return {
+        "startedDateTime": datetime.fromtimestamp(started_ms / 1000, timezone.utc).isoformat().replace("+00:00", "Z"),
+        "time": max(0.0, timing.get("responseEnd", 0.0)),
+        "_resourceType": request.resource_type,
+        "request": request_entry,
+        "response": {
+            "status": response.status,
+            "statusText": response.status_text,
+            "headers": har_headers(response.headers),
+            "content": content,
+        },
+    }
+
+def write_network_archive(path, entries):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as archive_file:
+        json.dump({"log": {"version": "1.2", "creator": {"name": "passport-bot", "version": "1"}, "entries": entries}}, archive_file)
+
+def load_network_archive(path):
+    # A directory merges all of its archives into one timeline
+    paths = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".har")) if os.path.isdir(path) else [path]
+    entries = []
+    for archive_path in paths:
+        with open(archive_path, encoding="utf-8") as archive_file:
+            entries.extend(json.load(archive_file)["log"]["entries"])
+    entries.sort(key=lambda entry: entry["startedDateTime"])
+    for entry in entries:
+        content = entry["response"]["content"]
+        text = content.get("text", "")
+        entry["_body"] = base64.b64decode(text) if content.get("encoding") == "base64" else text.encode("utf-8")
+    return entries
+
+class NetworkRecorder:
+    # Saved by close_portal_context/close_browser while the context is still open,
+    # since response bodies can no longer be read once it is closed
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        self.pending = set()
+
+    def attach(self, browser_context):
+        browser_context.on("requestfinished", self._on_request_finished)
+
+    def _on_request_finished(self, request):
+        task = asyncio.create_task(self._record(request))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def _record(self, request):
+        response = await request.response()
+        if response is None:
+            return
+        try:
+            body = await response.body()
+        except Exception:
+            # Redirects and bodies the browser already discarded
+            body = b""
+        self.entries.append(har_entry(request, response, body))
+        network_counters["recorded"] += 1
+
+    async def save(self):
+        if self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+        if self.entries:
+            logger.info(f"[NetworkRecorder:Save] Writing {len(self.entries)} requests to {self.path}")
+            await blocking_executor.run("network_archive", write_network_archive, self.path, self.entries)
+            network_counters["archives_written"] += 1
+
+class NetworkReplay:
+    # One per browser context, so every context walks the recording from the start
+    def __init__(self, entries, time_scale):
+        self.time_scale = time_scale
+        self.by_url = defaultdict(list)
+        self.by_path = defaultdict(list)
+        for entry in entries:
+            method, url = entry["request"]["method"], entry["request"]["url"]
+            self.by_url[(method, url)].append(entry)
+            self.by_path[(method, urlsplit(url).path)].append(entry)
+        self.cursors = Counter()
+
+    def match(self, method, url):
+        # Exact URL first, then the same path with other query values; repeated
+        # requests get the recorded responses in order and then the last one again
+        for key, recorded in (((method, redact_url(url)), self.by_url), ((method, urlsplit(url).path), self.by_path)):
+            entries = recorded.get(key)
+            if entries:
+                entry = entries[min(self.cursors[key], len(entries) - 1)]
+                self.cursors[key] += 1
+                return entry
+        return None
+
+    async def handle(self, route):
+        request = route.request
+        entry = self.match(request.method, request.url)
+        if entry is None:
+            network_counters["replay_missed"] += 1
+            await route.abort("internetdisconnected")
+            return
+        if self.time_scale:
+            await asyncio.sleep(entry["time"] * self.time_scale / 1000)
+        response = entry["response"]
+        await route.fulfill(
+            status=response["status"],
+            headers={header["name"]: header["value"] for header in response["headers"]
+                     if header["value"] != REDACTED and header["name"].lower() != "content-length"},
+            body=entry["_body"],
+        )
+        network_counters["replayed"] += 1
+
+network_counters = Counter()
+network_recorders = defaultdict(list)
+_replay_entries = None
+
+async def new_portal_context(browser):
+    global _replay_entries
+    browser_context = await browser.new_context()
+    if PORTAL_REPLAY_ARCHIVE:
+        if _replay_entries is None:
+            _replay_entries = await blocking_executor.run("network_archive", load_network_archive, PORTAL_REPLAY_ARCHIVE)
+        await browser_context.route("**/*", NetworkReplay(_replay_entries, PORTAL_REPLAY_TIME_SCALE).handle)
+    elif PORTAL_RECORD_DIR:
+        name = f"{datetime.now():%Y%m%d-%H%M%S}-{secrets.token_hex(3)}.har"
+        recorder = NetworkRecorder(os.path.join(PORTAL_RECORD_DIR, name))
+        recorder.attach(browser_context)
+        network_recorders[browser].append((browser_context, recorder))
+    return browser_context
+
+async def save_recordings(browser, browser_context=None):
+    recordings = network_recorders.get(browser, [])
+    for entry in [entry for entry in recordings if browser_context in (None, entry[0])]:
+        recordings.remove(entry)
+        try:
+            await entry[1].save()
+        except Exception as e:
+            logger.error(f"[save_recordings:Error] Could not write {entry[1].path}: {str(e)}")
+    if not recordings:
+        network_recorders.pop(browser, None)
+
+async def close_portal_context(browser, browser_context):
+    await save_recordings(browser, browser_context)
+    await browser_context.close()
+
+async def close_browser(browser):
+    await save_recordings(browser)
+    await browser.close()
+
+# Adaptive portal timeouts. Each wait is named; its deadline is the observed
+# percentile latency for that operation times a multiplier plus a margin, clamped
+# to [floor, ceiling]. Until enough samples exist the previous fixed value is used.
+# A wait that times out is recorded at its deadline, so a slow spell raises the
+# next deadline instead of failing every user at the same point.
+PORTAL_TIMEOUT_FLOOR_MS = int(os.getenv("PORTAL_TIMEOUT_FLOOR_MS", "5000"))
+PORTAL_TIMEOUT_CEILING_MS = int(os.getenv("PORTAL_TIMEOUT_CEILING_MS", str(PAGE_TIMEOUT_MS)))
+PORTAL_TIMEOUT_PERCENTILE = float(os.getenv("PORTAL_TIMEOUT_PERCENTILE", "99"))
+PORTAL_TIMEOUT_MULTIPLIER = float(os.getenv("PORTAL_TIMEOUT_MULTIPLIER", "1.5"))
+PORTAL_TIMEOUT_MARGIN_MS = int(os.getenv("PORTAL_TIMEOUT_MARGIN_MS", "3000"))
+PORTAL_TIMEOUT_WINDOW = int(os.getenv("PORTAL_TIMEOUT_WINDOW", "200"))
+PORTAL_TIMEOUT_MIN_SAMPLES = int(os.getenv("PORTAL_TIMEOUT_MIN_SAMPLES", "20"))
+PORTAL_TIMEOUT_DEFAULTS_MS = {
+    "navigation": PAGE_TIMEOUT_MS,
+    "action": PAGE_TIMEOUT_MS,
+    "network_idle": PAGE_TIMEOUT_MS,
+    "options": PAGE_TIMEOUT_MS,
+    "start_checkbox": 60000,
+    "booking_card": 60000,
+    "region_select": 50000,
+    "status_input": 30000,
+    "status_result": PAGE_TIMEOUT_MS,
+}
+
+class TimeoutPolicy:
+    def __init__(self, defaults, floor_ms, ceiling_ms, percentile, multiplier, margin_ms, window, min_samples):
+        self.defaults = defaults
+        self.floor_ms = floor_ms
+        self.ceiling_ms = ceiling_ms
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.margin_ms = margin_ms
+        self.min_samples = min_samples
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self.timeouts = Counter()
+
+    def _percentile_ms(self, operation, pct):
+        ordered = sorted(self._samples[operation])
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+    def timeout_ms(self, operation):
+        if len(self._samples[operation]) < self.min_samples:
+            return self.defaults.get(operation, self.ceiling_ms)
+        observed = self._percentile_ms(operation, self.percentile)
+        deadline = observed * self.multiplier + self.margin_ms
+        return int(min(self.ceiling_ms, max(self.floor_ms, deadline)))
+
+    def observe(self, operation, elapsed_ms):
+        self._samples[operation].append(elapsed_ms)
+        if operation != "navigation":
+            # Page-wide default for waits that are not individually named
+            self._samples["action"].append(elapsed_ms)
+
+    @contextlib.contextmanager
+    def deadline(self, operation):
+        timeout = self.timeout_ms(operation)
+        started = time.perf_counter()
+        try:
+            yield timeout
+        except Exception as e:
+            if not is_playwright_timeout(e):
+                raise
+            self.timeouts[operation] += 1
+            logger.error(f"[TimeoutPolicy:Timeout] {operation} exceeded {timeout}ms")
+            self.observe(operation, timeout)
+            raise
+        self.observe(operation, (time.perf_counter() - started) * 1000)
+
+    def apply(self, page):
+        page.set_default_timeout(self.timeout_ms("action"))
+        page.set_default_navigation_timeout(self.timeout_ms("navigation"))
+
+    def stats(self):
+        stats = {}
+        for operation in sorted(set(self.defaults) | set(self._samples)):
+            samples = self._samples.get(operation)
+            stats[operation] = {
+                "timeout_ms": self.timeout_ms(operation),
+                "samples": len(samples) if samples else 0,
+                "p50_ms": round(self._percentile_ms(operation, 50)) if samples else None,
+                "p99_ms": round(self._percentile_ms(operation, 99)) if samples else None,
+                "timeouts": self.timeouts[operation],
+            }
+        return stats
+
+timeout_policy = TimeoutPolicy(
+    PORTAL_TIMEOUT_DEFAULTS_MS, PORTAL_TIMEOUT_FLOOR_MS, PORTAL_TIMEOUT_CEILING_MS, PORTAL_TIMEOUT_PERCENTILE,
+    PORTAL_TIMEOUT_MULTIPLIER, PORTAL_TIMEOUT_MARGIN_MS, PORTAL_TIMEOUT_WINDOW, PORTAL_TIMEOUT_MIN_SAMPLES
+)
+
+# Portal health. A background prober and real portal navigations feed a circuit
+# breaker; while it is open, entry points answer at once instead of launching a
+# browser against a site that is down. After BREAKER_OPEN_S one half-open trial
+# (a probe or a user request) decides whether it closes again.
+PORTAL_PROBE_URL = os.getenv("PORTAL_PROBE_URL", PORTAL_URL)
+# Replayed runs are offline, so probing is off unless asked for
+PORTAL_PROBE_INTERVAL_S = float(os.getenv("PORTAL_PROBE_INTERVAL_S", "0" if PORTAL_REPLAY_ARCHIVE else "30"))
+PORTAL_PROBE_TIMEOUT_S = float(os.getenv("PORTAL_PROBE_TIMEOUT_S", "10"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_OPEN_S = float(os.getenv("BREAKER_OPEN_S", "60"))
+BREAKER_TRIAL_TIMEOUT_S = float(os.getenv("BREAKER_TRIAL_TIMEOUT_S", "180"))
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold, open_s, trial_timeout_s):
+        self.failure_threshold = failure_threshold
+        self.open_s = open_s
+        self.trial_timeout_s = trial_timeout_s
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_started = None
+        self.rejected = 0
+        self.opened = 0
+        self.last_failure = None
+        self.last_latency_ms = None
+
+    def allow(self):
+        now = time.monotonic()
+        if self.state == self.OPEN and now - self.opened_at >= self.open_s:
+            logger.info("[CircuitBreaker:HalfOpen] Cool-down elapsed, allowing a trial request")
+            self.state = self.HALF_OPEN
+            self.trial_started = None
+        if self.state == self.HALF_OPEN:
+            # A trial that never reported back is treated as abandoned
+            if self.trial_started is None or now - self.trial_started >= self.trial_timeout_s:
+                self.trial_started = now
+                return True
+        if self.state == self.CLOSED:
+            return True
+        self.rejected += 1
+        return False
+
+    def would_allow(self):
+        # allow() without taking the trial or counting a rejection
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            return now - self.opened_at >= self.open_s
+        if self.state == self.HALF_OPEN:
+            return self.trial_started is None or now - self.trial_started >= self.trial_timeout_s
+        return True
+
+    def retry_after(self):
+        if self.state != self.OPEN:
+            return 0
+        return max(0, self.open_s - (time.monotonic() - self.opened_at))
+
+    def record_success(self, latency_s=None):
+        if latency_s is not None:
+            self.last_latency_ms = round(latency_s * 1000)
+        if self.state != self.CLOSED:
+            logger.info("[CircuitBreaker:Closed] Portal recovered, closing breaker")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.trial_started = None
+
+    def record_failure(self, reason):
+        self.consecutive_failures += 1
+        self.last_failure = reason
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.error(f"[CircuitBreaker:Open] Opening breaker after {self.consecutive_failures} failures: {reason}")
+                self.opened += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.trial_started = None
+
+    def unavailable_text(self):
+        minutes = max(1, round(self.retry_after() / 60))
+        return (
+            "⚠️ The passport service website is not responding right now. "
+            f"Please try again in about {minutes} minute{'s' if minutes > 1 else ''}."
+        )
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "retry_after_s": round(self.retry_after(), 1),
+            "last_latency_ms": self.last_latency_ms,
+            "last_failure": self.last_failure,
+        }
+
+portal_breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_OPEN_S, BREAKER_TRIAL_TIMEOUT_S)
+
+class PortalHealthProber:
+    def __init__(self, breaker, url, interval, timeout):
+        self.breaker = breaker
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.probes = 0
+        self.failures = 0
+        self._task = None
+
+    async def probe(self, client):
+        self.probes += 1
+        started = time.perf_counter()
+        try:
+            response = await client.get(self.url)
+            latency = time.perf_counter() - started
+            if response.status_code >= 500 or "service unavailable" in response.text[:4096].lower():
+                raise httpx.HTTPStatusError(f"portal answered {response.status_code}", request=response.request, response=response)
+        except httpx.HTTPError as e:
+            self.failures += 1
+            logger.error(f"[PortalHealthProber:Failure] {str(e) or type(e).__name__}")
+            self.breaker.record_failure(f"probe: {str(e) or type(e).__name__}")
+            return
+        self.breaker.record_success(latency)
+
+    async def _run(self, delay):
+        await asyncio.sleep(delay)
+        async with httpx.AsyncClient(timeout=self.timeout, follow_redirects=True) as client:
+            while True:
+                if self.breaker.would_allow() and self.breaker.allow():
+                    await self.probe(client)
+                delay = self.interval
+                if self.breaker.state == CircuitBreaker.OPEN:
+                    delay = min(delay, max(1.0, self.breaker.retry_after()))
+                await asyncio.sleep(delay)
+
+    def start(self, delay=0.0):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run(delay))
+
+    def stats(self):
+        return {"probes": self.probes, "failures": self.failures, "interval_s": self.interval}
+
+portal_prober = PortalHealthProber(portal_breaker, PORTAL_PROBE_URL, PORTAL_PROBE_INTERVAL_S, PORTAL_PROBE_TIMEOUT_S)
+
+# Bounded retries. Every retried portal operation has a budget of attempts and an
+# exponential backoff with jitter; only transient errors are retried, and nothing
+# is retried while the portal breaker is open. Budgets that span several updates
+# (no time slots, re-opening the booking form) are counted per conversation.
+# Override with RETRY_BUDGET_<NAME>="attempts,base_delay_s,max_delay_s".
+RETRY_BUDGET_DEFAULTS = {
+    "options": (10, 0.25, 1.0),
+    "calendar_months": (12, 1.0, 1.0),
+    "time_slots": (3, 0.0, 0.0),
+    "booking_form": (3, 2.0, 10.0),
+    "summary": (3, 1.0, 8.0),
+    "status": (2, 1.0, 5.0),
+}
+RETRYABLE_ERROR_MARKERS = ("net::ERR_", "Navigation failed", "Timeout")
+
+class RetryBudget:
+    def __init__(self, attempts, base_delay_s, max_delay_s):
+        self.attempts = attempts
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+
+    def delay(self, attempt):
+        delay = min(self.max_delay_s, self.base_delay_s * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+def load_retry_budgets():
+    budgets = {}
+    for name, default in RETRY_BUDGET_DEFAULTS.items():
+        override = os.getenv(f"RETRY_BUDGET_{name.upper()}")
+        attempts, base_delay_s, max_delay_s = override.split(",") if override else default
+        budgets[name] = RetryBudget(int(attempts), float(base_delay_s), float(max_delay_s))
+    return budgets
+
+class RetryExhausted(Exception):
+    def __init__(self, operation, attempts, last_error=None):
+        super().__init__(f"{operation} gave up after {attempts} attempts: {last_error or 'no result'}")
+        self.operation = operation
+        self.attempts = attempts
+        self.last_error = last_error
+
+def is_retryable(error):
+    if is_playwright_timeout(error) or isinstance(error, (asyncio.TimeoutError, httpx.TransportError, ConnectionError)):
+        return True
+    return any(marker in str(error) for marker in RETRYABLE_ERROR_MARKERS)
+
+class RetryEngine:
+    def __init__(self, budgets, breaker):
+        self.budgets = budgets
+        self.breaker = breaker
+        self.attempts = Counter()
+        self.retries = Counter()
+        self.exhausted = Counter()
+        self.not_retryable = Counter()
+
+    async def run(self, operation, func, *args, retry_if=None, **kwargs):
+        budget = self.budgets[operation]
+        last_error = None
+        for attempt in range(1, budget.attempts + 1):
+            self.attempts[operation] += 1
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    self.not_retryable[operation] += 1
+                    raise
+                last_error = e
+            else:
+                if retry_if is None or not retry_if(result):
+                    return result
+                last_error = None
+            if attempt == budget.attempts or self.breaker.state == CircuitBreaker.OPEN:
+                break
+            delay = budget.delay(attempt)
+            logger.info(f"[RetryEngine:Retry] {operation} attempt {attempt}/{budget.attempts} failed, retrying in {delay:.2f}s")
+            self.retries[operation] += 1
+            await asyncio.sleep(delay)
+        self.exhausted[operation] += 1
+        logger.error(f"[RetryEngine:Exhausted] {operation} exhausted after {attempt} attempts: {last_error}")
+        raise RetryExhausted(operation, attempt, last_error)
+
+    def consume(self, user_data, operation):
+        # For retries that wait on the user (a new date, another tap) rather than a loop
+        used = user_data.setdefault("retry_budgets", {})
+        used[operation] = used.get(operation, 0) + 1
+        self.attempts[operation] += 1
+        if used[operation] >= self.budgets[operation].attempts:
+            self.exhausted[operation] += 1
+            return False
+        self.retries[operation] += 1
+        return True
+
+    def reset(self, user_data, *operations):
+        used = user_data.get("retry_budgets", {})
+        for operation in operations or list(used):
+            used.pop(operation, None)
+
+    def stats(self):
+        return {
+            operation: {
+                "attempts": self.attempts[operation],
+                "retries": self.retries[operation],
+                "exhausted": self.exhausted[operation],
+                "not_retryable": self.not_retryable[operation],
+            }
+            for operation in self.budgets
+            if self.attempts[operation]
+        }
+
+retry_engine = RetryEngine(load_retry_budgets(), portal_breaker)
+
 # Pagination configuration
 OCCUPATION_PAGE_SIZE = 8
 PAGINATION_PREFIX = "page_"
+KEYBOARD_PAGE_ROWS = int(os.getenv("KEYBOARD_PAGE_ROWS", str(OCCUPATION_PAGE_SIZE)))
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "256"))
+
+class SerializedKeyboardMarkup(InlineKeyboardMarkup):
+    # Serialized once when built; every send and page flip reuses the same dict
+    def __init__(self, inline_keyboard):
+        super().__init__(inline_keyboard)
+        self._serialized = super().to_dict()
+
+    def to_dict(self, recursive: bool = True):
+        return self._serialized
+
+class KeyboardCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._pages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def pages(self, kind, buttons, columns=1, page_rows=None):
+        # The option list itself is the version: a changed list is a new entry
+        page_rows = page_rows or KEYBOARD_PAGE_ROWS
+        key = (kind, columns, page_rows, tuple(buttons))
+        pages = self._pages.get(key)
+        if pages is not None:
+            self.hits += 1
+            self._pages.move_to_end(key)
+            return pages
+        self.misses += 1
+        pages = self._build(kind, key[3], columns, page_rows)
+        self._pages[key] = pages
+        if len(self._pages) > self.max_entries:
+            self._pages.popitem(last=False)
+        return pages
+
+    def _build(self, kind, buttons, columns, page_rows):
+        rows = [
+            [InlineKeyboardButton(text, callback_data=data) for text, data in buttons[i:i + columns]]
+            for i in range(0, len(buttons), columns)
+        ]
+        chunks = [rows[i:i + page_rows] for i in range(0, len(rows), page_rows)] or [[]]
+        pages = []
+        for number, chunk in enumerate(chunks):
+            if len(chunks) > 1:
+                nav = []
+                if number > 0:
+                    nav.append(InlineKeyboardButton("◀️ Prev", callback_data=f"{PAGINATION_PREFIX}{kind}_{number - 1}"))
+                nav.append(InlineKeyboardButton(f"{number + 1}/{len(chunks)}", callback_data=f"{PAGINATION_PREFIX}{kind}_{number}"))
+                if number < len(chunks) - 1:
+                    nav.append(InlineKeyboardButton("Next ▶️", callback_data=f"{PAGINATION_PREFIX}{kind}_{number + 1}"))
+                chunk = chunk + [nav]
+            pages.append(SerializedKeyboardMarkup(chunk))
+        return pages
+
+    def stats(self):
+        return {"entries": len(self._pages), "hits": self.hits, "misses": self.misses}
+
+keyboard_cache = KeyboardCache(KEYBOARD_CACHE_SIZE)
+
+def paginated_keyboard(context, kind, buttons, columns=1):
+    # Remembers the list so page flips can be answered without touching the browser
+    buttons = tuple(buttons)
+    context.user_data.setdefault("keyboards", {})[kind] = (buttons, columns)
+    return keyboard_cache.pages(kind, buttons, columns)[0]
+
+async def handle_page_flip(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("[handle_page_flip:Start] Entering handle_page_flip function")
+    query = update.callback_query
+    kind, _, number = query.data[len(PAGINATION_PREFIX):].rpartition("_")
+    keyboard = context.user_data.get("keyboards", {}).get(kind)
+    if keyboard is None:
+        logger.error(f"[handle_page_flip:Unknown] No keyboard stored for {kind}")
+        await query.answer("This list has expired.")
+        return None
+    # A keyboard restored from the resume file comes back as JSON lists
+    buttons, columns = keyboard
+    pages = keyboard_cache.pages(kind, tuple(map(tuple, buttons)), columns)
+    number = min(int(number), len(pages) - 1)
+    await query.answer()
+    if query.message.reply_markup is not None and query.message.reply_markup.to_dict() == pages[number].to_dict():
+        logger.info("[handle_page_flip:SamePage] Page already shown")
+        return None
+    logger.info(f"[handle_page_flip:Edit] Showing page {number + 1}/{len(pages)} of {kind}")
+    try:
+        await query.edit_message_reply_markup(reply_markup=pages[number])
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    return None
+
+# Valid options of the n-th location select (city, office, branch)
+SELECT_OPTIONS_JS = """
+    (index) => {
+        const select = document.querySelectorAll("select.form-control")[index];
+        return Array.from(select.options)
+            .filter(opt => {
+                const txt = opt.textContent.trim().toLowerCase();
+                return opt.value && txt !== "" && !txt.includes("select") && !txt.includes("--");
+            })
+            .map(opt => [opt.value, opt.textContent.trim()]);
+    }
+"""
+
+# Booking page actions, shared by the conversation handlers and checkpoint replay.
+# Each completed step appends [step, payload] to user_data["checkpoints"]; payloads
+# hold only JSON values so the log never references objects from a lost page.
+# checkpoint_seq only ever grows, so a recovery can tell the log moved under it.
+def checkpoint(user_data, step, **payload):
+    user_data.setdefault("checkpoints", []).append([step, payload])
+    user_data["checkpoint_seq"] = user_data.get("checkpoint_seq", 0) + 1
+
+async def open_booking_form(page):
+    logger.info("[open_booking_form:WaitLoad] Waiting for page to load")
+    with timeout_policy.deadline("network_idle") as timeout:
+        await page.wait_for_load_state('networkidle', timeout=timeout)
+    logger.info("[open_booking_form:WaitSelector] Waiting for teal card selector")
+    with timeout_policy.deadline("booking_card") as timeout:
+        await page.wait_for_selector(".card--teal.flex.flex--column", state='visible', timeout=timeout)
+    logger.info("[open_booking_form:ClickCard] Clicking teal card")
+    await page.evaluate('''() => {
+        document.querySelector('.card--teal.flex.flex--column').click();
+    }''')
+
+async def select_location_option(page, index, value):
+    await page.locator("select.form-control").nth(index).select_option(value=value)
+    if index == 0:
+        logger.info("[select_location_option:TriggerChange] Triggering change event on region select")
+        await page.evaluate(
+            """() => {
+                const select = document.querySelectorAll("select.form-control")[0];
+                select.dispatchEvent(new Event('change', { bubbles: true }));
+            }"""
+        )
+
+async def open_calendar(page):
+    await page.get_by_role("button", name="Next").click()
+    logger.info("[open_calendar:Wait] Waiting for page to process")
+    await page.wait_for_timeout(3000)
+
+async def click_calendar_day(page, label):
+    # Day buttons are found again by their aria-label, moving forward month by month
+    day = page.locator(f'div.react-calendar__month-view__days button:not([disabled]):has(abbr[aria-label="{label}"])')
+    for _ in range(retry_engine.budgets["calendar_months"].attempts):
+        if await day.count():
+            await day.first.click()
+            return
+        logger.info(f"[click_calendar_day:NextMonth] {label} not shown, clicking next month button")
+        await page.locator("button.react-calendar__navigation__next-button").click()
+    raise LookupError(f"date {label} is no longer offered")
+
+# Time slots. One evaluate reads both session tables: every bookable slot with its
+# time, session and remaining capacity when the portal shows one. Inventories are
+# cached per branch and date for SLOT_CACHE_TTL_S. A chosen slot is found again by
+# table and time on the current page, so nothing from an earlier page is kept.
+SLOT_CACHE_TTL_S = float(os.getenv("SLOT_CACHE_TTL_S", "20"))
+SLOT_CACHE_SIZE = int(os.getenv("SLOT_CACHE_SIZE", "256"))
+SLOT_TABLES = [["displayMorningAppts", "Morning"], ["displayAfternoonAppts", "Afternoon"]]
+SLOT_INVENTORY_JS = r"""
+    (tables) => tables.flatMap(([table, session]) =>
+        Array.from(document.querySelectorAll(`table#${table} input.btn_select`)).map((button, index) => {
+            if (button.disabled) {
+                return null;
+            }
+            const row = button.closest("tr");
+            const cells = row ? Array.from(row.cells).map(cell => cell.textContent.trim()).filter(Boolean) : [];
+            const time = cells.find(text => /\d{1,2}:\d{2}/.test(text)) || "";
+            const capacity = cells
+                .filter(text => text !== time)
+                .map(text => text.match(/^(?:\D*:\s*)?(\d+)\s*(?:slots?|seats?|left|remaining|available)?$/i))
+                .find(Boolean);
+            return {table, session, index, time, capacity: capacity ? Number(capacity[1]) : null};
+        }).filter(Boolean)
+    )
+"""
+
+# Position of the slot's button now: its old position when that row's time cell still
+# reads exactly the same, else the first enabled row whose time cell does, else -1.
+# Whole-cell comparison, so "2:30" never matches a "12:30" row.
+SLOT_FIND_JS = """
+    ([table, time, index]) => {
+        const buttons = Array.from(document.querySelectorAll(`table#${table} input.btn_select`));
+        const matches = button => {
+            const row = button.closest("tr");
+            return !button.disabled && row && Array.from(row.cells).some(cell => cell.textContent.trim() === time);
+        };
+        return buttons[index] && matches(buttons[index]) ? index : buttons.findIndex(matches);
+    }
+"""
+
+class SlotInventoryCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def store(self, key, slots):
+        self._entries[key] = (time.monotonic() + self.ttl, slots)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        if self._entries.pop(key, None) is not None:
+            self.invalidated += 1
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "invalidated": self.invalidated}
+
+slot_cache = SlotInventoryCache(SLOT_CACHE_TTL_S, SLOT_CACHE_SIZE)
+
+def slot_cache_key(user_data):
+    return user_data.get("selected_branch"), user_data.get("selected_date")
+
+def slot_label(slot):
+    name = slot["time"] or f"{slot['session']} slot {slot['index'] + 1}"
+    label = f"{'🌅' if slot['session'] == 'Morning' else '🌇'} {name}"
+    if slot["capacity"] is not None:
+        label += f" · {slot['capacity']} left"
+    return label
+
+async def read_slot_inventory(page, key):
+    slots = slot_cache.get(key)
+    if slots is None:
+        slots = await page.evaluate(SLOT_INVENTORY_JS, SLOT_TABLES)
+        slot_cache.store(key, slots)
+    return slots
+
+async def click_time_slot(page, slot):
+    # The table renders a moment after the day click; locator counts do not wait for it
+    try:
+        with timeout_policy.deadline("options") as timeout:
+            await page.wait_for_selector(f"table#{slot['table']} input.btn_select", state="attached", timeout=timeout)
+    except Exception as e:
+        if not is_playwright_timeout(e):
+            raise
+        raise LookupError(f"time slot {slot.get('time') or slot['index']} is no longer offered") from e
+    # Checkpoints from before times were read carry only table and index
+    if slot.get("time"):
+        index = await page.evaluate(SLOT_FIND_JS, [slot["table"], slot["time"], slot["index"]])
+    else:
+        index = slot["index"]
+    button = page.locator(f"table#{slot['table']} input.btn_select").nth(index)
+    if index < 0 or not await button.count():
+        raise LookupError(f"time slot {slot.get('time') or slot['index']} is no longer offered")
+    await button.click()
+
+async def submit_time_slot(page):
+    await page.get_by_role("button", name="Next").click()
+    logger.info("[submit_time_slot:Wait] Waiting for page to process")
+    await page.wait_for_timeout(1000)
+
+async def fill_personal_form(page, user_data):
+    logger.info("[fill_personal_form:FillFirstName] Filling first name")
+    await page.fill('input[name="firstName"]', user_data["first_name"])
+    logger.info("[fill_personal_form:FillMiddleName] Filling middle name")
+    await page.fill('input[name="middleName"]', user_data["middle_name"])
+    logger.info("[fill_personal_form:FillLastName] Filling last name")
+    await page.fill('input[name="lastName"]', user_data["last_name"])
+    logger.info("[fill_personal_form:ClearDOB] Clearing date of birth field")
+    await page.fill('#date-picker-dialog', '')
+    logger.info("[fill_personal_form:TypeDOB] Typing date of birth")
+    await page.type('#date-picker-dialog', user_data["dob"])
+    logger.info("[fill_personal_form:FillGezFirstName] Filling Amharic first name")
+    await page.fill('input[name="geezFirstName"]', user_data["amharic_first_name"])
+    logger.info("[fill_personal_form:FillGezMiddleName] Filling Amharic middle name")
+    await page.fill('input[name="geezMiddleName"]', user_data["amharic_middle_name"])
+    logger.info("[fill_personal_form:FillGezLastName] Filling Amharic last name")
+    await page.fill('input[name="geezLastName"]', user_data["amharic_last_name"])
+    logger.info("[fill_personal_form:SelectNationality] Selecting nationality")
+    await page.select_option('select[name="nationalityId"]', "ETHIOPIA")   
+    logger.info("[fill_personal_form:FillPhone] Filling phone number")
+    await page.fill('input[name="phoneNumber"]', user_data["phone_number"])
+    logger.info("[fill_personal_form:FillBirthPlace] Filling birth place")
+    await page.fill('input[name="birthPlace"]', user_data["birth_place"])
+
+async def submit_personal_form(page, user_data):
+    await page.get_by_role("button", name="Next").click()
+    logger.info("[submit_personal_form:WaitForRegion] Waiting for region select")
+    with timeout_policy.deadline("region_select") as timeout:
+        await page.wait_for_selector('select[name="region"]', timeout=timeout)
+    logger.info("[submit_personal_form:SelectRegion] Selecting region")
+    await page.locator("select[name='region']").select_option(value=user_data["selected_region"])
+
+async def submit_address_form(page, user_data):
+    logger.info("[submit_address_form:FillCity] Filling city")
+    await page.fill('input[name="city"]', user_data["selected_city"])
+    logger.info("[submit_address_form:ClickNext1] Clicking first Next button")
+    await page.get_by_role("button", name="Next").click()
+    logger.info("[submit_address_form:ClickNext2] Clicking second Next button")
+    await page.get_by_role("button", name="Next").click()
+    logger.info("[submit_address_form:ClickSubmit] Clicking Submit button")
+    await page.get_by_role("button", name="Submit").click()
+
+async def upload_documents(page, uploads, user_data):
+    logger.info("[upload_documents:UploadID] Uploading ID document")
+    await page.set_input_files('input[name="input-0"]', uploads[user_data["id_doc"]])
+    logger.info("[upload_documents:UploadBirthCert] Uploading birth certificate")
+    await page.set_input_files('input[name="input-1"]', uploads[user_data["birth_cert"]])
+    logger.info("[upload_documents:ClickUpload] Clicking Upload button")
+    await page.get_by_role("button", name="Upload").click()
+    logger.info("[upload_documents:ClickCheckbox] Clicking defaultUnchecked checkbox")
+    await page.click('label[for="defaultUnchecked"]')
+    logger.info("[upload_documents:ClickNext] Clicking Next button")
+    await page.get_by_role("button", name="Next").click()
 
 async def ask_region(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[ask_region:Start] Entering ask_region function")
     message = update.message or update.callback_query.message
     chat_id = message.chat.id
     logger.info(f"[ask_region:GetPage] Retrieving page for chat_id {chat_id}")
-    page = active_sessions[chat_id]['page']
+    page = session_registry.page(chat_id)
     logger.info("[ask_region:ReplyText] Sending region selection prompt")
     await message.reply_text("Please select your region.")
     logger.info("[ask_region:LocateSelect] Locating region select element")
     select_locator = page.locator("select.form-control").nth(0)
     logger.info("[ask_region:WaitForSelect] Waiting for select element to be visible")
-    await select_locator.wait_for()
+    with timeout_policy.deadline("options") as timeout:
+        await select_locator.wait_for(timeout=timeout)
     logger.info("[ask_region:GetOptions] Retrieving options from select element")
     options = await select_locator.locator('option').all()
     valid_options = []
@@ -118,22 +2002,11 @@ async def ask_region(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data["region_options"] = valid_options
 
     logger.info("[ask_region:CreateKeyboard] Creating inline keyboard for regions")
-    keyboard = []
-    for i in range(0, len(valid_options), 3):
-        row = []
-        if i < len(valid_options):
-            value, text = valid_options[i]
-            row.append(InlineKeyboardButton(text, callback_data=f"region_{value}"))
-        if i + 1 < len(valid_options):
-            value, text = valid_options[i + 1]
-            row.append(InlineKeyboardButton(text, callback_data=f"region_{value}"))
-        if i + 2 < len(valid_options):
-            value, text = valid_options[i + 2]
-            row.append(InlineKeyboardButton(text, callback_data=f"region_{value}"))
-        keyboard.append(row)
+    reply_markup = paginated_keyboard(
+        context, "region", ((text, f"region_{value}") for value, text in valid_options), columns=3
+    )
 
     logger.info("[ask_region:SendKeyboard] Sending region selection keyboard")
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await message.reply_text("Please select a Region:", reply_markup=reply_markup)
     logger.info("[ask_region:Return] Returning state 0")
     return 0
@@ -149,16 +2022,8 @@ async def ask_region_response(update: Update, context: ContextTypes.DEFAULT_TYPE
     logger.info("[ask_region_response:GetSelectedValue] Extracting selected region value")
     selected_value = query.data.replace("region_", "")
     logger.info(f"[ask_region_response:SelectOption] Selecting option {selected_value} on page")
-    region_select = active_sessions[chat_id]['page'].locator("select.form-control").nth(0)
-    await region_select.select_option(value=selected_value)
-    
-    logger.info("[ask_region_response:TriggerChange] Triggering change event on region select")
-    await active_sessions[chat_id]['page'].evaluate(
-        """() => {
-            const select = document.querySelectorAll("select.form-control")[0];
-            select.dispatchEvent(new Event('change', { bubbles: true }));
-        }"""
-    )
+    await select_location_option(session_registry.page(chat_id), 0, selected_value)
+    checkpoint(context.user_data, "location", index=0, value=selected_value)
     logger.info("[ask_region_response:GetRegionName] Retrieving region name")
     region_name = next((text for value, text in context.user_data["region_options"] if value == selected_value), "Unknown")
 
@@ -173,47 +2038,28 @@ async def ask_city(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[ask_city:Start] Entering ask_city function")
     message = update.message or update.callback_query.message
     chat_id = message.chat.id
-    page = active_sessions[chat_id]['page']
+    page = session_registry.page(chat_id)
     logger.info("[ask_city:LocateSelect] Locating city select element")
     select_locator = page.locator("select.form-control").nth(1)
     logger.info("[ask_city:WaitForSelect] Waiting for city select element to be visible")
-    await select_locator.wait_for()
+    with timeout_policy.deadline("options") as timeout:
+        await select_locator.wait_for(timeout=timeout)
     
-    MAX_RETRIES = 10
-    city_options = []
-    
-    logger.info("[ask_city:FetchOptions] Attempting to fetch city options")
-    for attempt in range(MAX_RETRIES):
-        logger.info(f"[ask_city:FetchOptionsAttempt] Attempt {attempt + 1}/{MAX_RETRIES}")
-        await page.wait_for_timeout(500)
-        city_options = await page.evaluate("""
-            () => {
-                const select = document.querySelectorAll("select.form-control")[1];
-                return Array.from(select.options)
-                    .filter(opt => {
-                        const txt = opt.textContent.trim().toLowerCase();
-                        return opt.value && txt !== "" && !txt.includes("select") && !txt.includes("--");
-                    })
-                    .map(opt => [opt.value, opt.textContent.trim()]);
-            }
-        """)
-        if city_options:
-            logger.info(f"[ask_city:OptionsFound] Found {len(city_options)} city options")
-            break
-    
-    if not city_options:
+    logger.info("[ask_city:FetchOptions] Fetching city options with retry budget")
+    try:
+        city_options = await retry_engine.run(
+            "options", page.evaluate, SELECT_OPTIONS_JS, 1, retry_if=lambda options: not options
+        )
+    except RetryExhausted:
         logger.error("[ask_city:NoOptions] Failed to load city options")
-        await message.reply_text("❌ Failed to load city options. Please try again.")
-        return ConversationHandler.END
+        return await leave_after_retries(update, context, "❌ Failed to load city options. Please try again later.")
+    logger.info(f"[ask_city:OptionsFound] Found {len(city_options)} city options")
 
     logger.info("[ask_city:StoreOptions] Storing city options in user_data")
     context.user_data["city_options"] = city_options
     
     logger.info("[ask_city:CreateKeyboard] Creating inline keyboard for cities")
-    keyboard = [
-        [InlineKeyboardButton(text, callback_data=f"city_{value}")] for value, text in city_options
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = paginated_keyboard(context, "city", ((text, f"city_{value}") for value, text in city_options))
     logger.info("[ask_city:SendKeyboard] Sending city selection keyboard")
     await message.reply_text("Please select a City:", reply_markup=reply_markup)
     
@@ -231,7 +2077,8 @@ async def ask_city_response(update: Update, context: ContextTypes.DEFAULT_TYPE)
     logger.info("[ask_city_response:GetSelectedValue] Extracting selected city value")
     selected_value = query.data.replace("city_", "")
     logger.info(f"[ask_city_response:SelectOption] Selecting city option {selected_value} on page")
-    await active_sessions[chat_id]['page'].locator("select.form-control").nth(1).select_option(value=selected_value)
+    await select_location_option(session_registry.page(chat_id), 1, selected_value)
+    checkpoint(context.user_data, "location", index=1, value=selected_value)
     logger.info("[ask_city_response:GetCityName] Retrieving city name")
     city_name = next((text for value, text in context.user_data["city_options"] if value == selected_value), "Unknown")
 
@@ -246,48 +2093,29 @@ async def ask_office(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[ask_office:Start] Entering ask_office function")
     message = update.message or update.callback_query.message
     chat_id = message.chat.id
-    page = active_sessions[chat_id]['page']
+    page = session_registry.page(chat_id)
     
     logger.info("[ask_office:LocateSelect] Locating office select element")
     select_locator = page.locator("select.form-control").nth(2)
     logger.info("[ask_office:WaitForSelect] Waiting for office select element to be visible")
-    await select_locator.wait_for()
+    with timeout_policy.deadline("options") as timeout:
+        await select_locator.wait_for(timeout=timeout)
     
-    MAX_RETRIES = 10
-    office_options = []
-    
-    logger.info("[ask_office:FetchOptions] Attempting to fetch office options")
-    for attempt in range(MAX_RETRIES):
-        logger.info(f"[ask_office:FetchOptionsAttempt] Attempt {attempt + 1}/{MAX_RETRIES}")
-        await page.wait_for_timeout(500)
-        office_options = await page.evaluate("""
-            () => {
-                const select = document.querySelectorAll("select.form-control")[2];
-                return Array.from(select.options)
-                    .filter(opt => {
-                        const txt = opt.textContent.trim().toLowerCase();
-                        return opt.value && txt !== "" && !txt.includes("select") && !txt.includes("--");
-                    })
-                    .map(opt => [opt.value, opt.textContent.trim()]);
-            }
-        """)
-        if office_options:
-            logger.info(f"[ask_office:OptionsFound] Found {len(office_options)} office options")
-            break
-
-    if not office_options:
+    logger.info("[ask_office:FetchOptions] Fetching office options with retry budget")
+    try:
+        office_options = await retry_engine.run(
+            "options", page.evaluate, SELECT_OPTIONS_JS, 2, retry_if=lambda options: not options
+        )
+    except RetryExhausted:
         logger.error("[ask_office:NoOptions] Failed to load office options")
-        await message.reply_text("❌ Failed to load office options. Please try again.")
-        return ConversationHandler.END
+        return await leave_after_retries(update, context, "❌ Failed to load office options. Please try again later.")
+    logger.info(f"[ask_office:OptionsFound] Found {len(office_options)} office options")
 
     logger.info("[ask_office:StoreOptions] Storing office options in user_data")
     context.user_data["office_options"] = office_options
 
     logger.info("[ask_office:CreateKeyboard] Creating inline keyboard for offices")
-    keyboard = [
-        [InlineKeyboardButton(text, callback_data=f"office_{value}")] for value, text in office_options
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = paginated_keyboard(context, "office", ((text, f"office_{value}") for value, text in office_options))
     logger.info("[ask_office:SendKeyboard] Sending office selection keyboard")
     await message.reply_text("Please select an Office:", reply_markup=reply_markup)
 
@@ -305,7 +2133,8 @@ async def ask_office_response(update: Update, context: ContextTypes.DEFAULT_TYPE
     logger.info("[ask_office_response:GetSelectedValue] Extracting selected office value")
     selected_value = query.data.replace("office_", "")
     logger.info(f"[ask_office_response:SelectOption] Selecting office option {selected_value} on page")
-    await active_sessions[chat_id]['page'].locator("select.form-control").nth(2).select_option(value=selected_value)
+    await select_location_option(session_registry.page(chat_id), 2, selected_value)
+    checkpoint(context.user_data, "location", index=2, value=selected_value)
     logger.info("[ask_office_response:GetOfficeName] Retrieving office name")
     office_name = next((text for value, text in context.user_data["office_options"] if value == selected_value), "Unknown")
     logger.info(f"[ask_office_response:EditMessage] Updating message with selected office: {office_name}")
@@ -317,47 +2146,28 @@ async def ask_branch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[ask_branch:Start] Entering ask_branch function")
     message = update.message or update.callback_query.message
     chat_id = message.chat.id
-    page = active_sessions[chat_id]['page']
+    page = session_registry.page(chat_id)
     logger.info("[ask_branch:LocateSelect] Locating branch select element")
     select_locator = page.locator("select.form-control").nth(3)
     logger.info("[ask_branch:WaitForSelect] Waiting for branch select element to be visible")
-    await select_locator.wait_for()
-
-    MAX_RETRIES = 10
-    branch_options = []
-
-    logger.info("[ask_branch:FetchOptions] Attempting to fetch branch options")
-    for attempt in range(MAX_RETRIES):
-        logger.info(f"[ask_branch:FetchOptionsAttempt] Attempt {attempt + 1}/{MAX_RETRIES}")
-        await page.wait_for_timeout(500)
-        branch_options = await page.evaluate("""
-            () => {
-                const select = document.querySelectorAll("select.form-control")[3];
-                return Array.from(select.options)
-                    .filter(opt => {
-                        const txt = opt.textContent.trim().toLowerCase();
-                        return opt.value && txt !== "" && !txt.includes("select") && !txt.includes("--");
-                    })
-                    .map(opt => [opt.value, opt.textContent.trim()]);
-            }
-        """)
-        if branch_options:
-            logger.info(f"[ask_branch:OptionsFound] Found {len(branch_options)} branch options")
-            break
+    with timeout_policy.deadline("options") as timeout:
+        await select_locator.wait_for(timeout=timeout)
 
-    if not branch_options:
+    logger.info("[ask_branch:FetchOptions] Fetching branch options with retry budget")
+    try:
+        branch_options = await retry_engine.run(
+            "options", page.evaluate, SELECT_OPTIONS_JS, 3, retry_if=lambda options: not options
+        )
+    except RetryExhausted:
         logger.error("[ask_branch:NoOptions] Failed to load branch options")
-        await message.reply_text("❌ Failed to load branch options. Please try again.")
-        return ConversationHandler.END
+        return await leave_after_retries(update, context, "❌ Failed to load branch options. Please try again later.")
+    logger.info(f"[ask_branch:OptionsFound] Found {len(branch_options)} branch options")
 
     logger.info("[ask_branch:StoreOptions] Storing branch options in user_data")
     context.user_data["branch_options"] = branch_options
 
     logger.info("[ask_branch:CreateKeyboard] Creating inline keyboard for branches")
-    keyboard = [
-        [InlineKeyboardButton(text, callback_data=f"branch_{value}")] for value, text in branch_options
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = paginated_keyboard(context, "branch", ((text, f"branch_{value}") for value, text in branch_options))
     logger.info("[ask_branch:SendKeyboard] Sending branch selection keyboard")
     await message.reply_text("Please select a Branch:", reply_markup=reply_markup)
 
@@ -374,32 +2184,33 @@ async def ask_branch_response(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     logger.info("[ask_branch_response:GetSelectedValue] Extracting selected branch value")
     selected_value = query.data.replace("branch_", "")
-    page = active_sessions[chat_id]['page']
+    page = session_registry.page(chat_id)
     logger.info(f"[ask_branch_response:SelectOption] Selecting branch option {selected_value} on page")
-    await page.locator("select.form-control").nth(3).select_option(value=selected_value)
+    await select_location_option(page, 3, selected_value)
+    checkpoint(context.user_data, "location", index=3, value=selected_value)
+    context.user_data["selected_branch"] = selected_value
     logger.info("[ask_branch_response:GetBranchName] Retrieving branch name")
     branch_name = next((text for value, text in context.user_data["branch_options"] if value == selected_value), "Unknown")
     logger.info(f"[ask_branch_response:EditMessage] Updating message with selected branch: {branch_name}")
     await query.edit_message_text(text=f"✅ Branch selected: {branch_name}!")
     
     logger.info("[ask_branch_response:ClickNext] Clicking Next button")
-    await page.get_by_role("button", name="Next").click()
-    logger.info("[ask_branch_response:Wait] Waiting for page to process")
-    await page.wait_for_timeout(3000)
+    await open_calendar(page)
+    checkpoint(context.user_data, "calendar")
     logger.info("[ask_branch_response:SendStatus] Sending status message")
-    status_msg = await message.reply_text("Checking available dates... from current month...")
+    progress = await ProgressReporter.send(message, "Checking available dates... from current month...")
     logger.info("[ask_branch_response:UpdateStatus] Updating status message")
-    await status_msg.edit_text("almost there...checking available dates...")
+    await progress.update("almost there...checking available dates...")
     logger.info("[ask_branch_response:CallAskDate] Calling ask_date function")
-    return await ask_date(update, context, status_msg)
+    return await ask_date(update, context, progress)
 
-async def ask_date(update: Update, context: ContextTypes.DEFAULT_TYPE, status_msg) -> int:
+async def ask_date(update: Update, context: ContextTypes.DEFAULT_TYPE, progress) -> int:
     logger.info("[ask_date:Start] Entering ask_date function")
     message = update.message or update.callback_query.message
     chat_id = message.chat.id
-    page = active_sessions[chat_id]['page']
+    page = session_registry.page(chat_id)
     logger.info("[ask_date:UpdateStatus] Updating status message to check dates")
-    await status_msg.edit_text("Checking available dates...please wait")
+    await progress.update("Checking available dates...please wait")
     logger.info("[ask_date:CheckCalendar] Checking if calendar is visible")
     calendar_visible = await page.locator("div.react-calendar__month-view__days").is_visible()
     if not calendar_visible:
@@ -409,39 +2220,45 @@ async def ask_date(update: Update, context: ContextTypes.DEFAULT_TYPE, status_ms
         return await new_or_check(update, context)
     
     logger.info("[ask_date:CalendarVisible] Calendar is visible")
-    await status_msg.edit_text("Calendar is visible, checking for available dates...")
+    await progress.update("Calendar is visible, checking for available dates...")
     
-    logger.info("[ask_date:FetchDays] Fetching available day buttons")
-    while True:
+    async def read_month():
         day_buttons = await page.locator("div.react-calendar__month-view__days button:not([disabled])").all()
         logger.info(f"[ask_date:DaysFound] Found {len(day_buttons)} available dates")
-        await status_msg.edit_text(f"Found {len(day_buttons)} available dates.")
-        if day_buttons:
-            break
-        logger.info("[ask_date:ClickNextMonth] Clicking next month button")
-        await page.locator("button.react-calendar__navigation__next-button").click()
-        logger.info("[ask_date:WaitNextMonth] Waiting after clicking next month")
-        await page.wait_for_timeout(1000)
+        await progress.update(f"Found {len(day_buttons)} available dates.")
+        if not day_buttons:
+            logger.info("[ask_date:ClickNextMonth] Clicking next month button")
+            await page.locator("button.react-calendar__navigation__next-button").click()
+        return day_buttons
+
+    logger.info("[ask_date:FetchDays] Fetching available day buttons, one month per attempt")
+    try:
+        day_buttons = await retry_engine.run("calendar_months", read_month, retry_if=lambda buttons: not buttons)
+    except RetryExhausted:
+        await progress.finish("❌ No available dates in the coming months.")
+        return await leave_after_retries(update, context, "Please try another branch or check again later.")
     
     logger.info("[ask_date:ExtractDates] Extracting available dates")
-    await status_msg.edit_text("Extracting available dates...")
+    await progress.update("Extracting available dates...")
     available_days = []
     for i, button in enumerate(day_buttons, start=1):
         label = await button.locator("abbr").get_attribute("aria-label")
         if label:
-            available_days.append((i, label, button))
+            available_days.append((i, label))
+    logger.info("[ask_date:DualLabels] Adding Ethiopian calendar labels")
+    available_days = [
+        (i, dual, label)
+        for (i, label), dual in zip(available_days, ethiopian_calendar.dual_labels(label for _, label in available_days))
+    ]
     logger.info(f"[ask_date:DatesExtracted] Extracted {len(available_days)} available days")
 
     logger.info("[ask_date:StoreDays] Storing available days in user_data")
     context.user_data["available_days"] = available_days
 
     logger.info("[ask_date:CreateKeyboard] Creating inline keyboard for dates")
-    keyboard = [
-        [InlineKeyboardButton(label, callback_data=f"date_{i}")] for i, label, _ in available_days
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = paginated_keyboard(context, "date", ((label, f"date_{i}") for i, label, _ in available_days))
     logger.info("[ask_date:SendKeyboard] Sending date selection keyboard")
-    await status_msg.edit_text("📅 Available Dates:", reply_markup=reply_markup)
+    await progress.finish("📅 Available Dates:", reply_markup=reply_markup)
 
     logger.info("[ask_date:Return] Returning state 4")
     return 4
@@ -459,72 +2276,101 @@ async def ask_date_response(update: Update, context: ContextTypes.DEFAULT_TYPE)
     logger.info(f"[ask_date_response:SelectedIndex] Selected index: {selected_idx}")
     available_days = context.user_data["available_days"]
     
+    page = session_registry.page(chat_id)
     logger.info("[ask_date_response:ClickDate] Clicking selected date")
-    for i, label, button in available_days:
+    for i, label, portal_label in available_days:
         if i == selected_idx:
-            await button.click()
+            await click_calendar_day(page, portal_label)
+            checkpoint(context.user_data, "date", label=portal_label)
+            context.user_data["selected_date"] = portal_label
             logger.info(f"[ask_date_response:EditMessage] Updating message with selected date: {label}")
             await query.edit_message_text(text=f"✅ Selected date: {label}")
             break
 
     logger.info("[ask_date_response:Wait] Waiting for page to process")
-    await active_sessions[chat_id]['page'].wait_for_timeout(1000)
+    await page.wait_for_timeout(1000)
     logger.info("[ask_date_response:CallHandleTimeSlot] Calling handle_time_slot function")
     return await handle_time_slot(update, context)
 
 async def handle_time_slot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[handle_time_slot:Start] Entering handle_time_slot function")
-    page = active_sessions[update.effective_chat.id]['page']
+    page = session_registry.page(update.effective_chat.id)
     message = update.message or update.callback_query.message
     logger.info("[handle_time_slot:SendStatus] Sending status message for time slots")
-    status_msg = await message.reply_text("Checking for available time slots...")
+    progress = await ProgressReporter.send(message, "Checking for available time slots...")
     
-    logger.info("[handle_time_slot:FetchMorning] Fetching morning time slots")
-    morning_buttons = await page.locator("table#displayMorningAppts input.btn_select").all()
-    logger.info("[handle_time_slot:FetchAfternoon] Fetching afternoon time slots")
-    afternoon_buttons = await page.locator("table#displayAfternoonAppts input.btn_select").all()
+    logger.info("[handle_time_slot:ReadInventory] Reading morning and afternoon time slots")
+    slots = await read_slot_inventory(page, slot_cache_key(context.user_data))
+    logger.info(f"[handle_time_slot:SlotsFound] Found {len(slots)} time slots")
   
-    if not morning_buttons and not afternoon_buttons:
+    if not slots:
         logger.error("[handle_time_slot:NoSlots] No time slots available")
-        await status_msg.edit_text("❌ No time slots available.")
+        if not retry_engine.consume(context.user_data, "time_slots"):
+            await progress.finish("❌ No time slots available on the dates tried.")
+            return await leave_after_retries(update, context, "Please try another branch or check again later.")
+        await progress.update("❌ No time slots available. Please pick another date.")
         logger.info("[handle_time_slot:CallAskDate] Calling ask_date function")
-        return await ask_date(update, context, status_msg)
-    
-    if morning_buttons:
-        logger.info("[handle_time_slot:MorningSlots] Morning slots available")
-        await status_msg.edit_text("🕒 Morning slots available.")
-        logger.info("[handle_time_slot:SelectMorning] Selecting first morning slot")
-        await morning_buttons[0].click()
-        logger.info("[handle_time_slot:UpdateMorningStatus] Updating status for morning slot")
-        await status_msg.edit_text("🕒 Morning time slot selected.")
-    elif afternoon_buttons:
-        logger.info("[handle_time_slot:AfternoonSlots] Afternoon slots available")
-        await status_msg.edit_text("🕒 Afternoon slots available.")
-        logger.info("[handle_time_slot:SelectAfternoon] Selecting first afternoon slot")
-        await afternoon_buttons[0].click()
-        logger.info("[handle_time_slot:UpdateAfternoonStatus] Updating status for afternoon slot")
-        await status_msg.edit_text("🕒 Afternoon time slot selected.")
-    
-    chat_id = message.chat.id
-    page = active_sessions[chat_id]['page']
-    logger.info("[handle_time_slot:ClickNext] Clicking Next button")
-    await page.get_by_role("button", name="Next").click()
-    logger.info("[handle_time_slot:Wait] Waiting for page to process")
-    await page.wait_for_timeout(1000)
-    logger.info("[handle_time_slot:CallAskFirstName] Calling ask_first_name function")
+        return await ask_date(update, context, progress)
+    retry_engine.reset(context.user_data, "time_slots")
+
+    logger.info("[handle_time_slot:StoreSlots] Storing time slots in user_data")
+    context.user_data["slot_options"] = slots
+    logger.info("[handle_time_slot:CreateKeyboard] Creating inline keyboard for time slots")
+    reply_markup = paginated_keyboard(context, "slot", ((slot_label(slot), f"slot_{n}") for n, slot in enumerate(slots)))
+    logger.info("[handle_time_slot:SendKeyboard] Sending time slot selection keyboard")
+    await progress.finish("🕒 Available Time Slots:", reply_markup=reply_markup)
+
+    logger.info("[handle_time_slot:Return] Returning TIME_SLOT_STATE")
+    return TIME_SLOT_STATE
+
+async def ask_time_slot_response(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    logger.info("[ask_time_slot_response:Start] Entering ask_time_slot_response function")
+    query = update.callback_query
+    chat_id = update.effective_chat.id
+    logger.info("[ask_time_slot_response:AnswerQuery] Answering callback query")
+    await query.answer()
+
+    slot = context.user_data["slot_options"][int(query.data.replace("slot_", ""))]
+    page = session_registry.page(chat_id)
+    logger.info(f"[ask_time_slot_response:ClickSlot] Clicking {slot['session']} slot {slot['time'] or slot['index']}")
+    try:
+        await click_time_slot(page, slot)
+    except LookupError as e:
+        logger.error(f"[ask_time_slot_response:SlotGone] {str(e)}")
+        slot_cache.invalidate(slot_cache_key(context.user_data))
+        await query.edit_message_text(text="⚠️ That time slot is no longer available.")
+        return await handle_time_slot(update, context)
+    checkpoint(context.user_data, "slot", table=slot["table"], time=slot["time"], index=slot["index"])
+    logger.info("[ask_time_slot_response:EditMessage] Updating message with selected time slot")
+    await query.edit_message_text(text=f"✅ Selected time slot: {slot_label(slot)}")
+
+    logger.info("[ask_time_slot_response:ClickNext] Clicking Next button")
+    await submit_time_slot(page)
+    logger.info("[ask_time_slot_response:CallAskFirstName] Calling ask_first_name function")
     return await ask_first_name(update, context)
 
 async def ask_first_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[ask_first_name:Start] Entering ask_first_name function")
     message = update.message or update.callback_query.message
+    context.user_data.pop("intake_used", None)
+    context.user_data.pop("dropdown_preset", None)
     logger.info("[ask_first_name:ReplyText] Sending prompt for first name")
-    await message.reply_text("Enter your First Name:")
+    await message.reply_text(
+        "Enter your First Name:\n"
+        "• Or fill everything in one message, or forward your saved profile.",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("⚡ Fill all details at once", callback_data="intake_template")]
+        ])
+    )
     logger.info("[ask_first_name:Return] Returning PERSONAL_FIRSTNAME state")
     return PERSONAL_FIRSTNAME
 
 async def handle_first_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[handle_first_name:Start] Entering handle_first_name function")
     message = update.message or update.callback_query.message
+    if looks_like_intake(message.text):
+        logger.info("[handle_first_name:Intake] Message looks like a filled template")
+        return await handle_intake(update, context)
     logger.info("[handle_first_name:StoreFirstName] Storing first name in user_data")
     context.user_data["first_name"] = message.text.strip()
     logger.info("[handle_first_name:ReplyText] Sending prompt for middle name")
@@ -597,17 +2443,21 @@ async def handle_birth_place(update: Update, context: ContextTypes.DEFAULT_TYPE)
     logger.info("[handle_birth_place:Return] Returning PERSONAL_PHONE_NUMBER state")
     return PERSONAL_PHONE_NUMBER
 
+ETHIOPIC_RE = re.compile(r'[ሀ-ፕ]|[\u1369-\u137C]')
+
+def clean_phone_number(phone_number):
+    cleaned_number = ''.join(filter(str.isdigit, phone_number))
+    if len(cleaned_number) == 10 and cleaned_number.startswith(('09', '07')):
+        return cleaned_number
+    return None
+
 async def handle_phone_number(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[handle_phone_number:Start] Entering handle_phone_number function")
     message = update.message or update.callback_query.message
     phone_number = message.text.strip()
-    logger.info("[handle_phone_number:CleanNumber] Cleaning phone number")
-    cleaned_number = ''.join(filter(str.isdigit, phone_number))
-    
     logger.info("[handle_phone_number:ValidateNumber] Validating phone number")
-    if (len(cleaned_number) == 10 and 
-        cleaned_number.startswith(('09', '07')) and
-        cleaned_number[2:].isdigit()):
+    cleaned_number = clean_phone_number(phone_number)
+    if cleaned_number:
         
         logger.info("[handle_phone_number:StoreNumber] Storing valid phone number in user_data")
         context.user_data["phone_number"] = cleaned_number
@@ -628,94 +2478,179 @@ async def handle_phone_number(update: Update, context: ContextTypes.DEFAULT_TYPE
     logger.info("[handle_phone_number:ReturnInvalid] Returning PERSONAL_PHONE_NUMBER state for retry")
     return PERSONAL_PHONE_NUMBER
 
+# Ethiopian <-> Gregorian conversion table for 1900-2100. One packed entry per
+# Gregorian day plus the Gregorian ordinal of every Ethiopian new year, so both
+# directions and Pagume/leap validation are a single index.
+ETHIOPIAN_MONTHS = (
+    "መስከረም", "ጥቅምት", "ኅዳር", "ታኅሣሥ", "ጥር", "የካቲት", "መጋቢት",
+    "ሚያዝያ", "ግንቦት", "ሰኔ", "ሐምሌ", "ነሐሴ", "ጳጉሜ",
+)
+ETHIOPIAN_DATE_RE = re.compile(r'^(\d{4})/(\d{1,2})/(\d{1,2})$')
+GREGORIAN_DATE_RE = re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})$|^(\d{2})(\d{2})(\d{4})$')
+PORTAL_DATE_FORMAT = "%B %d, %Y"
+
+class EthiopianCalendar:
+    FIRST_DAY = date(1900, 1, 1)
+    LAST_DAY = date(2100, 12, 31)
+    FIRST_ORDINAL = FIRST_DAY.toordinal()
+    LAST_ORDINAL = LAST_DAY.toordinal()
+
+    def __init__(self):
+        self._by_day = None
+        self._new_years = None
+        self._first_year = None
+        self._labels = {}
+
+    def _build(self):
+        # Anchored on the library's answer for the first day, then walked day by day
+        from ethiopian_date import EthiopianDateConverter
+        anchor = EthiopianDateConverter.date_to_ethiopian(self.FIRST_DAY)
+        year, month, day = anchor.year, anchor.month, anchor.day
+        first_ordinal = self.FIRST_ORDINAL
+        by_day = array.array("I")
+        new_years = array.array("I")
+        self._first_year = year
+        new_years.append(first_ordinal - ((month - 1) * 30 + day - 1))
+        for ordinal in range(first_ordinal, self.LAST_ORDINAL + 1):
+            by_day.append(year << 9 | month << 5 | day)
+            day += 1
+            if day > (30 if month < 13 else 6 if year % 4 == 3 else 5):
+                day = 1
+                month += 1
+                if month > 13:
+                    month = 1
+                    year += 1
+                    new_years.append(ordinal + 1)
+        new_years.append(new_years[-1] + (366 if year % 4 == 3 else 365))
+        self._by_day = by_day
+        self._new_years = new_years
+
+    def _tables(self):
+        if self._by_day is None:
+            self._build()
+        return self._by_day, self._new_years
+
+    def days_in_month(self, year, month):
+        _, new_years = self._tables()
+        index = year - self._first_year
+        if not 0 <= index < len(new_years) - 1 or not 1 <= month <= 13:
+            return 0
+        return 30 if month < 13 else new_years[index + 1] - new_years[index] - 360
+
+    def to_gregorian(self, year, month, day):
+        # Returns None for dates that do not exist or fall outside the table
+        if not 1 <= day <= self.days_in_month(year, month):
+            return None
+        ordinal = self._new_years[year - self._first_year] + (month - 1) * 30 + day - 1
+        if not self.FIRST_ORDINAL <= ordinal <= self.LAST_ORDINAL:
+            return None
+        return date.fromordinal(ordinal)
+
+    def to_ethiopian(self, gregorian):
+        by_day, _ = self._tables()
+        index = gregorian.toordinal() - self.FIRST_ORDINAL
+        if not 0 <= index < len(by_day):
+            return None
+        packed = by_day[index]
+        return packed >> 9, packed >> 5 & 0xF, packed & 0x1F
+
+    def format_ethiopian(self, gregorian):
+        converted = self.to_ethiopian(gregorian)
+        if converted is None:
+            return ""
+        year, month, day = converted
+        return f"{ETHIOPIAN_MONTHS[month - 1]} {day}, {year}"
+
+    def dual_labels(self, portal_labels):
+        # Batch form for keyboards: each distinct portal label is parsed and converted once
+        labels = []
+        for label in portal_labels:
+            dual = self._labels.get(label)
+            if dual is None:
+                try:
+                    ethiopian = self.format_ethiopian(datetime.strptime(label, PORTAL_DATE_FORMAT).date())
+                except ValueError:
+                    ethiopian = ""
+                dual = f"{label} · {ethiopian}" if ethiopian else label
+                self._labels[label] = dual
+            labels.append(dual)
+        return labels
+
+ethiopian_calendar = EthiopianCalendar()
+
 def validate_gregorian_date(date_str):
     logger.info("[validate_gregorian_date:Start] Entering validate_gregorian_date function")
+    match = GREGORIAN_DATE_RE.match(date_str)
+    if not match:
+        logger.error("[validate_gregorian_date:InvalidFormat] Invalid date format")
+        return False
+    month, day, year = (int(value) for value in (match.group(1, 2, 3) if match.group(1) else match.group(4, 5, 6)))
     try:
-        if '/' in date_str:
-            logger.info("[validate_gregorian_date:TryFormat1] Trying mm/dd/yyyy format")
-            date_obj = datetime.strptime(date_str, "%m/%d/%Y")
-        else:
-            logger.info("[validate_gregorian_date:CheckLength] Checking length for mmddyyyy format")
-            if len(date_str) != 8:
-                logger.error("[validate_gregorian_date:InvalidLength] Invalid date length")
-                return False
-            logger.info("[validate_gregorian_date:TryFormat2] Trying mmddyyyy format")
-            date_obj = datetime.strptime(date_str, "%m%d%Y")
-        
-        logger.info("[validate_gregorian_date:SanityCheck] Performing year sanity check")
-        if date_obj.year < 1900 or date_obj.year > datetime.now().year:
-            logger.error("[validate_gregorian_date:InvalidYear] Year out of valid range")
-            return False
-        logger.info("[validate_gregorian_date:Success] Date validated successfully")
-        return date_obj
+        date_obj = datetime(year, month, day)
     except ValueError:
-        logger.error("[validate_gregorian_date:InvalidFormat] Invalid date format")
+        logger.error("[validate_gregorian_date:InvalidFormat] Invalid date values")
         return False
 
+    logger.info("[validate_gregorian_date:SanityCheck] Performing year sanity check")
+    if date_obj.year < 1900 or date_obj.year > datetime.now().year:
+        logger.error("[validate_gregorian_date:InvalidYear] Year out of valid range")
+        return False
+    logger.info("[validate_gregorian_date:Success] Date validated successfully")
+    return date_obj
+
 def convert_ethiopian_to_gregorian(eth_date_str):
     logger.info("[convert_ethiopian_to_gregorian:Start] Entering convert_ethiopian_to_gregorian function")
-    try:
-        logger.info("[convert_ethiopian_to_gregorian:ValidateFormat] Validating Ethiopian date format")
-        if not re.match(r'^\d{4}/\d{1,2}/\d{1,2}$', eth_date_str):
-            logger.error("[convert_ethiopian_to_gregorian:InvalidFormat] Invalid Ethiopian date format")
-            return False
-            
-        logger.info("[convert_ethiopian_to_gregorian:ParseDate] Parsing Ethiopian date")
-        year, month, day = map(int, eth_date_str.split('/'))
-        
-        logger.info("[convert_ethiopian_to_gregorian:ValidateValues] Validating Ethiopian date values")
-        if month < 1 or month > 13 or day < 1 or day > 30:
-            logger.error("[convert_ethiopian_to_gregorian:InvalidValues] Invalid Ethiopian date values")
-            return False
-        if month == 13 and day > 5:
-            logger.error("[convert_ethiopian_to_gregorian:InvalidPagume] Invalid Ethiopian date for Pagume")
-            return False
-            
-        logger.info("[convert_ethiopian_to_gregorian:Convert] Converting to Gregorian date")
-        greg_date = EthiopianDateConverter.to_gregorian(year, month, day)
-        
-        logger.info("[convert_ethiopian_to_gregorian:SanityCheck] Performing final sanity check")
-        if greg_date.year < 1900 or greg_date > datetime.now().date():
-            logger.error("[convert_ethiopian_to_gregorian:InvalidRange] Converted date out of valid range")
-            return False
-            
-        logger.info("[convert_ethiopian_to_gregorian:Success] Successfully converted date")
-        return greg_date
+    match = ETHIOPIAN_DATE_RE.match(eth_date_str)
+    if not match:
+        logger.error("[convert_ethiopian_to_gregorian:InvalidFormat] Invalid Ethiopian date format")
+        return False
 
-    except Exception as e:
-        logger.error(f"[convert_ethiopian_to_gregorian:Error] Error converting Ethiopian date: {e}")
+    logger.info("[convert_ethiopian_to_gregorian:Convert] Converting to Gregorian date")
+    year, month, day = map(int, match.groups())
+    greg_date = ethiopian_calendar.to_gregorian(year, month, day)
+    if greg_date is None:
+        logger.error("[convert_ethiopian_to_gregorian:InvalidValues] Invalid Ethiopian date values")
+        return False
+
+    logger.info("[convert_ethiopian_to_gregorian:SanityCheck] Performing final sanity check")
+    if greg_date > datetime.now().date():
+        logger.error("[convert_ethiopian_to_gregorian:InvalidRange] Converted date out of valid range")
         return False
 
+    logger.info("[convert_ethiopian_to_gregorian:Success] Successfully converted date")
+    return greg_date
+
+def parse_date_of_birth(dob_input):
+    # Returns (mm/dd/yyyy, converted_from_ethiopian) or None
+    if ETHIOPIAN_DATE_RE.match(dob_input):
+        logger.info("[parse_date_of_birth:EthiopianDetected] Ethiopian date format detected")
+        greg_date = convert_ethiopian_to_gregorian(dob_input)
+        if greg_date:
+            return greg_date.strftime("%m/%d/%Y"), True
+    logger.info("[parse_date_of_birth:ValidateGregorian] Validating Gregorian date")
+    date_obj = validate_gregorian_date(dob_input)
+    if date_obj:
+        return date_obj.strftime("%m/%d/%Y"), False
+    return None
+
 async def handle_dob(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[handle_dob:Start] Entering handle_dob function")
     message = update.message or update.callback_query.message
     dob_input = message.text.strip()
     
     logger.info("[handle_dob:CheckEthiopic] Checking for Ethiopic characters")
-    if re.search(r'[ሀ-ፕ]|[\u1369-\u137C]', dob_input):
+    if ETHIOPIC_RE.search(dob_input):
         logger.error("[handle_dob:EthiopicDetected] Ethiopic characters detected")
         await message.reply_text("Please enter the date in English numbers (0-9)")
         logger.info("[handle_dob:ReturnEthiopic] Returning PERSONAL_DOB state for retry")
         return PERSONAL_DOB
-    
-    logger.info("[handle_dob:CheckEthiopianFormat] Checking for Ethiopian date format")
-    if '/' in dob_input and (dob_input.count('/') == 2 and re.match(r'^\d{4}/\d{1,2}/\d{1,2}$', dob_input)):
-        logger.info("[handle_dob:EthiopianDetected] Ethiopian date format detected")
-        greg_date = convert_ethiopian_to_gregorian(dob_input)
-        if greg_date:
-            logger.info("[handle_dob:StoreEthiopian] Storing converted Gregorian date")
-            context.user_data["dob"] = greg_date.strftime("%m/%d/%Y")
+
+    parsed = parse_date_of_birth(dob_input)
+    if parsed:
+        context.user_data["dob"], converted = parsed
+        if converted:
             logger.info(f"[handle_dob:ReplyConverted] Replying with converted date: {context.user_data['dob']}")
             await message.reply_text(f"Converted to Gregorian: {context.user_data['dob']}")
-            logger.info("[handle_dob:CallAskDropdown] Calling ask_dropdown_option function")
-            return await ask_dropdown_option(update, context)
-    
-    logger.info("[handle_dob:ValidateGregorian] Validating Gregorian date")
-    date_obj = validate_gregorian_date(dob_input)
-    logger.info(f"[handle_dob:GregorianResult] Gregorian validation result: {date_obj}")
-    if date_obj:
-        logger.info("[handle_dob:StoreGregorian] Storing Gregorian date in user_data")
-        context.user_data["dob"] = date_obj.strftime("%m/%d/%Y")
         logger.info("[handle_dob:CallAskDropdown] Calling ask_dropdown_option function")
         return await ask_dropdown_option(update, context)
     
@@ -729,11 +2664,150 @@ async def handle_dob(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[handle_dob:ReturnInvalid] Returning PERSONAL_DOB state for retry")
     return PERSONAL_DOB
 
+# Fast intake: every personal field in one message, either the filled template
+# or a forwarded saved profile. Dropdown fields are matched against the portal's
+# own option labels.
+INTAKE_FIELDS = [
+    ("first_name", "First name"),
+    ("middle_name", "Middle name"),
+    ("last_name", "Last name"),
+    ("amharic_first_name", "First name (Amharic)"),
+    ("amharic_middle_name", "Middle name (Amharic)"),
+    ("amharic_last_name", "Last name (Amharic)"),
+    ("birth_place", "Birth place"),
+    ("phone_number", "Phone"),
+    ("dob", "Date of birth"),
+]
+INTAKE_DROPDOWNS = [(f"dropdown_{step}", label) for step, (_, label, _) in enumerate(DROPDOWN_SEQUENCE)]
+INTAKE_LABELS = {label.lower(): key for key, label in INTAKE_FIELDS + INTAKE_DROPDOWNS}
+INTAKE_MIN_FIELDS = 3
+INTAKE_OPTIONS_JS = """
+(selectors) => selectors.map(selector => {
+    const select = document.querySelector(selector);
+    if (!select) return [];
+    return Array.from(select.options)
+        .filter(opt => opt.value && !opt.textContent.includes("--"))
+        .map(opt => [opt.value, opt.textContent.trim()]);
+})
+"""
+
+def intake_template(values=None):
+    values = values or {}
+    return "\n".join(f"{label}: {values.get(key, '')}" for key, label in INTAKE_FIELDS + INTAKE_DROPDOWNS)
+
+def read_intake_lines(text):
+    fields = {}
+    for line in (text or "").splitlines():
+        label, separator, value = line.partition(":")
+        key = INTAKE_LABELS.get(label.strip().lower())
+        if separator and key:
+            fields[key] = value.strip()
+    return fields
+
+def looks_like_intake(text):
+    return len(read_intake_lines(text)) >= INTAKE_MIN_FIELDS
+
+def parse_intake(text):
+    # Validates every field and returns (values, errors) so all problems are reported at once
+    fields = read_intake_lines(text)
+    values, errors = {}, []
+    for key, label in INTAKE_FIELDS:
+        value = fields.get(key, "")
+        if not value:
+            errors.append(f"{label}: missing")
+        elif key.startswith("amharic_") and not ETHIOPIC_RE.search(value):
+            errors.append(f"{label}: please use Amharic (Ge'ez) letters")
+        elif key == "phone_number":
+            phone_number = clean_phone_number(value)
+            if phone_number:
+                values[key] = phone_number
+            else:
+                errors.append(f"{label}: must be 10 digits starting with 09 or 07")
+        elif key == "dob":
+            parsed = None if ETHIOPIC_RE.search(value) else parse_date_of_birth(value)
+            if parsed:
+                values[key] = parsed[0]
+            else:
+                errors.append(f"{label}: use mm/dd/yyyy or Ethiopian yyyy/mm/dd in English digits")
+        else:
+            values[key] = value
+    for key, _ in INTAKE_DROPDOWNS:
+        if fields.get(key):
+            values[key] = fields[key]
+    return values, errors
+
+async def send_intake_template(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    logger.info("[send_intake_template:Start] Entering send_intake_template function")
+    query = update.callback_query
+    await query.answer()
+    await query.message.reply_text(
+        "Copy this message, fill in every line after the colon and send it back:\n\n" + intake_template()
+    )
+    logger.info("[send_intake_template:Return] Returning PERSONAL_FIRSTNAME state")
+    return PERSONAL_FIRSTNAME
+
+async def handle_intake(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    logger.info("[handle_intake:Start] Entering handle_intake function")
+    message = update.message
+    chat_id = message.chat.id
+    values, errors = parse_intake(message.text)
+
+    logger.info("[handle_intake:CheckDropdowns] Matching dropdown answers against portal options")
+    page = session_registry.page(chat_id)
+    provided = [(step, key, label) for step, (key, label) in enumerate(INTAKE_DROPDOWNS) if key in values]
+    selections = []
+    unmatched = []
+    if provided:
+        options = await page.evaluate(INTAKE_OPTIONS_JS, [DROPDOWN_SEQUENCE[step][0] for step, _, _ in provided]) or []
+        for (step, key, label), choices in zip(provided, options):
+            match = next(((value, text) for value, text in choices if text.lower() == values[key].lower()), None)
+            if match is None:
+                # Asked again with buttons below instead of failing the whole message
+                unmatched.append(f"{label} \"{values[key]}\"")
+            else:
+                selections.append((step, key, *match))
+
+    if errors:
+        logger.error(f"[handle_intake:Invalid] {len(errors)} invalid fields")
+        await message.reply_text(
+            "❌ Please fix these fields and send the whole message again:\n" + "\n".join(f"• {error}" for error in errors)
+        )
+        logger.info("[handle_intake:ReturnInvalid] Returning PERSONAL_FIRSTNAME state for retry")
+        return PERSONAL_FIRSTNAME
+
+    logger.info("[handle_intake:StoreValues] Storing all personal details in user_data")
+    for key, _ in INTAKE_FIELDS:
+        context.user_data[key] = values[key]
+    context.user_data["intake_used"] = True
+    received = "✅ All details received."
+    if unmatched:
+        received += f"\n{', '.join(unmatched)} did not match an option; please pick from the list."
+    await message.reply_text(received)
+
+    for step, key, value, text in selections:
+        selector = DROPDOWN_SEQUENCE[step][0]
+        logger.info(f"[handle_intake:SelectOption] Selecting {value} for {selector}")
+        await page.select_option(selector, value)
+        checkpoint(context.user_data, "dropdown", selector=selector, value=value)
+        context.user_data[key] = text
+
+    if len(selections) < len(DROPDOWN_SEQUENCE):
+        logger.info("[handle_intake:AskDropdowns] Dropdown answers missing, asking for them")
+        context.user_data["dropdown_step"] = 0
+        context.user_data["dropdown_preset"] = [step for step, _, _, _ in selections]
+        return await ask_dropdown_option(update, context)
+    logger.info("[handle_intake:CallFillPersonal] Calling fill_personal_form_on_page")
+    return await fill_personal_form_on_page(update, context)
+
 async def ask_dropdown_option(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[ask_dropdown_option:Start] Entering ask_dropdown_option function")
     message = update.message or update.callback_query.message
     logger.info("[ask_dropdown_option:GetStep] Retrieving current dropdown step")
     step = context.user_data.get("dropdown_step", 0)
+    # Dropdowns already answered in an intake message are skipped
+    while step in context.user_data.get("dropdown_preset", ()):
+        step += 1
+    context.user_data["dropdown_step"] = step
     
     if step >= len(DROPDOWN_SEQUENCE):
         logger.info("[ask_dropdown_option:EndSequence] Dropdown sequence completed")
@@ -742,11 +2816,12 @@ async def ask_dropdown_option(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     selector, label, buttons_per_row = DROPDOWN_SEQUENCE[step]
     chat_id = message.chat.id
-    page = active_sessions[chat_id]['page']
+    page = session_registry.page(chat_id)
     logger.info(f"[ask_dropdown_option:LocateDropdown] Locating dropdown: {selector}")
     dropdown = page.locator(selector)
     logger.info("[ask_dropdown_option:WaitForDropdown] Waiting for dropdown to be visible")
-    await dropdown.wait_for()
+    with timeout_policy.deadline("options") as timeout:
+        await dropdown.wait_for(timeout=timeout)
     logger.info("[ask_dropdown_option:GetOptions] Retrieving dropdown options")
     options = await dropdown.locator('option').all()
 
@@ -765,15 +2840,9 @@ async def ask_dropdown_option(update: Update, context: ContextTypes.DEFAULT_TYPE
     context.user_data["current_dropdown_selector"] = selector
 
     logger.info("[ask_dropdown_option:CreateKeyboard] Creating inline keyboard for dropdown")
-    keyboard = []
-    row = []
-    for i, (value, text) in enumerate(valid_options, 1):
-        row.append(InlineKeyboardButton(text, callback_data=f"dropdown_{step}_{value}"))
-        if i % buttons_per_row == 0 or i == len(valid_options):
-            keyboard.append(row)
-            row = []
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = paginated_keyboard(
+        context, "dropdown", ((text, f"dropdown_{step}_{value}") for value, text in valid_options), columns=buttons_per_row
+    )
     logger.info(f"[ask_dropdown_option:SendKeyboard] Sending dropdown selection prompt for {label}")
     await message.reply_text(f"Please select {label}:", reply_markup=reply_markup)
 
@@ -804,12 +2873,14 @@ async def handle_dropdown_response(update: Update, context: ContextTypes.DEFAULT
 
     value, label = selected_option
     chat_id = message.chat.id
-    page = active_sessions[chat_id]['page']
+    page = session_registry.page(chat_id)
     logger.info(f"[handle_dropdown_response:SelectOption] Selecting dropdown option: {value}")
     await page.select_option(selector, value)
+    checkpoint(context.user_data, "dropdown", selector=selector, value=value)
     logger.info(f"[handle_dropdown_response:EditMessage] Updating message with selected option: {label}")
     await query.edit_message_text(text=f"✅ {label} selected.")
 
+    context.user_data[f"dropdown_{step}"] = label
     logger.info("[handle_dropdown_response:NextStep] Incrementing dropdown step")
     context.user_data["dropdown_step"] = step + 1
     logger.info("[handle_dropdown_response:CallAskDropdown] Calling ask_dropdown_option function")
@@ -819,40 +2890,22 @@ async def fill_personal_form_on_page(update: Update, context: ContextTypes.DEFAU
     logger.info("[fill_personal_form_on_page:Start] Entering fill_personal_form_on_page function")
     message = update.message or update.callback_query.message
     chat_id = message.chat.id
-    page = active_sessions[chat_id]['page']
+    page = session_registry.page(chat_id)
     user_data = context.user_data
     
-    logger.info("[fill_personal_form_on_page:FillFirstName] Filling first name")
-    await page.fill('input[name="firstName"]', user_data["first_name"])
-    logger.info("[fill_personal_form_on_page:FillMiddleName] Filling middle name")
-    await page.fill('input[name="middleName"]', user_data["middle_name"])
-    logger.info("[fill_personal_form_on_page:FillLastName] Filling last name")
-    await page.fill('input[name="lastName"]', user_data["last_name"])
-    logger.info("[fill_personal_form_on_page:ClearDOB] Clearing date of birth field")
-    await page.fill('#date-picker-dialog', '')
-    logger.info("[fill_personal_form_on_page:TypeDOB] Typing date of birth")
-    await page.type('#date-picker-dialog', user_data["dob"])
-    logger.info("[fill_personal_form_on_page:FillGezFirstName] Filling Amharic first name")
-    await page.fill('input[name="geezFirstName"]', user_data["amharic_first_name"])
-    logger.info("[fill_personal_form_on_page:FillGezMiddleName] Filling Amharic middle name")
-    await page.fill('input[name="geezMiddleName"]', user_data["amharic_middle_name"])
-    logger.info("[fill_personal_form_on_page:FillGezLastName] Filling Amharic last name")
-    await page.fill('input[name="geezLastName"]', user_data["amharic_last_name"])
-    logger.info("[fill_personal_form_on_page:SelectNationality] Selecting nationality")
-    await page.select_option('select[name="nationalityId"]', "ETHIOPIA")   
-    logger.info("[fill_personal_form_on_page:FillPhone] Filling phone number")
-    await page.fill('input[name="phoneNumber"]', user_data["phone_number"])
-    logger.info("[fill_personal_form_on_page:FillBirthPlace] Filling birth place")
-    await page.fill('input[name="birthPlace"]', user_data["birth_place"])
+    await fill_personal_form(page, user_data)
+
+    if not user_data.get("intake_used"):
+        logger.info("[fill_personal_form_on_page:SendProfile] Sending saved profile for fast intake next time")
+        with outbound_priority(PRIORITY_BULK):
+            await message.reply_text(
+                "📋 Saved profile — forward this message to me on your next booking to fill everything at once:\n\n"
+                + intake_template(user_data)
+            )
 
     logger.info("[fill_personal_form_on_page:ClickNext] Clicking Next button")
-    await page.get_by_role("button", name="Next").click()
-    logger.info("[fill_personal_form_on_page:WaitForRegion] Waiting for region select")
-    await page.wait_for_selector('select[name="region"]', timeout=50000)
-    logger.info("[fill_personal_form_on_page:SelectRegion] Selecting region")
-    region_select = page.locator("select[name='region']")
-    selected_region = context.user_data["selected_region"]
-    await region_select.select_option(value=selected_region)
+    await submit_personal_form(page, user_data)
+    checkpoint(user_data, "personal")
 
     logger.info("[fill_personal_form_on_page:CallFillAddress] Calling fill_address_form_on_page")
     return await fill_address_form_on_page(update, context)
@@ -861,17 +2914,10 @@ async def fill_address_form_on_page(update: Update, context: ContextTypes.DEFAUL
     logger.info("[fill_address_form_on_page:Start] Entering fill_address_form_on_page function")
     message = update.message or update.callback_query.message
     chat_id = message.chat.id
-    page = active_sessions[chat_id]['page']
-    user_data = context.user_data
+    page = session_registry.page(chat_id)
     
-    logger.info("[fill_address_form_on_page:FillCity] Filling city")
-    await page.fill('input[name="city"]', user_data["selected_city"])
-    logger.info("[fill_address_form_on_page:ClickNext1] Clicking first Next button")
-    await page.get_by_role("button", name="Next").click()
-    logger.info("[fill_address_form_on_page:ClickNext2] Clicking second Next button")
-    await page.get_by_role("button", name="Next").click()
-    logger.info("[fill_address_form_on_page:ClickSubmit] Clicking Submit button")
-    await page.get_by_role("button", name="Submit").click()
+    await submit_address_form(page, context.user_data)
+    checkpoint(context.user_data, "address")
 
     logger.info("[fill_address_form_on_page:CallFileUpload] Calling file_upload_from_telegram")
     return await file_upload_from_telegram(update, context)
@@ -948,17 +2994,35 @@ async def handle_file_upload(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.info(f"[handle_file_upload:ReturnTooLarge] Returning state for {context.user_data['current_file_type']}")
         return FILE_UPLOAD_ID_DOC if context.user_data["current_file_type"] == "id_doc" else FILE_UPLOAD_BIRTH_CERT
 
-    logger.info("[handle_file_upload:PreparePath] Preparing file path")
-    file_path = f"downloads/{context.user_data['current_file_type']}.{ext}"
-    logger.info("[handle_file_upload:CreateDir] Creating downloads directory")
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    logger.info("[handle_file_upload:DownloadFile] Downloading file")
-    tg_file = await file.get_file()
-    await tg_file.download_to_drive(file_path)
-    logger.info(f"[handle_file_upload:FileDownloaded] File downloaded to {file_path}")
+    chat_id = message.chat.id
+    session = session_registry.get(chat_id)
+    if not session:
+        logger.error("[handle_file_upload:SessionExpired] Session expired")
+        await message.reply_text("❌ Session expired. Please /start again.")
+        return ConversationHandler.END
+
+    logger.info("[handle_file_upload:CheckCache] Checking per-chat upload buffers")
+    uploads = session.uploads
+    if file.file_unique_id in uploads:
+        logger.info(f"[handle_file_upload:CacheHit] File {file.file_unique_id} already downloaded, reusing buffer")
+    else:
+        logger.info("[handle_file_upload:DownloadFile] Downloading file into memory")
+        tg_file = await file.get_file()
+        buffer = await tg_file.download_as_bytearray()
+        uploads[file.file_unique_id] = {
+            "name": f"{context.user_data['current_file_type']}.{ext}",
+            "mimeType": getattr(file, "mime_type", None) or mimetypes.guess_type(f"file.{ext}")[0] or "application/octet-stream",
+            "buffer": bytes(buffer),
+        }
+        logger.info(f"[handle_file_upload:FileDownloaded] Downloaded {len(buffer)} bytes for chat_id {chat_id}")
+    # Buffers live with the browser session; keep enough to download them again after recovery
+    upload = uploads[file.file_unique_id]
+    context.user_data.setdefault("upload_refs", {})[file.file_unique_id] = {
+        "file_id": file.file_id, "name": upload["name"], "mimeType": upload["mimeType"]
+    }
 
-    logger.info("[handle_file_upload:StoreFilePath] Storing file path in user_data")
-    context.user_data[context.user_data["current_file_type"]] = file_path
+    logger.info("[handle_file_upload:StoreFileRef] Storing file reference in user_data")
+    context.user_data[context.user_data["current_file_type"]] = file.file_unique_id
 
     if context.user_data["current_file_type"] == "id_doc":
         logger.info("[handle_file_upload:IDUploaded] ID document uploaded")
@@ -978,34 +3042,15 @@ async def upload_files_to_form(update: Update, context: ContextTypes.DEFAULT_TYP
     logger.info("[upload_files_to_form:Start] Entering upload_files_to_form function")
     message = update.message or update.callback_query.message
     chat_id = message.chat.id
-    page = active_sessions[chat_id]['page']
+    page = session_registry.page(chat_id)
     
-    try:
-        logger.info("[upload_files_to_form:UploadID] Uploading ID document")
-        await page.set_input_files('input[name="input-0"]', context.user_data["id_doc"])
-        logger.info("[upload_files_to_form:UploadBirthCert] Uploading birth certificate")
-        await page.set_input_files('input[name="input-1"]', context.user_data["birth_cert"])
-        logger.info("[upload_files_to_form:ClickUpload] Clicking Upload button")
-        await page.get_by_role("button", name="Upload").click()
-        logger.info("[upload_files_to_form:ReplySuccess] Sending success message")
-        await message.reply_text("📁 Uploaded successfully.")
-
-        logger.info("[upload_files_to_form:ClickCheckbox] Clicking defaultUnchecked checkbox")
-        await page.click('label[for="defaultUnchecked"]')
-        logger.info("[upload_files_to_form:ClickNext] Clicking Next button")
-        await page.get_by_role("button", name="Next").click()
-
-        logger.info("[upload_files_to_form:CallAskPayment] Calling ask_payment_method function")
-        return await ask_payment_method(update, context)
-    finally:
-        logger.info("[upload_files_to_form:Cleanup] Cleaning up uploaded files")
-        for file_type in ["id_doc", "birth_cert"]:
-            if file_path := context.user_data.get(file_type):
-                try:
-                    logger.info(f"[upload_files_to_form:DeleteFile] Deleting file {file_path}")
-                    os.remove(file_path)
-                except Exception as e:
-                    logger.error(f"[upload_files_to_form:DeleteError] Error deleting file {file_path}: {e}")
+    await upload_documents(page, session_registry.get(chat_id).uploads, context.user_data)
+    checkpoint(context.user_data, "documents")
+    logger.info("[upload_files_to_form:ReplySuccess] Sending success message")
+    await message.reply_text("📁 Uploaded successfully.")
+
+    logger.info("[upload_files_to_form:CallAskPayment] Calling ask_payment_method function")
+    return await ask_payment_method(update, context)
 
 async def ask_payment_method(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[ask_payment_method:Start] Entering ask_payment_method function")
@@ -1042,54 +3087,92 @@ async def handle_payment_method(update: Update, context: ContextTypes.DEFAULT_TY
     logger.info(f"[handle_payment_method:SelectedMethod] Selected payment method: {selected_method}")
     
     chat_id = message.chat.id
-    page = active_sessions[chat_id]['page']
+    page = session_registry.page(chat_id)
     logger.info(f"[handle_payment_method:ClickMethod] Clicking payment method: {selected_method}")
     await page.locator(f"div.type:has(p:has-text('{selected_method}')) p").click()
     logger.info("[handle_payment_method:ClickCheckbox] Clicking defaultUncheckedDisabled2 checkbox")
     await page.click('label[for="defaultUncheckedDisabled2"]')
     logger.info("[handle_payment_method:ClickNext] Clicking Next button")
     await page.get_by_role("button", name="Next").click()
+    checkpoint(context.user_data, "payment")
 
     logger.info(f"[handle_payment_method:EditMessage] Updating message with selected method: {selected_method}")
     await query.edit_message_text(text=f"✅ Selected payment method: {selected_method}")
     logger.info("[handle_payment_method:CallGenerateOutput] Calling generate_complete_output function")
     return await generate_complete_output(update, context)
 
-async def generate_complete_output(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    logger.info("[generate_complete_output:Start] Entering generate_complete_output function")
-    message = update.message or update.callback_query.message
-    chat_id = message.chat.id
-    logger.info("[generate_complete_output:SendStatus] Sending status message for data extraction")
-    status_msg = await message.reply_text("Extracting application data....")
-    page = active_sessions[chat_id]['page']
-    logger.info("[generate_complete_output:WaitLoad] Waiting for page to load")
-    await page.wait_for_load_state("networkidle")
-    logger.info("[generate_complete_output:WaitSelector] Waiting for summary selector")
-    await page.wait_for_selector('div.col-md-4.order-md-2.mb-4.mt-5')
-
-    logger.info("[generate_complete_output:GetContent] Retrieving page content")
-    content = await page.content()
-    logger.info("[generate_complete_output:ParseContent] Parsing content with BeautifulSoup")
-    soup = BeautifulSoup(content, 'html.parser')
-    logger.info("[generate_complete_output:SelectContainers] Selecting data containers")
-    containers = soup.select('div.col-md-4.order-md-2.mb-4.mt-5 ul.list-group.mb-3')
+# Booking summary extraction
+SUMMARY_CONTAINER_SELECTOR = 'div.col-md-4.order-md-2.mb-4.mt-5'
+SUMMARY_HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+SUMMARY_EXTRACT_JS = """
+(selector) => {
+    const data = [];
+    document.querySelectorAll(selector + " ul.list-group.mb-3").forEach(list => {
+        Array.from(list.querySelectorAll("li.list-group-item")).slice(1).forEach(item => {
+            const left = item.querySelector("h6");
+            const right = item.querySelector("span") || item.querySelector("strong");
+            if (left && right) {
+                data.push([left.textContent.trim(), right.textContent.trim()]);
+            }
+        });
+    });
+    return data;
+}
+"""
 
+def parse_summary_html(content, parser=None):
+    # Runs in the blocking executor; must not touch Telegram or Playwright objects.
+    # Accepts either the whole page or just the summary container's HTML.
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(content, parser or SUMMARY_HTML_PARSER)
+    containers = soup.select(f'{SUMMARY_CONTAINER_SELECTOR} ul.list-group.mb-3') or soup.select('ul.list-group.mb-3')
     data = {}
-    logger.info("[generate_complete_output:ProcessContainers] Processing containers")
     for container in containers:
         items = container.find_all('li', class_='list-group-item')
         for item in items[1:]:
             left = item.find('h6')
             right = item.find('span') or item.find('strong')
-            logger.info("[generate_complete_output:ExtractItem] Extracting item data")
-            await status_msg.edit_text("Extracting application data.... PLEASE WAIT")
             if left and right:
-                logger.info("[generate_complete_output:StoreItem] Storing item data")
-                key = left.get_text(strip=True)
-                value = right.get_text(strip=True)
-                data[key] = value
+                data[left.get_text(strip=True)] = right.get_text(strip=True)
+    return data
+
+async def extract_summary(page):
+    logger.info("[extract_summary:Evaluate] Extracting summary pairs in page")
+    try:
+        pairs = await page.evaluate(SUMMARY_EXTRACT_JS, SUMMARY_CONTAINER_SELECTOR)
+        if pairs:
+            return dict(pairs)
+    except Exception as e:
+        logger.error(f"[extract_summary:EvaluateError] In-page extraction failed: {e}")
+    logger.info("[extract_summary:Fallback] Parsing summary container HTML in executor")
+    container_html = await page.locator(SUMMARY_CONTAINER_SELECTOR).first.inner_html()
+    return await blocking_executor.run("parse_summary", parse_summary_html, container_html)
+
+async def generate_complete_output(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    logger.info("[generate_complete_output:Start] Entering generate_complete_output function")
+    message = update.message or update.callback_query.message
+    chat_id = message.chat.id
+    logger.info("[generate_complete_output:SendStatus] Sending status message for data extraction")
+    status_msg = await message.reply_text("Extracting application data.... PLEASE WAIT")
+    page = session_registry.page(chat_id)
+
+    async def read_summary():
+        logger.info("[generate_complete_output:WaitSelector] Waiting for summary items")
+        await page.wait_for_selector(f'{SUMMARY_CONTAINER_SELECTOR} li.list-group-item')
+        return await extract_summary(page)
+
+    try:
+        data = await retry_engine.run("summary", read_summary, retry_if=lambda data: not data.get("Application Number"))
+    except RetryExhausted as e:
+        logger.error(f"[generate_complete_output:NoAppNumber] {str(e)}")
+        data = {}
     logger.info("[generate_complete_output:ExtractionComplete] Data extraction completed")
-    await status_msg.edit_text("All data extracted successfully.")
+
+    if not data.get("Application Number"):
+        await status_msg.edit_text("❌ Application Number not found. Please check your status later.")
+        logger.info("[generate_complete_output:CallNewOrCheck] Calling new_or_check function")
+        return await new_or_check(update, context)
 
     logger.info("[generate_complete_output:FormatMessage] Formatting summary message")
     message_t = "📄 *Your ePassport Summary:*\n\n"
@@ -1099,87 +3182,98 @@ async def generate_complete_output(update: Update, context: ContextTypes.DEFAULT
     logger.info("[generate_complete_output:SendSummary] Sending summary message")
     await status_msg.edit_text(message_t, parse_mode="Markdown")
     
-    if data.get("Application Number") is None:
-        logger.error("[generate_complete_output:NoAppNumber] Application Number not found")
-        await message.reply_text("❌ Application Number not found. Please try again.")
-        logger.info("[generate_complete_output:Retry] Retrying generate_complete_output")
-        return await generate_complete_output(update, context)
-    
     logger.info("[generate_complete_output:GetAppNumber] Retrieving application number")
-    app_number = data.get("Application Number", None).replace(" ", "_")
+    app_number = data["Application Number"].replace(" ", "_")
     logger.info(f"[generate_complete_output:GenerateFilename] Generating filename: {app_number}.pdf")
     filename = f"{app_number}.pdf"
 
     logger.info("[generate_complete_output:CallSavePDF] Calling save_pdf function")
     return await save_pdf(update, context, page, filename=filename, app_number=app_number)
 
+def pdf_document_name(chat_id, prefix, app_number):
+    # Documents only ever live in memory; the name is what the user sees in Telegram
+    return f"{prefix}{app_number or chat_id}.pdf"
+
 async def save_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE, page, filename="output.pdf", app_number=None) -> int:
     logger.info("[save_pdf:Start] Entering save_pdf function")
     message = update.message or update.callback_query.message
     chat_id = message.chat.id
     logger.info("[save_pdf:SendStatus] Sending PDF generation status")
-    status_msg = await message.reply_text(" PDF...")
-    folder = "filesdownloaded"
-    logger.info("[save_pdf:CreateDir] Creating filesdownloaded directory")
-    os.makedirs(folder, exist_ok=True)
+    progress = await ProgressReporter.send(message, " PDF...")
     
-    logger.info("[save_pdf:SavePDF] Saving PDF")
-    pdf_path = os.path.join(folder, filename)
-    await page.pdf(path=pdf_path)
-    logger.info(f"[save_pdf:PDFSaved] PDF saved as {pdf_path}")
-    
-    try:
-        logger.info("[save_pdf:UploadPDF] Uploading PDF to user")
-        await status_msg.edit_text("📎 Uploading PDF ...")
-        with open(pdf_path, "rb") as pdf_file:
-            logger.info("[save_pdf:SendDocument] Sending PDF document")
-            await message.reply_document(document=pdf_file, filename=filename, caption="📎 Here is your instruction PDF.")
-            logger.info("[save_pdf:CallMainPassportStatus] Calling main_passport_status")
-            result = await main_passport_status(update, context, page, app_number)
-            if result:
-                logger.info("[save_pdf:SendResult] Sending passport status result")
-                await message.reply_text(result)
-
-            logger.info("[save_pdf:SendStatusPDF] Sending passport status PDF")
-            with open(f"Passport_status_{app_number}.pdf", "rb") as pdf_file:
-                await message.reply_document(pdf_file, caption="Your Appointment report is ready.")
-        logger.info("[save_pdf:SendDone] Sending completion message")
-        await message.reply_text("✅ All done!")
-    finally:
-        logger.info("[save_pdf:Cleanup] Cleaning up PDF files")
-        try:
-            if os.path.exists(pdf_path):
-                logger.info(f"[save_pdf:DeletePDF] Deleting PDF file {pdf_path}")
-                os.remove(pdf_path)
-            if os.path.exists(f"Passport_status_{app_number}.pdf"):
-                logger.info(f"[save_pdf:DeleteStatusPDF] Deleting status PDF file Passport_status_{app_number}.pdf")
-                os.remove(f"Passport_status_{app_number}.pdf")
-        except Exception as e:
-            logger.error(f"[save_pdf:DeleteError] Error deleting file: {e}")
+    logger.info("[save_pdf:RenderPDF] Rendering instruction PDF in memory")
+    instruction_pdf = await page.pdf()
+    logger.info(f"[save_pdf:PDFRendered] Instruction PDF rendered ({len(instruction_pdf)} bytes)")
+
+    logger.info("[save_pdf:StartStatusReport] Preparing appointment report status message")
+    report = await ProgressReporter.send(message, "Loading status page...")
+    await progress.update("📎 Uploading PDF ...")
+
+    logger.info("[save_pdf:RunParallel] Uploading instruction PDF, fetching report and resetting page concurrently")
+    async with session_registry.lease(chat_id) as session:
+        if session is None:
+            # The session expired or its browser went away; the shared status browser still works
+            logger.info("[save_pdf:NoSession] Session gone, fetching report with the shared status browser")
+            status_fetch = status_lookup_browser.fetch(app_number)
+        else:
+            status_fetch = fetch_status_on_secondary_context(session.browser, app_number, progress=report.update)
+        upload_result, status_result, reset_result = await asyncio.gather(
+            message.reply_document(
+                document=instruction_pdf,
+                filename=filename,
+                caption="📎 Here is your instruction PDF."
+            ),
+            status_fetch,
+            reset_booking_page(page),
+            return_exceptions=True
+        )
+    if isinstance(upload_result, Exception):
+        raise upload_result
+    if isinstance(reset_result, Exception):
+        logger.error(f"[save_pdf:ResetError] Error resetting booking page: {reset_result}")
+
+    if status_result and not isinstance(status_result, Exception):
+        status_cache.store(app_number, status_result)
+    if isinstance(status_result, Exception) or not status_result:
+        logger.error(f"[save_pdf:StatusError] Appointment report unavailable: {status_result}")
+        await report.finish("❌ Appointment report is not available yet. Use Check Passport Status later.")
+    else:
+        status_text, status_pdf = status_result
+        await report.finish("PDF generated successfully.")
+        logger.info("[save_pdf:SendResult] Sending passport status result")
+        await message.reply_text(status_text)
+        logger.info("[save_pdf:SendStatusPDF] Sending passport status PDF")
+        await message.reply_document(
+            document=status_pdf,
+            filename=pdf_document_name(chat_id, "Passport_status_", app_number),
+            caption="Your Appointment report is ready."
+        )
+    context.user_data.pop("checkpoints", None)
+    logger.info("[save_pdf:SendDone] Sending completion message")
+    await message.reply_text("✅ All done!")
     
-    logger.info("[save_pdf:SendThankYou] Sending thank you message")
-    await message.reply_text("Thank you for using the Ethiopian Passport Booking Bot!")
-    logger.info("[save_pdf:SendSupport] Sending support contact message")
-    await message.reply_text("If you need further assistance, please contact support.")
-    logger.info("[save_pdf:CallNewOrCheck] Calling new_or_check function")
-    return await new_or_check(update, context)
+    with outbound_priority(PRIORITY_BULK):
+        logger.info("[save_pdf:SendThankYou] Sending thank you message")
+        await message.reply_text("Thank you for using the Ethiopian Passport Booking Bot!")
+        logger.info("[save_pdf:SendSupport] Sending support contact message")
+        await message.reply_text("If you need further assistance, please contact support.")
+    if isinstance(reset_result, Exception):
+        logger.info("[save_pdf:CallNewOrCheck] Retrying page reset through new_or_check")
+        return await new_or_check(update, context)
+    await send_after_start_menu(message)
+    logger.info("[save_pdf:Return] Returning AFTER_START state")
+    return AFTER_START
 
-async def new_or_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    logger.info("[new_or_check:Start] Entering new_or_check function")
-    message = update.message or update.callback_query.message
-    chat_id = message.chat.id
-    page = active_sessions[chat_id]['page']
-    logger.info("[new_or_check:NavigateStatus] Navigating to Status page")
+async def reset_booking_page(page):
+    logger.info("[reset_booking_page:NavigateStatus] Navigating to Status page")
     await page.click('a[href="/Status"]')
-    logger.info("[new_or_check:NavigateRequest] Navigating to request-appointment page")
+    logger.info("[reset_booking_page:NavigateRequest] Navigating to request-appointment page")
     await page.click('a[href="/request-appointment"]')
-    logger.info("[new_or_check:WaitForCheckbox] Waiting for defaultChecked2 checkbox")
-    await page.wait_for_selector("label[for='defaultChecked2']", timeout=30000)
-    logger.info("[new_or_check:ClickCheckbox] Clicking defaultChecked2 checkbox")
-    await page.click("label[for='defaultChecked2']")
-    logger.info("[new_or_check:ClickCard] Clicking card link")
-    await page.click(".card--link")
-    logger.info("[new_or_check:SendOptions] Sending new or check options")
+    await accept_appointment_terms(page)
+
+async def send_after_start_menu(message):
+    session_registry.touch(message.chat.id, "menu")
+    logger.info("[send_after_start_menu:SendOptions] Sending new or check options")
     await message.reply_text(
         "Please choose an option:",
         reply_markup=InlineKeyboardMarkup([
@@ -1189,6 +3283,29 @@ async def new_or_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         ])
     )
 
+async def leave_after_retries(update: Update, context: ContextTypes.DEFAULT_TYPE, text) -> int:
+    logger.info("[leave_after_retries:Start] Retry budget spent, returning user to the menu")
+    message = update.message or update.callback_query.message
+    chat_id = message.chat.id
+    retry_engine.reset(context.user_data)
+    context.user_data.pop("checkpoints", None)
+    await message.reply_text(text)
+    try:
+        return await new_or_check(update, context)
+    except Exception as e:
+        logger.error(f"[leave_after_retries:ResetError] Could not reset booking page: {str(e)}")
+        await session_registry.release(chat_id, "retry_exhausted")
+        await message.reply_text("Please /start again in a few minutes.")
+        return ConversationHandler.END
+
+async def new_or_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    logger.info("[new_or_check:Start] Entering new_or_check function")
+    message = update.message or update.callback_query.message
+    chat_id = message.chat.id
+    page = session_registry.page(chat_id)
+    await reset_booking_page(page)
+    await send_after_start_menu(message)
+
     logger.info("[new_or_check:Return] Returning AFTER_START state")
     return AFTER_START
 
@@ -1214,67 +3331,461 @@ async def after_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         logger.info("[after_start:ReturnInvalid] Returning AFTER_START state")
         return AFTER_START
 
+async def launch_browser_page():
+    logger.info("[launch_browser_page:StartPlaywright] Starting playwright")
+    playwright = await async_playwright().start()
+    try:
+        logger.info("[launch_browser_page:LaunchBrowser] Launching browser")
+        browser = await playwright.chromium.launch(headless=True, args=BROWSER_LAUNCH_ARGS)
+        logger.info("[launch_browser_page:CreatePage] Creating browser context and page")
+        page = await (await new_portal_context(browser)).new_page()
+    except Exception:
+        await playwright.stop()
+        raise
+    timeout_policy.apply(page)
+    return playwright, browser, page
+
+async def open_appointment_page(page):
+    # Returns the page title; navigation outcomes feed the portal breaker
+    navigation_started = time.perf_counter()
+    try:
+        with timeout_policy.deadline("navigation") as timeout:
+            await page.goto(f"{PORTAL_URL}/request-appointment", wait_until="load", timeout=timeout)
+        logger.info("[open_appointment_page:GetTitle] Retrieving page title")
+        title = await page.title()
+    except Exception as e:
+        portal_breaker.record_failure(f"start: {str(e)}")
+        raise
+    logger.info(f"[open_appointment_page:PageTitle] Page title: {title}")
+    if "service unavailable" in title.lower():
+        portal_breaker.record_failure("start: service unavailable")
+    else:
+        portal_breaker.record_success(time.perf_counter() - navigation_started)
+    return title
+
+async def accept_appointment_terms(page):
+    logger.info("[accept_appointment_terms:WaitForCheckbox] Waiting for defaultChecked2 checkbox")
+    with timeout_policy.deadline("start_checkbox") as timeout:
+        await page.wait_for_selector("label[for='defaultChecked2']", timeout=timeout)
+    logger.info("[accept_appointment_terms:ClickCheckbox] Clicking defaultChecked2 checkbox")
+    await page.click("label[for='defaultChecked2']")
+    logger.info("[accept_appointment_terms:ClickCard] Clicking card link")
+    await page.click(".card--link")
+
+# Cold start. A small pool of browsers already sitting on the appointment page is
+# kept ready for /start and recovery; entries older than BROWSER_POOL_MAX_AGE_S are
+# navigated again before use, since the portal expires idle pages. At boot the
+# warm-up imports Playwright, fills the pool, builds the calendar tables and probes
+# the portal concurrently; readiness (/readyz) waits for it so rolling deploys only
+# route traffic to warm replicas. BROWSER_POOL_SIZE=0 disables the pool.
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "1"))
+BROWSER_POOL_MAX_AGE_S = float(os.getenv("BROWSER_POOL_MAX_AGE_S", "300"))
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "1") != "0"
+STARTUP_WARMUP_TIMEOUT_S = float(os.getenv("STARTUP_WARMUP_TIMEOUT_S", "60"))
+
+class StartupClock:
+    # Milliseconds since PROCESS_STARTED for each startup milestone, recorded once
+    def __init__(self, started):
+        self.started = started
+        self.marks = {}
+
+    def mark(self, name, at=None):
+        if name in self.marks:
+            return False
+        self.marks[name] = round(((at or time.perf_counter()) - self.started) * 1000)
+        logger.info(f"[StartupClock:Mark] {name} at {self.marks[name]}ms after process start")
+        return True
+
+    def stats(self):
+        return dict(self.marks)
+
+startup_clock = StartupClock(PROCESS_STARTED)
+startup_clock.mark("imports", IMPORTS_FINISHED)
+
+class BrowserPool:
+    def __init__(self, size, max_age):
+        self.size = size
+        self.max_age = max_age
+        self._entries = deque()
+        self._filling = None
+        self.launched = 0
+        self.hits = 0
+        self.misses = 0
+        self.renavigated = 0
+        self.discarded = 0
+
+    async def _launch(self):
+        playwright, browser, page = await launch_browser_page()
+        try:
+            title = await open_appointment_page(page)
+            if "service unavailable" in title.lower():
+                raise RuntimeError("portal returned Service unavailable")
+        except BaseException:
+            await self._close((None, playwright, browser, page))
+            raise
+        self.launched += 1
+        return time.monotonic(), playwright, browser, page
+
+    async def _close(self, entry):
+        _, playwright, browser, _ = entry
+        for close in (functools.partial(close_browser, browser), playwright.stop):
+            with contextlib.suppress(Exception):
+                await close()
+
+    async def fill(self):
+        while len(self._entries) < self.size and portal_breaker.state != CircuitBreaker.OPEN:
+            try:
+                entry = await self._launch()
+            except Exception as e:
+                logger.error(f"[BrowserPool:FillError] {str(e)}")
+                return
+            self._entries.append(entry)
+            logger.info(f"[BrowserPool:Filled] {len(self._entries)}/{self.size} browsers ready")
+
+    def refill(self):
+        if self.size > 0 and (self._filling is None or self._filling.done()):
+            self._filling = asyncio.create_task(self.fill())
+
+    async def take(self):
+        # Returns (playwright, browser, page, title), or None when nothing usable is pooled
+        while self._entries:
+            entry = self._entries.popleft()
+            created, playwright, browser, page = entry
+            try:
+                if not browser.is_connected():
+                    raise RuntimeError("browser disconnected")
+                if time.monotonic() - created > self.max_age:
+                    self.renavigated += 1
+                    title = await open_appointment_page(page)
+                else:
+                    title = await page.title()
+                    # Handing out a loaded page settles a half-open trial like a navigation would;
+                    # otherwise the trial is only freed after BREAKER_TRIAL_TIMEOUT_S
+                    if "service unavailable" in title.lower():
+                        portal_breaker.record_failure("start: service unavailable")
+                    else:
+                        portal_breaker.record_success()
+            except Exception as e:
+                logger.error(f"[BrowserPool:Discard] Pooled browser unusable: {str(e)}")
+                self.discarded += 1
+                await self._close(entry)
+                continue
+            self.hits += 1
+            self.refill()
+            return playwright, browser, page, title
+        self.misses += 1
+        self.refill()
+        return None
+
+    async def close(self):
+        if self._filling:
+            self._filling.cancel()
+            await asyncio.gather(self._filling, return_exceptions=True)
+        while self._entries:
+            await self._close(self._entries.popleft())
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "ready": len(self._entries),
+            "launched": self.launched,
+            "hits": self.hits,
+            "misses": self.misses,
+            "renavigated": self.renavigated,
+            "discarded": self.discarded,
+        }
+
+browser_pool = BrowserPool(BROWSER_POOL_SIZE, BROWSER_POOL_MAX_AGE_S)
+
+async def acquire_appointment_page():
+    pooled = await browser_pool.take()
+    if pooled:
+        logger.info("[acquire_appointment_page:Pooled] Using a pre-launched browser")
+        return pooled
+    playwright, browser, page = await launch_browser_page()
+    try:
+        title = await open_appointment_page(page)
+    except BaseException:
+        for close in (browser.close, playwright.stop):
+            with contextlib.suppress(Exception):
+                await close()
+        raise
+    return playwright, browser, page, title
+
+class StartupWarmup:
+    def __init__(self):
+        self.done = asyncio.Event()
+        self.steps = {}
+        self.failed = []
+        self._task = None
+
+    async def _step(self, name, func):
+        started = time.perf_counter()
+        try:
+            await func()
+        except Exception as e:
+            logger.error(f"[StartupWarmup:StepFailed] {name}: {str(e)}")
+            self.failed.append(name)
+        self.steps[name] = round((time.perf_counter() - started) * 1000)
+        logger.info(f"[StartupWarmup:Step] {name} took {self.steps[name]}ms")
+
+    async def _browsers(self):
+        await blocking_executor.run("warmup", importlib.import_module, "playwright.async_api")
+        await browser_pool.fill()
+
+    async def _calendar(self):
+        await blocking_executor.run("warmup", ethiopian_calendar._tables)
+
+    async def _summary_parser(self):
+        await blocking_executor.run("warmup", importlib.import_module, "bs4")
+
+    async def _portal_probe(self):
+        if PORTAL_REPLAY_ARCHIVE:
+            return
+        async with httpx.AsyncClient(timeout=portal_prober.timeout, follow_redirects=True) as client:
+            await portal_prober.probe(client)
+
+    async def _run(self):
+        steps = [
+            self._step("browsers", self._browsers),
+            self._step("calendar", self._calendar),
+            self._step("summary_parser", self._summary_parser),
+            self._step("portal_probe", self._portal_probe),
+        ]
+        try:
+            await asyncio.wait_for(asyncio.gather(*steps), STARTUP_WARMUP_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            logger.error(f"[StartupWarmup:Timeout] Warm-up still running after {STARTUP_WARMUP_TIMEOUT_S:g}s, reporting ready")
+            self.failed.append("timeout")
+        # Ready even if a step failed: a down portal must not keep every replica out of rotation
+        self.done.set()
+        startup_clock.mark("warm")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def wait(self, timeout):
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self.done.wait(), timeout)
+
+    def stats(self):
+        return {"ready": self.done.is_set(), "steps_ms": dict(self.steps), "failed": list(self.failed)}
+
+startup_warmup = StartupWarmup()
+
+def watch_session(application, session):
+    # A crashed page takes its browser down; a lost browser releases the session and,
+    # mid-booking, starts rebuilding it from the checkpoint log
+    async def browser_lost(_):
+        lost = await session_registry.browser_lost(session.browser_id)
+        for chat_id in lost:
+            if booking_recovery.recoverable(application.user_data.get(chat_id, {})):
+                booking_recovery.schedule(chat_id, application)
+
+    session.browser.on("disconnected", lambda _: asyncio.create_task(browser_lost(_)))
+    session.page.on("crash", lambda _: asyncio.create_task(session.browser.close()))
+
+# Rebuilding a lost booking page: a fresh browser is driven through the checkpoint
+# log without asking the user anything. Steps are replayed in batches, one per portal
+# page, with a settle wait only where the portal navigates. Nothing past payment is
+# ever replayed, so a recovery cannot submit a second booking.
+RECOVERY_PAGE_BREAKS = {"booking_form", "calendar", "date", "slot", "personal", "address", "documents"}
+RECOVERY_TERMINAL_STEPS = {"payment"}
+RECOVERY_TIMEOUT_S = float(os.getenv("RECOVERY_TIMEOUT_S", "120"))
+
+def replay_batches(checkpoints):
+    batch = []
+    for step, payload in checkpoints:
+        batch.append((step, payload))
+        if step in RECOVERY_PAGE_BREAKS:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class BookingRecovery:
+    def __init__(self, timeout_s):
+        self.timeout_s = timeout_s
+        self.tasks = {}
+        self.counters = Counter()
+        self.recover_ms = deque(maxlen=200)
+
+    def recoverable(self, user_data):
+        checkpoints = user_data.get("checkpoints") or []
+        return bool(checkpoints) and checkpoints[-1][0] not in RECOVERY_TERMINAL_STEPS
+
+    def schedule(self, chat_id, application):
+        task = self.tasks.get(chat_id)
+        if task is None:
+            task = asyncio.create_task(self._guarded(chat_id, application))
+            self.tasks[chat_id] = task
+            task.add_done_callback(lambda _: self.tasks.pop(chat_id, None))
+        return task
+
+    async def recover(self, chat_id, application) -> bool:
+        return await asyncio.shield(self.schedule(chat_id, application))
+
+    async def _guarded(self, chat_id, application) -> bool:
+        started = time.perf_counter()
+        try:
+            recovered = await asyncio.wait_for(self._run(chat_id, application), self.timeout_s)
+        except Exception as e:
+            logger.error(f"[BookingRecovery:Failed] Could not rebuild booking page for chat_id {chat_id}: {str(e)}")
+            self.counters["failed"] += 1
+            return False
+        if recovered:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.recover_ms.append(elapsed_ms)
+            self.counters["recovered"] += 1
+            logger.info(f"[BookingRecovery:Recovered] chat_id {chat_id} back at its last checkpoint in {elapsed_ms:.0f}ms")
+        return recovered
+
+    async def _run(self, chat_id, application) -> bool:
+        user_data = application.user_data.get(chat_id, {})
+        checkpoints = user_data.get("checkpoints")
+        seq = user_data.get("checkpoint_seq")
+        if not self.recoverable(user_data):
+            self.counters["refused"] += 1
+            return False
+        if not portal_breaker.allow():
+            logger.error(f"[BookingRecovery:BreakerOpen] Portal breaker open, not recovering chat_id {chat_id}")
+            self.counters["refused"] += 1
+            return False
+        await session_registry.release(chat_id, "recovering")
+
+        logger.info(f"[BookingRecovery:Start] Replaying {len(checkpoints)} checkpoints for chat_id {chat_id}")
+        playwright, browser, page, title = await acquire_appointment_page()
+        session = BrowserSession(chat_id, playwright, browser, page, state="recovering")
+        try:
+            if "service unavailable" in title.lower():
+                raise RuntimeError("portal returned Service unavailable")
+            await accept_appointment_terms(page)
+            await self._restore_uploads(session, user_data, application.bot)
+            for batch in replay_batches(list(checkpoints)):
+                batch_started = time.perf_counter()
+                for step, payload in batch:
+                    await self._apply(page, step, payload, user_data, session.uploads)
+                self.counters["steps_replayed"] += len(batch)
+                logger.info(
+                    f"[BookingRecovery:Batch] chat_id {chat_id} replayed {', '.join(step for step, _ in batch)} "
+                    f"in {(time.perf_counter() - batch_started) * 1000:.0f}ms"
+                )
+        except BaseException:
+            for close in (functools.partial(close_browser, browser), playwright.stop):
+                with contextlib.suppress(Exception):
+                    await close()
+            raise
+
+        moved_on = user_data.get("checkpoints") is not checkpoints or user_data.get("checkpoint_seq") != seq
+        if moved_on or chat_id in session_registry:
+            # The user restarted while we were replaying; their new session wins
+            logger.info(f"[BookingRecovery:Superseded] chat_id {chat_id} moved on during recovery")
+            await close_browser(browser)
+            await playwright.stop()
+            self.counters["superseded"] += 1
+            return False
+        session_registry.register(session)
+        session_registry.touch(chat_id, "booking")
+        watch_session(application, session)
+        return True
+
+    async def _restore_uploads(self, session, user_data, bot):
+        for unique_id, ref in user_data.get("upload_refs", {}).items():
+            logger.info(f"[BookingRecovery:Download] Downloading {ref['name']} again")
+            tg_file = await bot.get_file(ref["file_id"])
+            buffer = await tg_file.download_as_bytearray()
+            session.uploads[unique_id] = {"name": ref["name"], "mimeType": ref["mimeType"], "buffer": bytes(buffer)}
+
+    async def _apply(self, page, step, payload, user_data, uploads):
+        if step == "booking_form":
+            await open_booking_form(page)
+        elif step == "location":
+            await select_location_option(page, payload["index"], payload["value"])
+        elif step == "calendar":
+            await open_calendar(page)
+        elif step == "date":
+            await click_calendar_day(page, payload["label"])
+        elif step == "slot":
+            await click_time_slot(page, payload)
+            await submit_time_slot(page)
+        elif step == "dropdown":
+            await page.select_option(payload["selector"], payload["value"])
+        elif step == "personal":
+            await fill_personal_form(page, user_data)
+            await submit_personal_form(page, user_data)
+        elif step == "address":
+            await submit_address_form(page, user_data)
+        elif step == "documents":
+            await upload_documents(page, uploads, user_data)
+        else:
+            raise ValueError(f"cannot replay checkpoint {step}")
+
+    def stats(self) -> dict:
+        samples = list(self.recover_ms)
+        return {
+            "in_progress": len(self.tasks),
+            "recover_p50_ms": round(percentile(samples, 50)),
+            "recover_p95_ms": round(percentile(samples, 95)),
+            "recover_last_ms": round(samples[-1]) if samples else 0,
+            **self.counters,
+        }
+
+booking_recovery = BookingRecovery(RECOVERY_TIMEOUT_S)
+
+async def recovery_gate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Runs before every handler: a booking whose page is gone is rebuilt first
+    chat = update.effective_chat
+    if chat is None or context.user_data is None or not context.user_data.get("checkpoints"):
+        return
+    message = update.effective_message
+    if message and message.text and message.text.split()[0] in ("/start", "/cancel"):
+        return
+    session = session_registry.get(chat.id)
+    if session and not session.page.is_closed():
+        return
+
+    logger.info(f"[recovery_gate:Recover] Booking page lost for chat_id {chat.id}, rebuilding it")
+    if await booking_recovery.recover(chat.id, context.application):
+        return
+    past_payment = not booking_recovery.recoverable(context.user_data)
+    context.user_data.pop("checkpoints", None)
+    if message:
+        await message.reply_text(
+            "⚠️ The portal page was lost after your booking was submitted. "
+            "Use Check Passport Status to get your appointment report."
+            if past_payment else
+            "⚠️ The portal page was lost and could not be restored. Please /start again."
+        )
+    raise ApplicationHandlerStop
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[start:Start] Entering start function")
+    started = time.perf_counter()
     message = update.message or update.callback_query.message
     chat_id = message.chat.id
+    if not portal_breaker.allow():
+        logger.error("[start:BreakerOpen] Portal breaker open, answering without a browser")
+        await message.reply_text(portal_breaker.unavailable_text())
+        return ConversationHandler.END
     logger.info("[start:SendStatus] Sending initializing session message")
-    status_msg = await message.reply_text("Initializing session...")
+    progress = await ProgressReporter.send(message, "Initializing session...")
     
     logger.info("[start:CleanupSession] Cleaning up existing session if any")
-    if chat_id in active_sessions:
-        if 'page' in active_sessions[chat_id]:
-            logger.info("[start:ClosePage] Closing existing page")
-            await active_sessions[chat_id]['page'].close()
-        if 'browser' in active_sessions[chat_id]:
-            logger.info("[start:CloseBrowser] Closing existing browser")
-            await active_sessions[chat_id]['browser'].close()
-        if 'playwright' in active_sessions[chat_id]:
-            logger.info("[start:StopPlaywright] Stopping existing playwright")
-            await active_sessions[chat_id]['playwright'].stop()
-        logger.info("[start:DeleteSession] Deleting session from active_sessions")
-        del active_sessions[chat_id]
+    await session_registry.release(chat_id, "restart")
     
     try:
-        logger.info("[start:StartPlaywright] Starting playwright")
-        playwright = await async_playwright().start()
         logger.info("[start:LaunchBrowser] Launching browser")
-        await status_msg.edit_text("⚡Launching browser...")
-        browser = await playwright.chromium.launch(
-            headless=True,
-            args=[
-                '--no-sandbox',
-                '--disable-setuid-sandbox',
-                '--disable-dev-shm-usage',
-                '--single-process',
-                '--disable-gpu',
-                '--no-zygote',
-                '--disable-accelerated-2d-canvas',
-                '--disable-gpu-rasterization'
-            ]
-        )
-
-        logger.info("[start:CreateContext] Creating new browser context")
-        browser_context = await browser.new_context()
-        logger.info("[start:CreatePage] Creating new page")
-        page = await browser_context.new_page()
-        logger.info("[start:SetTimeouts] Setting page timeouts")
-        page.set_default_timeout(120000)
-        page.set_default_navigation_timeout(120000)
-        
-        logger.info("[start:Navigate] Navigating to request-appointment page")
-        await page.goto("https://www.ethiopianpassportservices.gov.et/request-appointment", wait_until="load")
-        
-        logger.info("[start:GetTitle] Retrieving page title")
-        title = await page.title()
-        logger.info(f"[start:PageTitle] Page title: {title}")
-        await status_msg.edit_text("⚡Browser launched. Please wait...")
-        await status_msg.edit_text("⚡Loading page...")
+        await progress.update("⚡Launching browser...")
+        playwright, browser, page, title = await acquire_appointment_page()
+        page_ready_ms = (time.perf_counter() - started) * 1000
+        await progress.update("⚡Browser launched. Please wait...")
+        await progress.update("⚡Loading page...")
         
         # Check for service unavailable
         if "service unavailable" in title.lower():
             logger.error("[start:ServiceUnavailable] Website returned Service unavailable")
-            await status_msg.edit_text("❌ The passport service website is currently unavailable. Please try again later.")
+            await progress.finish("❌ The passport service website is currently unavailable. Please try again later.")
             logger.info("[start:CleanupOnError] Cleaning up browser session")
             await page.close()
             await browser.close()
@@ -1282,38 +3793,29 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             logger.info("[start:ReturnError] Returning ConversationHandler.END")
             return ConversationHandler.END
 
-        logger.info("[start:StoreSession] Storing session in active_sessions")
-        active_sessions[chat_id] = {
-            'playwright': playwright,
-            'browser': browser,
-            'page': page,
-            'last_active': datetime.now()
-        }
+        logger.info("[start:StoreSession] Registering browser session")
+        session = BrowserSession(chat_id, playwright, browser, page)
+        session_registry.register(session)
+        watch_session(context.application, session)
         
-        logger.info("[start:WaitForCheckbox] Waiting for defaultChecked2 checkbox")
         try:
-            await page.wait_for_selector("label[for='defaultChecked2']", timeout=60000)  # Reduced timeout
-            logger.info("[start:ClickCheckbox] Clicking defaultChecked2 checkbox")
-            await page.click("label[for='defaultChecked2']")
-            logger.info("[start:ClickCard] Clicking card link")
-            await page.click(".card--link")
+            await accept_appointment_terms(page)
             logger.info("[start:UpdateStatus] Updating status message")
-            await status_msg.edit_text("⚡Page loaded. Please wait...")
+            await progress.update("⚡Page loaded. Please wait...")
         except Exception as e:
             logger.error(f"[start:CheckboxError] Error waiting for checkbox: {str(e)}")
-            await status_msg.edit_text("❌ Failed to load the appointment page. Please try again later.")
+            await progress.finish("❌ Failed to load the appointment page. Please try again later.")
             logger.info("[start:CleanupOnCheckboxError] Cleaning up browser session")
-            await page.close()
-            await browser.close()
-            await playwright.stop()
+            await session_registry.release(chat_id, "start_failed")
             logger.info("[start:ReturnCheckboxError] Returning ConversationHandler.END")
             return ConversationHandler.END
         
         logger.info("[start:ClearUserData] Clearing user data")
         context.user_data.clear()
         
+        session_registry.touch(chat_id, "menu")
         logger.info("[start:SendWelcome] Sending welcome message")
-        await status_msg.edit_text("Welcome to the Ethiopian Passport Booking Bot!")
+        await progress.finish("Welcome to the Ethiopian Passport Booking Bot!")
         logger.info("[start:SendOptions] Sending main menu options")
         await message.reply_text(
             "Please choose an option:",
@@ -1323,6 +3825,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
                 [InlineKeyboardButton("ℹ️ Help", callback_data="help")]
             ])
         )
+        if startup_clock.mark("first_response"):
+            logger.info(
+                f"[start:FirstResponse] First /start answered in {(time.perf_counter() - started) * 1000:.0f}ms "
+                f"(portal page ready after {page_ready_ms:.0f}ms)"
+            )
 
         logger.info("[start:Return] Returning MAIN_MENU state")
         return MAIN_MENU
@@ -1330,12 +3837,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         logger.error(f"[start:Error] Error initializing session: {str(e)}")
         await message.reply_text(f"❌ Error initializing session: {str(e)}")
         logger.info("[start:CleanupOnGeneralError] Cleaning up browser session")
-        if 'page' in locals():
-            await page.close()
-        if 'browser' in locals():
-            await browser.close()
-        if 'playwright' in locals():
-            await playwright.stop()
+        if not await session_registry.release(chat_id, "start_failed"):
+            if 'page' in locals():
+                await page.close()
+            if 'browser' in locals():
+                await browser.close()
+            if 'playwright' in locals():
+                await playwright.stop()
         logger.info("[start:ReturnError] Returning ConversationHandler.END")
         return ConversationHandler.END
     
@@ -1347,8 +3855,7 @@ async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     chat_id = query.message.chat.id
     
     logger.info("[main_menu_handler:UpdateLastActive] Updating last active time")
-    if chat_id in active_sessions:
-        active_sessions[chat_id]['last_active'] = datetime.now()
+    session_registry.touch(chat_id)
     
     if query.data == "book_appointment":
         logger.info("[main_menu_handler:BookAppointment] Handling book_appointment option")
@@ -1375,28 +3882,32 @@ async def new_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     message = update.message or update.callback_query.message
     chat_id = message.chat.id
     
-    if chat_id not in active_sessions:
+    if chat_id not in session_registry:
         logger.error("[new_appointment:SessionExpired] Session expired")
         await message.reply_text("❌ Session expired. Please /start again.")
         logger.info("[new_appointment:ReturnExpired] Returning ConversationHandler.END")
         return ConversationHandler.END
+
+    if not portal_breaker.allow():
+        logger.error("[new_appointment:BreakerOpen] Portal breaker open, not starting a booking")
+        await message.reply_text(portal_breaker.unavailable_text())
+        await send_after_start_menu(message)
+        return AFTER_START
     
     try:
         logger.info("[new_appointment:ResetDropdown] Resetting dropdown step")
         context.user_data["dropdown_step"] = 0
-        page = active_sessions[chat_id]['page']
-        logger.info("[new_appointment:UpdateLastActive] Updating last active time")
-        active_sessions[chat_id]['last_active'] = datetime.now()
-        
-        logger.info("[new_appointment:WaitLoad] Waiting for page to load")
-        await page.wait_for_load_state('networkidle')
-        logger.info("[new_appointment:WaitSelector] Waiting for teal card selector")
-        await page.wait_for_selector(".card--teal.flex.flex--column", state='visible', timeout=60000)
-        
-        logger.info("[new_appointment:ClickCard] Clicking teal card")
-        await page.evaluate('''() => {
-            document.querySelector('.card--teal.flex.flex--column').click();
-        }''')
+        retry_engine.reset(context.user_data)
+        context.user_data["checkpoints"] = []
+        context.user_data.pop("upload_refs", None)
+        page = session_registry.page(chat_id)
+        logger.info("[new_appointment:UpdateLastActive] Marking session as booking")
+        session_registry.touch(chat_id, "booking")
+
+        logger.info("[new_appointment:OpenForm] Opening the booking form")
+        await retry_engine.run("booking_form", open_booking_form, page)
+        portal_breaker.record_success()
+        checkpoint(context.user_data, "booking_form")
         
         logger.info("[new_appointment:SendReady] Sending ready message")
         await message.reply_text("✅ Ready! Let's begin your appointment booking.")
@@ -1404,76 +3915,117 @@ async def new_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return await ask_region(update, context)
     except Exception as e:
         logger.error(f"[new_appointment:Error] Error starting appointment: {str(e)}")
-        await message.reply_text(f"❌ Error starting appointment: {str(e)}")
-        logger.info("[new_appointment:CallMainMenu] Calling main_menu_handler function")
-        return await main_menu_handler(update, context)
+        portal_breaker.record_failure(f"new_appointment: {str(e)}")
+        return await leave_after_retries(update, context, "❌ Could not open the booking form. Please try again later.")
 
-async def main_passport_status(update: Update, context: ContextTypes.DEFAULT_TYPE, page, application_number) -> str:
-    logger.info("[main_passport_status:Start] Entering main_passport_status function")
-    message = update.message or update.callback_query.message
-    logger.info("[main_passport_status:SendStatus] Sending status page loading message")
-    status_msg = await message.reply_text("Loading status page...")
-    logger.info("[main_passport_status:ClickStatus] Clicking Status link")
-    await page.click('a[href="/Status"]')
-    logger.info("[main_passport_status:UpdateStatus] Updating status message")
-    await status_msg.edit_text("⚡Page loaded. Please wait...")
-    logger.info("[main_passport_status:WaitForInput] Waiting for application number input")
-    await page.wait_for_selector('input[placeholder="Application Number"]', timeout=5000)
-    logger.info("[main_passport_status:UpdateStatusInput] Updating status for filling application number")
-    await status_msg.edit_text("Filling application number...")
-    logger.info(f"[main_passport_status:FillInput] Filling application number: {application_number}")
+async def fetch_passport_status(page, application_number, progress=None):
+    logger.info("[fetch_passport_status:Start] Entering fetch_passport_status function")
+
+    async def report(text):
+        if progress:
+            await progress(text)
+
+    logger.info("[fetch_passport_status:WaitForInput] Waiting for application number input")
+    with timeout_policy.deadline("status_input") as timeout:
+        await page.wait_for_selector('input[placeholder="Application Number"]', timeout=timeout)
+    await report("Filling application number...")
+    logger.info(f"[fetch_passport_status:FillInput] Filling application number: {application_number}")
     await page.fill('input[placeholder="Application Number"]', application_number)
-    logger.info("[main_passport_status:UpdateStatusCheck] Updating status for checking data")
-    await status_msg.edit_text("checking data...")
+    await report("checking data...")
 
-    logger.info("[main_passport_status:ClickSearch] Clicking Search button")
+    logger.info("[fetch_passport_status:ClickSearch] Clicking Search button")
     await page.click('button:has-text("Search")')
-    logger.info("[main_passport_status:WaitAfterSearch] Waiting after clicking Search")
-    await page.wait_for_timeout(5000)
-    
-    logger.info("[main_passport_status:CheckDataNotFound] Checking for data not found message")
-    if await page.locator('text=Data not Found. Please Make sure You have Paid the Request.').is_visible():
-        logger.error("[main_passport_status:DataNotFound] Invalid Application Number")
-        await status_msg.edit_text("❌ Invalid Application Number. Please try again.")
-        logger.info("[main_passport_status:CallAskApplicationNumber] Calling ask_application_number function")
-        return await ask_application_number(update, context)  
+    logger.info("[fetch_passport_status:WaitForResult] Waiting for result card or not-found message")
+    not_found = page.get_by_text(STATUS_NOT_FOUND_TEXT)
+    with timeout_policy.deadline("status_result") as timeout:
+        await page.locator('a.card--link').or_(not_found).first.wait_for(timeout=timeout)
 
-    logger.info("[main_passport_status:WaitForCard] Waiting for card link selector")
-    await page.wait_for_selector('a.card--link', timeout=5000)
-    logger.info("[main_passport_status:GetCard] Retrieving card link element")
+    logger.info("[fetch_passport_status:CheckDataNotFound] Checking for data not found message")
+    if await not_found.is_visible():
+        logger.error("[fetch_passport_status:DataNotFound] Invalid Application Number")
+        return None
+
+    logger.info("[fetch_passport_status:GetCard] Retrieving card link element")
     card = await page.query_selector('a.card--link')
-    logger.info("[main_passport_status:GetCardText] Extracting card text content")
+    logger.info("[fetch_passport_status:GetCardText] Extracting card text content")
     text_content = await card.inner_text()
-    logger.info("[main_passport_status:FindEyeButton] Locating eye button")
+    logger.info("[fetch_passport_status:FindEyeButton] Locating eye button")
     eye_button = await card.query_selector('div i.fa-eye')
-    if eye_button:
-        logger.info("[main_passport_status:ClickEyeButton] Clicking eye button")
-        await eye_button.click()
-    else:
-        logger.error("[main_passport_status:NoEyeButton] Eye icon not found")
-        await status_msg.edit_text("❌ Invalid Application Number. Please try again.")
-        logger.info("[main_passport_status:CallAskApplicationNumberNoEye] Calling ask_application_number function")
-        return await ask_application_number(update, context)
+    if not eye_button:
+        logger.error("[fetch_passport_status:NoEyeButton] Eye icon not found")
+        return None
+    logger.info("[fetch_passport_status:ClickEyeButton] Clicking eye button")
+    await eye_button.click()
+    logger.info("[fetch_passport_status:WaitAfterEyeClick] Waiting for the report to settle")
+    with timeout_policy.deadline("network_idle") as timeout:
+        await page.wait_for_load_state("networkidle", timeout=timeout)
+
+    await report("Generating PDF...")
+    logger.info("[fetch_passport_status:CallGeneratePDF] Calling generate_official_pdf function")
+    pdf_bytes = await generate_official_pdf(page, application_number)
+    logger.info("[fetch_passport_status:ReturnResult] Returning extracted text content and PDF")
+    return text_content.strip(), pdf_bytes
+
+async def fetch_status_on_secondary_context(browser, application_number, progress=None):
+    logger.info("[fetch_status_on_secondary_context:Start] Opening short-lived context for status lookup")
+    browser_context = await new_portal_context(browser)
+    try:
+        page = await browser_context.new_page()
+        timeout_policy.apply(page)
+        logger.info("[fetch_status_on_secondary_context:Navigate] Navigating to Status page")
+        navigation_started = time.perf_counter()
+        try:
+            with timeout_policy.deadline("navigation") as timeout:
+                await page.goto(f"{PORTAL_URL}/Status", wait_until="load", timeout=timeout)
+        except Exception as e:
+            portal_breaker.record_failure(f"status page: {str(e)}")
+            raise
+        portal_breaker.record_success(time.perf_counter() - navigation_started)
+        return await fetch_passport_status(page, application_number, progress)
+    finally:
+        logger.info("[fetch_status_on_secondary_context:Close] Closing secondary context")
+        await close_portal_context(browser, browser_context)
+
+async def main_passport_status(update: Update, context: ContextTypes.DEFAULT_TYPE, page, application_number):
+    logger.info("[main_passport_status:Start] Entering main_passport_status function")
+    message = update.message or update.callback_query.message
+    logger.info("[main_passport_status:SendStatus] Sending status page loading message")
+    progress = await ProgressReporter.send(message, "Loading status page...")
+
+    async def fetch_on_page(number):
+        logger.info("[main_passport_status:ClickStatus] Clicking Status link")
+        await page.click('a[href="/Status"]')
+        logger.info("[main_passport_status:UpdateStatus] Updating status message")
+        await progress.update("⚡Page loaded. Please wait...")
+        logger.info("[main_passport_status:CallFetch] Calling fetch_passport_status function")
+        try:
+            result = await fetch_passport_status(page, number, progress=progress.update)
+        except Exception as e:
+            portal_breaker.record_failure(f"status: {str(e)}")
+            raise
+        portal_breaker.record_success()
+        return result
+
+    logger.info("[main_passport_status:Lookup] Looking up status through the status cache")
+    result = await status_cache.lookup(
+        application_number, lambda number: retry_engine.run("status", fetch_on_page, number)
+    )
+    if not result:
+        await progress.finish("❌ Invalid Application Number. Please try again.")
+        logger.info("[main_passport_status:CallAskApplicationNumber] Calling ask_application_number function")
+        await ask_application_number(update, context)
+        return None
 
-    logger.info("[main_passport_status:WaitAfterEyeClick] Waiting after clicking eye button")
-    await page.wait_for_timeout(3000)
-    logger.info("[main_passport_status:UpdateStatusPDF] Updating status for PDF generation")
-    await status_msg.edit_text("Generating PDF...")
-    logger.info("[main_passport_status:CallGeneratePDF] Calling generate_official_pdf function")
-    await generate_official_pdf(page, application_number)
     logger.info("[main_passport_status:UpdateStatusComplete] Updating status for PDF completion")
-    await status_msg.edit_text("PDF generated successfully.")
-    logger.info("[main_passport_status:ReturnText] Returning extracted text content")
-    return text_content.strip()
+    await progress.finish("PDF generated successfully.")
+    return result
 
 async def generate_official_pdf(page, application_number):
     logger.info("[generate_official_pdf:Start] Entering generate_official_pdf function")
-    logger.info(f"[generate_official_pdf:SavePDF] Saving PDF for application number: {application_number}")
-    await page.pdf(
-        path=f"Passport_status_{application_number}.pdf",
-        print_background=True,
-    )
-    logger.info("[generate_official_pdf:PDFSaved] PDF saved successfully")
+    logger.info(f"[generate_official_pdf:RenderPDF] Rendering PDF for application number: {application_number}")
+    pdf_bytes = await page.pdf(print_background=True)
+    logger.info(f"[generate_official_pdf:PDFRendered] PDF rendered ({len(pdf_bytes)} bytes)")
+    return pdf_bytes
 
 async def ask_application_number(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[ask_application_number:Start] Entering ask_application_number function")
@@ -1483,39 +4035,281 @@ async def ask_application_number(update: Update, context: ContextTypes.DEFAULT_T
     logger.info("[ask_application_number:Return] Returning state 111")
     return 111
 
+
+# Status results are cached per application number, and concurrent lookups for the
+# same number share one portal fetch. None (not found) is cached for a shorter time.
+STATUS_CACHE_TTL_S = float(os.getenv("STATUS_CACHE_TTL_S", "300"))
+STATUS_NEGATIVE_TTL_S = float(os.getenv("STATUS_NEGATIVE_TTL_S", "60"))
+STATUS_CACHE_SIZE = int(os.getenv("STATUS_CACHE_SIZE", "256"))
+# An explicit refresh re-checks the portal unless the cached result is this fresh
+STATUS_REFRESH_MIN_AGE_S = float(os.getenv("STATUS_REFRESH_MIN_AGE_S", "10"))
+
+def normalize_application_number(text):
+    return re.sub(r"[\s-]+", "", text or "").upper()
+
+class StatusCache:
+    def __init__(self, ttl, negative_ttl, max_entries):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def peek(self, application_number, max_age=None):
+        key = normalize_application_number(application_number)
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is None or entry[0] < now or (max_age is not None and now - entry[1] > max_age):
+            return False, None
+        self._entries.move_to_end(key)
+        return True, entry[2]
+
+    def store(self, application_number, result):
+        key = normalize_application_number(application_number)
+        ttl = self.ttl if result else self.negative_ttl
+        now = time.monotonic()
+        self._entries[key] = (now + ttl, now, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def task(self, application_number, fetch):
+        key = normalize_application_number(application_number)
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return task
+        self.misses += 1
+        task = asyncio.create_task(self._fetch(key, application_number, fetch))
+        self._in_flight[key] = task
+        return task
+
+    async def _fetch(self, key, application_number, fetch):
+        try:
+            result = await fetch(application_number)
+            self.store(key, result)
+            return result
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+
+    async def lookup(self, application_number, fetch, max_age=None):
+        found, result = self.peek(application_number, max_age)
+        if found:
+            self.hits += 1
+            return result
+        # Shielded so one cancelled waiter does not abort the fetch others share
+        return await asyncio.shield(self.task(application_number, fetch))
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "in_flight": len(self._in_flight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+        }
+
+status_cache = StatusCache(STATUS_CACHE_TTL_S, STATUS_NEGATIVE_TTL_S, STATUS_CACHE_SIZE)
+
+# Inline mode: "@bot <application number>" answers from the status cache. A miss
+# that does not finish within INLINE_STATUS_WAIT_S is answered with a placeholder
+# that is edited once the lookup completes (needs inline feedback enabled in
+# BotFather for ChosenInlineResult updates; the refresh button works without it).
+# Clients send a query per keystroke, so a miss only reaches the portal once the
+# user has stopped typing for INLINE_DEBOUNCE_S; earlier queries get no results.
+INLINE_STATUS_WAIT_S = float(os.getenv("INLINE_STATUS_WAIT_S", "2.5"))
+INLINE_DEBOUNCE_S = float(os.getenv("INLINE_DEBOUNCE_S", "0.8"))
+INLINE_CACHE_TIME_S = int(os.getenv("INLINE_CACHE_TIME_S", "30"))
+INLINE_LOOKUP_CONCURRENCY = int(os.getenv("INLINE_LOOKUP_CONCURRENCY", "2"))
+APPLICATION_NUMBER_RE = re.compile(r"^[A-Z0-9]{5,24}$")
+inline_latest_query = {}
+
+class StatusLookupBrowser:
+    # One shared browser for lookups that have no chat session behind them
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self._slots = None
+        self._lock = None
+        self._playwright = None
+        self._browser = None
+        self.launches = 0
+        self.fetches = 0
+
+    async def _ensure_browser(self):
+        async with self._lock:
+            if self._browser is None or not self._browser.is_connected():
+                if self._playwright is None:
+                    self._playwright = await async_playwright().start()
+                logger.info("[StatusLookupBrowser:Launch] Launching shared status browser")
+                self._browser = await self._playwright.chromium.launch(headless=True, args=BROWSER_LAUNCH_ARGS)
+                self.launches += 1
+            return self._browser
+
+    async def fetch(self, application_number):
+        if not portal_breaker.allow():
+            raise RuntimeError("portal unavailable (circuit breaker open)")
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._lock = asyncio.Lock()
+        async with self._slots:
+            browser = await self._ensure_browser()
+            self.fetches += 1
+            return await retry_engine.run("status", fetch_status_on_secondary_context, browser, application_number)
+
+    async def close(self):
+        try:
+            if self._browser:
+                await close_browser(self._browser)
+            if self._playwright:
+                await self._playwright.stop()
+        except Exception as e:
+            logger.error(f"[StatusLookupBrowser:CloseError] {str(e)}")
+        self._browser = self._playwright = None
+
+    def stats(self):
+        return {"launches": self.launches, "fetches": self.fetches, "running": self._browser is not None}
+
+status_lookup_browser = StatusLookupBrowser(INLINE_LOOKUP_CONCURRENCY)
+
+def inline_status_text(application_number, result):
+    if result is None:
+        return f"❌ No application found for {application_number}. Make sure the request is paid."
+    return f"🛂 Passport status for {application_number}\n\n{result[0]}"
+
+def inline_refresh_markup(application_number):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 Refresh", callback_data=f"inline_refresh_{application_number}")]
+    ])
+
+async def inline_status_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("[inline_status_query:Start] Entering inline_status_query function")
+    query = update.inline_query
+    application_number = normalize_application_number(query.query)
+    if not APPLICATION_NUMBER_RE.match(application_number):
+        logger.info("[inline_status_query:NoNumber] Query is not an application number")
+        await query.answer([], cache_time=INLINE_CACHE_TIME_S)
+        return
+
+    found, result = status_cache.peek(application_number)
+    if found:
+        status_cache.hits += 1
+    else:
+        user_id = query.from_user.id
+        inline_latest_query[user_id] = query.id
+        await asyncio.sleep(INLINE_DEBOUNCE_S)
+        if inline_latest_query.get(user_id) != query.id:
+            logger.info("[inline_status_query:Superseded] User kept typing, not looking up")
+            await query.answer([], cache_time=0)
+            return
+        del inline_latest_query[user_id]
+        logger.info(f"[inline_status_query:Miss] Looking up {application_number}")
+        try:
+            result = await asyncio.wait_for(
+                asyncio.shield(status_cache.task(application_number, status_lookup_browser.fetch)),
+                INLINE_STATUS_WAIT_S
+            )
+            found = True
+        except asyncio.TimeoutError:
+            logger.info("[inline_status_query:Placeholder] Lookup still running, answering with placeholder")
+        except Exception as e:
+            logger.error(f"[inline_status_query:LookupError] {str(e)}")
+
+    if found:
+        text = inline_status_text(application_number, result)
+        article = InlineQueryResultArticle(
+            id=f"status:{application_number}",
+            title=f"Passport status {application_number}",
+            description=text.splitlines()[-1][:100],
+            input_message_content=InputTextMessageContent(text),
+            reply_markup=inline_refresh_markup(application_number),
+        )
+    else:
+        article = InlineQueryResultArticle(
+            id=f"pending:{application_number}",
+            title=f"⏳ Checking {application_number}…",
+            description="Send now; the message updates when the lookup completes.",
+            input_message_content=InputTextMessageContent(f"⏳ Checking passport status for {application_number}…"),
+            reply_markup=inline_refresh_markup(application_number),
+        )
+    await query.answer([article], cache_time=INLINE_CACHE_TIME_S if found else 0)
+    logger.info("[inline_status_query:End] Exiting inline_status_query function")
+
+async def edit_inline_status(bot, inline_message_id, application_number, max_age=None):
+    try:
+        result = await status_cache.lookup(application_number, status_lookup_browser.fetch, max_age)
+        text = inline_status_text(application_number, result)
+    except Exception as e:
+        logger.error(f"[edit_inline_status:LookupError] {str(e)}")
+        text = f"❌ Could not check {application_number} right now. Tap refresh to try again."
+    try:
+        await bot.edit_message_text(
+            text, inline_message_id=inline_message_id, reply_markup=inline_refresh_markup(application_number)
+        )
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
+async def inline_status_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("[inline_status_chosen:Start] Entering inline_status_chosen function")
+    chosen = update.chosen_inline_result
+    kind, _, application_number = chosen.result_id.partition(":")
+    if kind != "pending" or not chosen.inline_message_id:
+        return
+    logger.info(f"[inline_status_chosen:Edit] Replacing placeholder for {application_number}")
+    await edit_inline_status(context.bot, chosen.inline_message_id, application_number)
+
+async def inline_status_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("[inline_status_refresh:Start] Entering inline_status_refresh function")
+    query = update.callback_query
+    await query.answer("Checking…")
+    if query.inline_message_id:
+        await edit_inline_status(
+            context.bot, query.inline_message_id, query.data[len("inline_refresh_"):], STATUS_REFRESH_MIN_AGE_S
+        )
+
 async def passport_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[passport_status:Start] Entering passport_status function")
     message = update.message or update.callback_query.message
     chat_id = message.chat.id
-    page = active_sessions[chat_id]['page']
+    page = session_registry.page(chat_id)
+    session_registry.touch(chat_id, "status")
     logger.info("[passport_status:GetPassportNumber] Retrieving passport number from message")
     passport_number = message.text
+    if not status_cache.peek(passport_number)[0] and not portal_breaker.allow():
+        logger.error("[passport_status:BreakerOpen] Portal breaker open and no cached status")
+        await message.reply_text(portal_breaker.unavailable_text())
+        await send_after_start_menu(message)
+        return AFTER_START
     logger.info(f"[passport_status:CallMainPassportStatus] Calling main_passport_status with number: {passport_number}")
-    result = await main_passport_status(update, context, page, passport_number)
-    if result:
-        try:
-            logger.info("[passport_status:SendResult] Sending passport status result")
-            await message.reply_text(result)
-            logger.info(f"[passport_status:OpenPDF] Opening status PDF for number: {passport_number}")
-            with open(f"Passport_status_{passport_number}.pdf", "rb") as pdf_file:
-                logger.info("[passport_status:SendPDF] Sending passport status PDF")
-                await message.reply_document(pdf_file, caption="Your passport status report is ready.")
-                logger.info("[passport_status:SendDone] Sending completion message")
-                await message.reply_text("✅ All done!")
-                logger.info("[passport_status:CallNewOrCheck] Calling new_or_check function")
-                return await new_or_check(update, context)
-        except FileNotFoundError:
-            logger.error(f"[passport_status:FileNotFound] File Passport_status_{passport_number}.pdf not found")
-        finally:
-            try:
-                logger.info("[passport_status:Cleanup] Cleaning up status PDF")
-                if os.path.exists(f"Passport_status_{passport_number}.pdf"):
-                    logger.info(f"[passport_status:DeletePDF] Deleting file Passport_status_{passport_number}.pdf")
-                    os.remove(f"Passport_status_{passport_number}.pdf")
-            except Exception as e:
-                logger.error(f"[passport_status:DeleteError] Error deleting file: {e}")
-    logger.info("[passport_status:Retry] Retrying passport_status function")
-    return await passport_status(update, context)
+    try:
+        result = await main_passport_status(update, context, page, passport_number)
+    except RetryExhausted:
+        return await leave_after_retries(update, context, "❌ The status page is not responding. Please try again later.")
+    if not result:
+        logger.info("[passport_status:AwaitNumber] Waiting for a new application number")
+        return 111
+
+    status_text, status_pdf = result
+    logger.info("[passport_status:SendResult] Sending passport status result")
+    await message.reply_text(status_text)
+    logger.info("[passport_status:SendPDF] Sending passport status PDF")
+    await message.reply_document(
+        document=status_pdf,
+        filename=pdf_document_name(chat_id, "Passport_status_", passport_number),
+        caption="Your passport status report is ready."
+    )
+    logger.info("[passport_status:SendDone] Sending completion message")
+    await message.reply_text("✅ All done!")
+    logger.info("[passport_status:CallNewOrCheck] Calling new_or_check function")
+    return await new_or_check(update, context)
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("[cancel:Start] Entering cancel function")
@@ -1523,18 +4317,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     chat_id = message.chat.id
     
     logger.info("[cancel:CleanupSession] Cleaning up browser session")
-    if chat_id in active_sessions:
-        if 'page' in active_sessions[chat_id]:
-            logger.info("[cancel:ClosePage] Closing page")
-            await active_sessions[chat_id]['page'].close()
-        if 'browser' in active_sessions[chat_id]:
-            logger.info("[cancel:CloseBrowser] Closing browser")
-            await active_sessions[chat_id]['browser'].close()
-        if 'playwright' in active_sessions[chat_id]:
-            logger.info("[cancel:StopPlaywright] Stopping playwright")
-            await active_sessions[chat_id]['playwright'].stop()
-        logger.info("[cancel:DeleteSession] Deleting session from active_sessions")
-        del active_sessions[chat_id]
+    await session_registry.release(chat_id, "cancel")
     
     logger.info("[cancel:ClearUserData] Clearing user data")
     context.user_data.clear()
@@ -1586,31 +4369,139 @@ async def handle_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     logger.info("[handle_help:Return] Returning ConversationHandler.END")
     return ConversationHandler.END
 
+async def loop_lag_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("[loop_lag_command:Start] Entering loop_lag_command function")
+    if not is_admin(update):
+        logger.error(f"[loop_lag_command:Denied] Chat {update.effective_chat.id} is not an admin")
+        return
+    await update.effective_message.reply_text(loop_lag_monitor.summary())
+
+def parse_profile_args(args):
+    duration_s, max_updates, track_allocations, top = PROFILE_DEFAULT_S, 0, False, PROFILE_TOP_N
+    for arg in args:
+        arg = arg.lower()
+        if arg in ("alloc", "mem"):
+            track_allocations = True
+        elif arg.startswith("top="):
+            top = int(arg[4:])
+        elif arg.endswith("u"):
+            max_updates = int(arg[:-1])
+            duration_s = PROFILE_MAX_S
+        elif arg.endswith("m"):
+            duration_s = float(arg[:-1]) * 60
+        else:
+            duration_s = float(arg.rstrip("s"))
+    return min(duration_s, PROFILE_MAX_S), max_updates, track_allocations, top
+
+async def run_profile(application, chat_id, duration_s, max_updates, top):
+    handled = 0
+
+    async def count_update(update, context):
+        nonlocal handled
+        handled += 1
+        if max_updates and handled >= max_updates:
+            handler_profiler.finished.set()
+
+    hook = TypeHandler(Update, count_update)
+    try:
+        application.add_handler(hook, group=PROFILE_HANDLER_GROUP)
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(handler_profiler.finished.wait(), duration_s)
+    finally:
+        application.remove_handler(hook, group=PROFILE_HANDLER_GROUP)
+        profile = handler_profiler.stop()
+    paths = await blocking_executor.run("profile", write_profile, profile, PROFILE_DIR)
+    summary = await blocking_executor.run("profile", profile_summary, profile, top, paths, handled)
+    await application.bot.send_message(chat_id, summary[:4096])
+
+profile_tasks = set()
+
+def profile_done(task):
+    profile_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        error = task.exception()
+        logger.error(f"[run_profile:Error] Profile failed: {''.join(traceback.format_exception(error))}")
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("[profile_command:Start] Entering profile_command function")
+    if not is_admin(update):
+        logger.error(f"[profile_command:Denied] Chat {update.effective_chat.id} is not an admin")
+        return
+    message = update.effective_message
+    if context.args and context.args[0].lower() == "stop":
+        if handler_profiler.running:
+            handler_profiler.finished.set()
+        else:
+            await message.reply_text("No profile is running.")
+        return
+    if handler_profiler.running:
+        await message.reply_text("A profile is already running; /profile stop ends it early.")
+        return
+    try:
+        duration_s, max_updates, track_allocations, top = parse_profile_args(context.args or [])
+    except ValueError:
+        await message.reply_text("Usage: /profile [60s|5m|200u] [alloc] [top=N], or /profile stop")
+        return
+    # Started before the reply so a second /profile sent meanwhile sees it running
+    handler_profiler.start(track_allocations)
+    task = asyncio.create_task(
+        run_profile(context.application, update.effective_chat.id, duration_s, max_updates, top)
+    )
+    profile_tasks.add(task)
+    task.add_done_callback(profile_done)
+    until = f"{max_updates} updates (at most {duration_s:g}s)" if max_updates else f"{duration_s:g}s"
+    await message.reply_text(f"🔬 Profiling for {until}{' with allocation tracking' if track_allocations else ''}.")
+
+def collect_metrics():
+    return {
+        "sessions": session_registry.stats(),
+        "blocking_executor": blocking_executor.stats(),
+        "outbound": outbound_rate_limiter.stats(),
+        "keyboards": keyboard_cache.stats(),
+        "slot_cache": slot_cache.stats(),
+        "status_cache": status_cache.stats(),
+        "status_browser": status_lookup_browser.stats(),
+        "portal": portal_breaker.stats(),
+        "portal_probe": portal_prober.stats(),
+        "browser_pool": browser_pool.stats(),
+        "startup": {**startup_clock.stats(), **startup_warmup.stats()},
+        "retries": retry_engine.stats(),
+        "recovery": booking_recovery.stats(),
+        "network": {"mode": "replay" if PORTAL_REPLAY_ARCHIVE else "record" if PORTAL_RECORD_DIR else "live", **network_counters},
+        "timeouts": {operation: values["timeout_ms"] for operation, values in timeout_policy.stats().items()},
+        "webhook": webhook_server.stats() if webhook_server else "polling",
+        "shutdown": shutdown_controller.stats(),
+    }
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("[stats_command:Start] Entering stats_command function")
+    if not is_admin(update):
+        logger.error(f"[stats_command:Denied] Chat {update.effective_chat.id} is not an admin")
+        return
+    metrics = collect_metrics()
+    if SUPERVISOR_METRICS_URL:
+        try:
+            async with httpx.AsyncClient(timeout=10) as client:
+                response = await client.get(SUPERVISOR_METRICS_URL)
+            metrics = {"worker": WORKER_INDEX, **response.json()["total"]}
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            logger.error(f"[stats_command:Cluster] Could not fetch cluster metrics: {str(e)}")
+    lines = ["📊 Bot metrics"]
+    for section, values in metrics.items():
+        if isinstance(values, dict):
+            lines.append(f"{section}: " + ", ".join(f"{key}={value}" for key, value in values.items()))
+        else:
+            lines.append(f"{section}: {values}")
+    await update.effective_message.reply_text("\n".join(lines))
+
 async def cleanup_inactive_sessions():
     logger.info("[cleanup_inactive_sessions:Start] Entering cleanup_inactive_sessions function")
     while True:
         try:
             logger.info("[cleanup_inactive_sessions:CheckSessions] Checking for inactive sessions")
-            now = datetime.now()
-            for chat_id in list(active_sessions.keys()):
-                try:
-                    logger.info(f"[cleanup_inactive_sessions:CheckChat] Checking session for chat_id {chat_id}")
-                    last_active = active_sessions[chat_id].get('last_active')
-                    if last_active and now - last_active > timedelta(minutes=30):
-                        logger.info(f"[cleanup_inactive_sessions:InactiveFound] Found inactive session for chat_id {chat_id}")
-                        if 'page' in active_sessions[chat_id]:
-                            logger.info(f"[cleanup_inactive_sessions:ClosePage] Closing page for chat_id {chat_id}")
-                            await active_sessions[chat_id]['page'].close()
-                        if 'browser' in active_sessions[chat_id]:
-                            logger.info(f"[cleanup_inactive_sessions:CloseBrowser] Closing browser for chat_id {chat_id}")
-                            await active_sessions[chat_id]['browser'].close()
-                        if 'playwright' in active_sessions[chat_id]:
-                            logger.info(f"[cleanup_inactive_sessions:StopPlaywright] Stopping playwright for chat_id {chat_id}")
-                            await active_sessions[chat_id]['playwright'].stop()
-                        logger.info(f"[cleanup_inactive_sessions:DeleteSession] Deleting session for chat_id {chat_id}")
-                        del active_sessions[chat_id]
-                except Exception as e:
-                    logger.error(f"[cleanup_inactive_sessions:SessionError] Error cleaning up session for chat_id {chat_id}: {e}")
+            expired = await session_registry.expire(SESSION_IDLE_TIMEOUT_S)
+            logger.info(f"[cleanup_inactive_sessions:Expired] Closed {expired} inactive sessions")
+            logger.info(f"[cleanup_inactive_sessions:Metrics] {collect_metrics()}")
             logger.info("[cleanup_inactive_sessions:Sleep] Sleeping for 5 minutes")
             await asyncio.sleep(300)
         except asyncio.CancelledError:
@@ -1621,50 +4512,792 @@ async def cleanup_inactive_sessions():
             logger.info("[cleanup_inactive_sessions:SleepRetry] Sleeping for 1 minute before retry")
             await asyncio.sleep(60)
 
-if __name__ == "__main__":
-    logger.info("[main:Start] Starting application")
-    application = Application.builder() \
+async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("[error_handler:Start] Entering error_handler function")
+    error = context.error
+    if isinstance(error, Exception):
+        import traceback
+        stack_trace = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+        logger.error(f"[error_handler:LogError] An error occurred: {error}\nStack trace:\n{stack_trace}")
+    
+    if update and update.effective_message:
+        logger.info("[error_handler:SendErrorMessage] Sending error message to user")
+        await update.effective_message.reply_text(
+            "🔧 System encountered an error. Please /start again.\n"
+            f"Error reference: {hash(str(error))}"
+        )
+    logger.info("[error_handler:End] Exiting error_handler function")
+
+# Webhook serving. BOT_MODE=polling stays the default for local development.
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_MAX_BODY_BYTES = int(os.getenv("WEBHOOK_MAX_BODY_BYTES", str(1024 * 1024)))
+# Replicas behind one load balancer share a URL; only one of them needs to register it
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "1") != "0"
+# Updates are only accepted with Telegram's secret header. It must be set explicitly and
+# shared by every replica: a made-up one would differ per process and restart, and each
+# registration would lock out the replicas that registered before it.
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "")
+
+class WebhookServer:
+    # sink receives each verified update as a decoded dict; path=None serves only
+    # the health, readiness and metrics endpoints
+    def __init__(self, sink, listen, port, path, secret_token, max_connections, checks=None, metrics=None):
+        self.sink = sink
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.max_connections = max_connections
+        self.checks = checks or {}
+        self.metrics = metrics
+        self.connections = set()
+        self.server = None
+        self.ready = False
+        self.draining = False
+        self.counters = Counter()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"[WebhookServer:Start] Listening on {self.listen}:{self.port}{self.path}")
+
+    async def close(self):
+        self.ready = False
+        if self.server:
+            self.server.close()
+            for writer in list(self.connections):
+                writer.close()
+            await self.server.wait_closed()
+        logger.info("[WebhookServer:Close] Webhook server closed")
+
+    def readiness(self):
+        checks = {"webhook": self.ready}
+        for name, check in self.checks.items():
+            checks[name] = bool(check())
+        return all(checks.values()), checks
+
+    async def _handle_connection(self, reader, writer):
+        if len(self.connections) >= self.max_connections:
+            self.counters["rejected_busy"] += 1
+            await self._respond(writer, "503 Service Unavailable", {"ok": False, "error": "busy"}, keep_alive=False)
+            writer.close()
+            return
+        self.connections.add(writer)
+        peer = writer.get_extra_info("peername")
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > WEBHOOK_MAX_BODY_BYTES:
+                    self.counters["rejected_size"] += 1
+                    await self._respond(writer, "413 Payload Too Large", {"ok": False}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length)
+                status, payload = await self._dispatch(method, target.split("?", 1)[0], headers, body, peer)
+                await self._respond(writer, status, payload)
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def _respond(self, writer, status, payload, keep_alive=True):
+        body = json.dumps(payload).encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+
+    def _has_secret(self, headers):
+        return bool(self.secret_token) and hmac.compare_digest(
+            headers.get("x-telegram-bot-api-secret-token", "").encode(), self.secret_token.encode()
+        )
+
+    def _trusted(self, peer, headers):
+        # Metrics describe users' traffic: local scrapers, or whoever holds the secret
+        with contextlib.suppress(TypeError, ValueError):
+            if ipaddress.ip_address(peer[0]).is_loopback:
+                return True
+        return self._has_secret(headers)
+
+    async def _dispatch(self, method, path, headers, body, peer=None):
+        if method == "GET" and path == "/healthz":
+            return "200 OK", {"ok": True}
+        if method == "GET" and path == "/readyz":
+            ready, checks = self.readiness()
+            return ("200 OK" if ready else "503 Service Unavailable"), {"ok": ready, "checks": checks}
+        if method == "GET" and path == "/metrics" and self.metrics:
+            if not self._trusted(peer, headers):
+                self.counters["rejected_metrics"] += 1
+                return "403 Forbidden", {"ok": False}
+            return "200 OK", await self.metrics()
+        if self.path is None or path != self.path:
+            return "404 Not Found", {"ok": False}
+        if method != "POST":
+            return "405 Method Not Allowed", {"ok": False}
+        if not self._has_secret(headers):
+            self.counters["rejected_secret"] += 1
+            logger.error("[WebhookServer:Dispatch] Rejected update with invalid secret token")
+            return "403 Forbidden", {"ok": False}
+        if self.draining:
+            # Telegram (or the supervisor) delivers it again, to whichever process is serving by then
+            self.counters["rejected_draining"] += 1
+            return "503 Service Unavailable", {"ok": False, "error": "draining"}
+        try:
+            data = json.loads(body)
+            await self.sink(data)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            self.counters["bad_request"] += 1
+            logger.error(f"[WebhookServer:Dispatch] Could not parse update: {str(e)}")
+            return "400 Bad Request", {"ok": False}
+        self.counters["received"] += 1
+        return "200 OK", {"ok": True}
+
+    def stats(self):
+        return {"connections": len(self.connections), "ready": self.ready, "draining": self.draining, **self.counters}
+
+webhook_server = None
+
+async def start_webhook(application):
+    global webhook_server
+    logger.info("[start_webhook:Start] Entering start_webhook function")
+    if WEBHOOK_REGISTER and not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL must be set when BOT_MODE=webhook")
+    if not WEBHOOK_SECRET_TOKEN:
+        raise ValueError("WEBHOOK_SECRET_TOKEN must be set when BOT_MODE=webhook")
+
+    async def enqueue(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    async def metrics():
+        return collect_metrics()
+
+    webhook_server = WebhookServer(
+        enqueue, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONNECTIONS,
+        checks={"application": lambda: application.running, "warm": startup_warmup.done.is_set},
+        metrics=metrics,
+    )
+    await webhook_server.start()
+    if WEBHOOK_REGISTER:
+        logger.info(f"[start_webhook:SetWebhook] Registering {WEBHOOK_URL}{WEBHOOK_PATH}")
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+        )
+    webhook_server.ready = True
+    logger.info("[start_webhook:End] Webhook server ready")
+    return webhook_server
+
+async def wait_for_stop_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+async def run_polling(application):
+    logger.info("[run_polling:Start] Entering run_polling function")
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.updater.start_polling()
+    await application.start()
+    await wait_for_stop_signal()
+
+    # Updates not fetched yet stay with Telegram for the next process
+    await shutdown_controller.drain(application, application.updater.stop)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+    logger.info("[run_polling:End] Exiting run_polling function")
+
+async def run_webhook(application):
+    logger.info("[run_webhook:Start] Entering run_webhook function")
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    server = await start_webhook(application)
+    await wait_for_stop_signal()
+
+    async def stop_ingress():
+        server.ready = False
+        server.draining = True
+
+    await shutdown_controller.drain(application, stop_ingress)
+    logger.info("[run_webhook:Stop] Stopping webhook server")
+    await server.close()
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+    logger.info("[run_webhook:End] Exiting run_webhook function")
+
+# Sharded deployment. BOT_MODE=supervisor starts BOT_WORKERS worker processes, each
+# a webhook-mode bot listening on localhost with its own browsers, and routes every
+# update to the worker that owns its chat so its browser session never has to move.
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", str(os.cpu_count() or 2)))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "9100"))
+WORKER_RESTART_BACKOFF_S = float(os.getenv("WORKER_RESTART_BACKOFF_S", "1.0"))
+WORKER_STOP_TIMEOUT_S = float(os.getenv("WORKER_STOP_TIMEOUT_S", "30"))
+# A worker that keeps refusing an update (restarting, draining) gets it again with
+# backoff for this long; then it is counted as dropped so the shard keeps moving
+WORKER_FORWARD_DEADLINE_S = float(os.getenv("WORKER_FORWARD_DEADLINE_S", "60"))
+# Command that starts one worker; the load test swaps in a stubbed portal
+WORKER_COMMAND = os.getenv("WORKER_COMMAND", f"{sys.executable} {os.path.abspath(__file__)}")
+SUPERVISOR_METRICS_URL = os.getenv("SUPERVISOR_METRICS_URL", "")
+ROUTING_FIELDS = (
+    "message", "edited_message", "channel_post", "edited_channel_post", "callback_query",
+    "inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query",
+    "poll_answer", "my_chat_member", "chat_member", "chat_join_request",
+)
+
+def update_routing_key(data):
+    # Inline queries carry no chat; the sender's id equals their private chat id
+    for field in ROUTING_FIELDS:
+        payload = data.get(field)
+        if not payload:
+            continue
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = payload.get("from") or payload.get("user")
+        if user:
+            return user["id"]
+    return data.get("update_id", 0)
+
+def shard_for(chat_id, workers):
+    return zlib.crc32(str(chat_id).encode()) % workers
+
+def merge_metrics(items):
+    total = {}
+    for item in items:
+        for key, value in item.items():
+            if isinstance(value, dict):
+                total[key] = merge_metrics([total.get(key, {}), value])
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                total[key] = round(total.get(key, 0) + value, 3)
+    return total
+
+class WorkerProcess:
+    def __init__(self, index, secret_token, global_rate):
+        self.index = index
+        self.port = WORKER_BASE_PORT + index
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.secret_token = secret_token
+        self.global_rate = global_rate
+        self.process = None
+        self.started_at = None
+        self.ready = False
+        self.restarts = 0
+        self.queue = asyncio.Queue()
+        self.forwarded = 0
+        self.redeliveries = 0
+        self.dropped = 0
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    def env(self):
+        return dict(
+            os.environ,
+            BOT_MODE="webhook",
+            WORKER_INDEX=str(self.index),
+            WEBHOOK_LISTEN="127.0.0.1",
+            WEBHOOK_PORT=str(self.port),
+            WEBHOOK_PATH="/update",
+            WEBHOOK_SECRET_TOKEN=self.secret_token,
+            WEBHOOK_REGISTER="0",
+            # Bot API flood limits are per bot token, so the workers split the budget
+            RATE_LIMIT_GLOBAL_PER_S=str(self.global_rate),
+            BOT_LOG_FILE=f"passport_bot.worker{self.index}.log",
+            SUPERVISOR_METRICS_URL=f"http://127.0.0.1:{WEBHOOK_PORT}/metrics",
+        )
+
+    async def watch_ready(self, client):
+        # A worker counts as ready once its own /readyz reports warm
+        while not self.ready:
+            with contextlib.suppress(httpx.HTTPError):
+                self.ready = (await client.get(f"{self.url}/readyz")).status_code == 200
+            if not self.ready:
+                await asyncio.sleep(0.5)
+        logger.info(f"[WorkerProcess:Ready] Worker {self.index} ready {time.monotonic() - self.started_at:.1f}s after start")
+
+    async def keep_alive(self, stopping, client):
+        backoff = WORKER_RESTART_BACKOFF_S
+        while not stopping.is_set():
+            self.process = await asyncio.create_subprocess_exec(*shlex.split(WORKER_COMMAND), env=self.env())
+            self.started_at = time.monotonic()
+            logger.info(f"[WorkerProcess:Start] Worker {self.index} started with pid {self.process.pid} on port {self.port}")
+            watcher = asyncio.create_task(self.watch_ready(client))
+            code = await self.process.wait()
+            watcher.cancel()
+            self.ready = False
+            if stopping.is_set():
+                break
+            self.restarts += 1
+            if time.monotonic() - self.started_at > 60:
+                backoff = WORKER_RESTART_BACKOFF_S
+            logger.error(f"[WorkerProcess:Crashed] Worker {self.index} exited with code {code}, restarting in {backoff}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    async def forward(self, client):
+        # One forwarder per worker keeps each chat's updates in order
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret_token}
+        while True:
+            data = await self.queue.get()
+            deadline = time.monotonic() + WORKER_FORWARD_DEADLINE_S
+            delay = 0.2
+            while True:
+                try:
+                    response = await client.post(f"{self.url}/update", json=data, headers=headers)
+                    if response.status_code == 200:
+                        self.forwarded += 1
+                        break
+                    if 400 <= response.status_code < 500:
+                        # Retrying cannot fix a bad body or a secret mismatch
+                        self.dropped += 1
+                        logger.error(
+                            f"[WorkerProcess:Forward] Worker {self.index} rejected update {data.get('update_id')} "
+                            f"with {response.status_code}"
+                        )
+                        break
+                except httpx.HTTPError:
+                    pass
+                if time.monotonic() + delay > deadline:
+                    self.dropped += 1
+                    logger.error(
+                        f"[WorkerProcess:Forward] Worker {self.index} unreachable for {WORKER_FORWARD_DEADLINE_S:g}s, "
+                        f"dropping update {data.get('update_id')}"
+                    )
+                    break
+                self.redeliveries += 1
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+
+    def stop(self):
+        if self.alive:
+            self.process.terminate()
+
+    async def wait_stopped(self):
+        if self.process is None:
+            return
+        try:
+            await asyncio.wait_for(self.process.wait(), WORKER_STOP_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            logger.error(f"[WorkerProcess:Kill] Worker {self.index} did not stop in time, killing it")
+            self.process.kill()
+            await self.process.wait()
+
+    def stats(self):
+        return {
+            "pid": self.process.pid if self.process else None,
+            "alive": self.alive,
+            "ready": self.ready,
+            "restarts": self.restarts,
+            "queue_depth": self.queue.qsize(),
+            "forwarded": self.forwarded,
+            "redeliveries": self.redeliveries,
+            "dropped": self.dropped,
+        }
+
+class Supervisor:
+    def __init__(self, workers):
+        self.secret_token = secrets.token_hex(16)
+        self.workers = [
+            WorkerProcess(index, self.secret_token, RATE_LIMIT_GLOBAL_PER_S / workers) for index in range(workers)
+        ]
+        self.stopping = asyncio.Event()
+        self.ingress = "webhook" if WEBHOOK_URL else "polling"
+        self.client = None
+        self.bot = None
+        self.server = None
+        self.tasks = []
+
+    async def route(self, data):
+        worker = self.workers[shard_for(update_routing_key(data), len(self.workers))]
+        await worker.queue.put(data)
+
+    async def poll_updates(self):
+        offset = None
+        while not self.stopping.is_set():
+            try:
+                updates = await self.bot.get_updates(offset=offset, timeout=10, allowed_updates=Update.ALL_TYPES)
+            except TelegramError as e:
+                logger.error(f"[Supervisor:PollUpdates] getUpdates failed: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await self.route(update.to_dict())
+                offset = update.update_id + 1
+
+    async def metrics(self):
+        responses = await asyncio.gather(
+            *(self.client.get(f"{worker.url}/metrics", timeout=5) for worker in self.workers),
+            return_exceptions=True,
+        )
+        per_worker = {}
+        for worker, response in zip(self.workers, responses):
+            if isinstance(response, httpx.Response) and response.status_code == 200:
+                per_worker[worker.index] = response.json()
+            else:
+                per_worker[worker.index] = {"error": str(response)}
+        return {
+            "supervisor": {
+                "ingress": self.ingress,
+                "workers": {worker.index: worker.stats() for worker in self.workers},
+            },
+            "total": merge_metrics(metrics for metrics in per_worker.values() if "error" not in metrics),
+            "workers": per_worker,
+        }
+
+    async def log_metrics(self):
+        while not self.stopping.is_set():
+            await asyncio.sleep(300)
+            metrics = await self.metrics()
+            logger.info(f"[Supervisor:Metrics] {metrics['supervisor']} total={metrics['total']}")
+
+    async def start(self):
+        logger.info(f"[Supervisor:Start] Starting {len(self.workers)} workers, {self.ingress} ingress")
+        if self.ingress == "webhook" and not WEBHOOK_SECRET_TOKEN:
+            raise ValueError("WEBHOOK_SECRET_TOKEN must be set when BOT_MODE=webhook")
+        self.client = httpx.AsyncClient(timeout=30)
+        self.bot = Bot(
+            TELEGRAM_BOT_TOKEN,
+            base_url=f"{TELEGRAM_API_BASE_URL}/bot" if TELEGRAM_API_BASE_URL else "https://api.telegram.org/bot",
+        )
+        await self.bot.initialize()
+        self.server = WebhookServer(
+            self.route, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH if self.ingress == "webhook" else None,
+            WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONNECTIONS,
+            checks={"workers": lambda: all(worker.alive and worker.ready for worker in self.workers)},
+            metrics=self.metrics,
+        )
+        await self.server.start()
+        for worker in self.workers:
+            self.tasks.append(asyncio.create_task(worker.keep_alive(self.stopping, self.client)))
+            self.tasks.append(asyncio.create_task(worker.forward(self.client)))
+        self.tasks.append(asyncio.create_task(self.log_metrics()))
+        if self.ingress == "webhook":
+            if WEBHOOK_REGISTER:
+                await self.bot.set_webhook(
+                    url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                    max_connections=WEBHOOK_MAX_CONNECTIONS,
+                    allowed_updates=Update.ALL_TYPES,
+                    secret_token=WEBHOOK_SECRET_TOKEN,
+                )
+        else:
+            await self.bot.delete_webhook()
+            self.tasks.append(asyncio.create_task(self.poll_updates()))
+        self.server.ready = True
+
+    async def stop(self):
+        logger.info("[Supervisor:Stop] Stopping workers")
+        self.stopping.set()
+        self.server.ready = False
+        for worker in self.workers:
+            worker.stop()
+        await asyncio.gather(*(worker.wait_stopped() for worker in self.workers))
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.server.close()
+        await self.client.aclose()
+        await self.bot.shutdown()
+        logger.info("[Supervisor:Stop] All workers stopped")
+
+async def run_supervisor():
+    logger.info("[run_supervisor:Start] Entering run_supervisor function")
+    supervisor = Supervisor(BOT_WORKERS)
+    await supervisor.start()
+    await wait_for_stop_signal()
+    await supervisor.stop()
+    logger.info("[run_supervisor:End] Exiting run_supervisor function")
+
+# Graceful shutdown. On SIGTERM ingress stops (polling ends; webhook updates get a
+# 503 so Telegram or the supervisor delivers them again later), new sessions are
+# turned away, and in-flight updates and recoveries get SHUTDOWN_DRAIN_S to finish.
+# Bookings that can be rebuilt from their checkpoints are written to
+# SHUTDOWN_STATE_PATH as JSON with their conversation state; the next process loads
+# them through ResumePersistence and recovery_gate rebuilds the page on the user's
+# next update. Other open sessions are told to start again. All browsers and
+# Playwright drivers are then closed at once. Drain plus close must fit in the
+# supervisor's WORKER_STOP_TIMEOUT_S.
+SHUTDOWN_DRAIN_S = float(os.getenv("SHUTDOWN_DRAIN_S", "20"))
+SHUTDOWN_CLOSE_S = float(os.getenv("SHUTDOWN_CLOSE_S", "5"))
+SHUTDOWN_STATE_PATH = os.getenv(
+    "SHUTDOWN_STATE_PATH", f"resume.worker{WORKER_INDEX}.json" if WORKER_INDEX else "resume.json"
+)
+RESTARTING_TEXT = "🔄 The bot is restarting for an update. Please try again in a minute."
+
+def write_resume_state(path, conversations, user_data):
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"saved_at": time.time(), "conversations": conversations, "user_data": user_data}, f)
+    os.replace(f"{path}.tmp", path)
+
+def read_resume_state(path):
+    with open(path, encoding="utf-8") as f:
+        saved = json.load(f)
+    os.remove(path)
+    return saved
+
+class ResumePersistence(BasePersistence):
+    # PTB persistence for persistent conversations and user_data. Nothing is written
+    # while the bot runs: the application reports conversation states here, and
+    # ShutdownController.persist writes the resumable bookings once on the way out.
+    # The next process reads them back when the application initializes.
+    def __init__(self, path):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False))
+        self.path = path
+        self.conversations = defaultdict(dict)
+        self.restored = None
+
+    def _load(self):
+        if self.restored is not None:
+            return
+        self.restored = {"conversations": {}, "user_data": {}}
+        try:
+            saved = read_resume_state(self.path)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"[ResumePersistence:LoadError] Could not read {self.path}: {str(e)}")
+            return
+        if time.time() - saved["saved_at"] > SESSION_IDLE_TIMEOUT_S:
+            logger.info("[ResumePersistence:Stale] Resume state is older than the session idle timeout, ignoring it")
+            return
+        self.restored = saved
+
+    async def get_user_data(self):
+        self._load()
+        return {int(user_id): data for user_id, data in self.restored["user_data"].items()}
+
+    async def get_conversations(self, name):
+        self._load()
+        for key, state in self.restored["conversations"].get(name, []):
+            self.conversations[name][tuple(key)] = state
+        return dict(self.conversations[name])
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            self.conversations[name].pop(key, None)
+        else:
+            self.conversations[name][key] = new_state
+
+    async def update_user_data(self, user_id, data):
+        # The live application.user_data is read at shutdown instead
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        pass
+
+class ShutdownController:
+    def __init__(self, drain_s, close_s, state_path):
+        self.drain_s = drain_s
+        self.close_s = close_s
+        self.state_path = state_path
+        self.draining = False
+        self.drain_ms = None
+        self.counters = Counter()
+
+    def resumable(self, application):
+        # (conversation key, state, user_data) for every booking the next process can rebuild
+        chats = []
+        for key, state in application.persistence.conversations["booking"].items():
+            user_data = application.user_data.get(key[-1])
+            if not isinstance(state, int) or not user_data or not booking_recovery.recoverable(user_data):
+                continue
+            try:
+                json.dumps(user_data)
+            except (TypeError, ValueError) as e:
+                logger.error(f"[ShutdownController:NotResumable] chat_id {key[0]} has data JSON cannot hold: {str(e)}")
+                continue
+            chats.append((key, state, user_data))
+        return chats
+
+    async def persist(self, application):
+        # Handlers cut off by the drain deadline may not have reported their last state yet
+        await application.update_persistence()
+        chats = self.resumable(application)
+        if not chats:
+            return set()
+        conversations = {"booking": [[list(key), state] for key, state, _ in chats]}
+        user_data = {str(key[-1]): data for key, _, data in chats}
+        try:
+            await blocking_executor.run("shutdown", write_resume_state, self.state_path, conversations, user_data)
+        except Exception as e:
+            logger.error(f"[ShutdownController:PersistError] Could not write {self.state_path}: {str(e)}")
+            return set()
+        self.counters["persisted"] += len(chats)
+        logger.info(f"[ShutdownController:Persisted] {len(chats)} resumable bookings written to {self.state_path}")
+        return {key[0] for key, _, _ in chats}
+
+    def restore(self, application):
+        # ResumePersistence already loaded the saved bookings during initialize()
+        restored = len(application.persistence.restored["conversations"].get("booking", []))
+        if restored:
+            self.counters["restored"] += restored
+            logger.info(f"[ShutdownController:Restored] {restored} bookings resume where they stopped")
+        return restored
+
+    async def _notify(self, bot, chat_ids):
+        async def send(chat_id):
+            with contextlib.suppress(TelegramError):
+                await bot.send_message(chat_id, RESTARTING_TEXT)
+
+        await asyncio.gather(*(send(chat_id) for chat_id in chat_ids))
+
+    async def drain(self, application, stop_ingress):
+        started = time.perf_counter()
+        self.draining = True
+        logger.info(f"[ShutdownController:Drain] Stopping ingress, allowing {self.drain_s:g}s for in-flight work")
+        await stop_ingress()
+        stopping = asyncio.create_task(application.stop())
+        _, pending = await asyncio.wait({stopping, *booking_recovery.tasks.values()}, timeout=self.drain_s)
+        if pending:
+            self.counters["cut_off"] += len(pending)
+            logger.error(f"[ShutdownController:Deadline] {len(pending)} operations still running, closing their browsers")
+
+        resumed = await self.persist(application)
+        unresumable = [chat_id for chat_id in session_registry.sessions if chat_id not in resumed]
+        self.counters["notified"] += len(unresumable)
+        closing = [
+            asyncio.create_task(self._notify(application.bot, unresumable)),
+            asyncio.create_task(session_registry.close_all("shutdown")),
+            asyncio.create_task(browser_pool.close()),
+            asyncio.create_task(status_lookup_browser.close()),
+        ]
+        _, unfinished = await asyncio.wait(closing, timeout=self.close_s)
+        if unfinished:
+            logger.error(f"[ShutdownController:CloseTimeout] {len(unfinished)} close steps did not finish in {self.close_s:g}s")
+        if not stopping.done():
+            # The cut-off handlers fail fast once their pages are gone
+            await asyncio.wait({stopping}, timeout=self.close_s)
+            stopping.cancel()
+        self.drain_ms = round((time.perf_counter() - started) * 1000)
+        logger.info(f"[ShutdownController:Drained] Shutdown drain finished in {self.drain_ms}ms")
+
+    def stats(self):
+        return {"draining": self.draining, "drain_ms": self.drain_ms, **self.counters}
+
+shutdown_controller = ShutdownController(SHUTDOWN_DRAIN_S, SHUTDOWN_CLOSE_S, SHUTDOWN_STATE_PATH)
+
+async def drain_gate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Runs before recovery_gate: while draining only chats with an open session go on
+    if not shutdown_controller.draining:
+        return
+    chat = update.effective_chat
+    message = update.effective_message
+    restarting = bool(message and message.text and message.text.split()[0] == "/start")
+    if chat is not None and chat.id in session_registry and not restarting:
+        return
+    shutdown_controller.counters["turned_away"] += 1
+    if update.callback_query:
+        with contextlib.suppress(TelegramError):
+            await update.callback_query.answer()
+    if chat is not None and message:
+        await message.reply_text(RESTARTING_TEXT)
+    raise ApplicationHandlerStop
+
+async def post_init(application):
+    logger.info("[post_init:Start] Entering post_init function")
+    logger.info("[post_init:Restore] Loading bookings saved by the previous process")
+    shutdown_controller.restore(application)
+    logger.info("[post_init:CreateCleanupTask] Creating cleanup_inactive_sessions task")
+    asyncio.create_task(cleanup_inactive_sessions())
+    logger.info("[post_init:StartLagMonitor] Starting event loop lag monitor")
+    loop_lag_monitor.start()
+    startup_clock.mark("initialized")
+    if STARTUP_WARMUP:
+        logger.info("[post_init:StartWarmup] Warming browsers, caches and portal health in the background")
+        startup_warmup.start()
+    else:
+        startup_warmup.done.set()
+    logger.info("[post_init:StartPortalProber] Starting portal health prober")
+    portal_prober.start(delay=PORTAL_PROBE_INTERVAL_S if STARTUP_WARMUP else 0.0)
+    if BOT_MODE == "polling":
+        # No readiness endpoint to gate on; polling starts once warm (updates wait at Telegram)
+        logger.info("[post_init:WaitWarmup] Waiting for warm-up before polling")
+        await startup_warmup.wait(STARTUP_WARMUP_TIMEOUT_S)
+    logger.info("[post_init:End] Exiting post_init function")
+
+async def post_shutdown(application):
+    logger.info("[post_shutdown:CloseStatusBrowser] Closing shared status browser")
+    await status_lookup_browser.close()
+    logger.info("[post_shutdown:CloseBrowserPool] Closing pooled browsers")
+    await browser_pool.close()
+
+def build_application():
+    logger.info("[build_application:Start] Building application")
+    builder = Application.builder() \
         .token(TELEGRAM_BOT_TOKEN) \
         .read_timeout(300) \
         .write_timeout(300) \
         .connect_timeout(300) \
         .pool_timeout(300) \
-        .build()
-    logger.info("[main:ApplicationBuilt] Application built successfully")
-
-    async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        logger.info("[error_handler:Start] Entering error_handler function")
-        error = context.error
-        if isinstance(error, Exception):
-            import traceback
-            stack_trace = "".join(traceback.format_exception(type(error), error, error.__traceback__))
-            logger.error(f"[error_handler:LogError] An error occurred: {error}\nStack trace:\n{stack_trace}")
-        
-        if update and update.effective_message:
-            logger.info("[error_handler:SendErrorMessage] Sending error message to user")
-            await update.effective_message.reply_text(
-                "🔧 System encountered an error. Please /start again.\n"
-                f"Error reference: {hash(str(error))}"
-            )
-        logger.info("[error_handler:End] Exiting error_handler function")
-
-    main_menu = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
-        states={
-            MAIN_MENU: [
-                CallbackQueryHandler(main_menu_handler)],
-            AFTER_START: [
-                CallbackQueryHandler(after_start, pattern="^new_appointment"),
-                CallbackQueryHandler(after_start, pattern="^passport_status"),
-                CallbackQueryHandler(after_start, pattern="^help")
-            ]
-        },
-        fallbacks=[CommandHandler("cancel", cancel)],
-        per_message=False,
-        per_user=True,
-        per_chat=True,
-    )
-    logger.info("[main:MainMenuHandler] Main menu conversation handler configured")
+        .rate_limiter(outbound_rate_limiter) \
+        .application_class(ChatOrderedApplication) \
+        .concurrent_updates(CONCURRENT_UPDATES) \
+        .persistence(ResumePersistence(SHUTDOWN_STATE_PATH))
+    if TELEGRAM_API_BASE_URL:
+        logger.info(f"[build_application:BaseUrl] Using Bot API at {TELEGRAM_API_BASE_URL}")
+        builder = builder \
+            .base_url(f"{TELEGRAM_API_BASE_URL}/bot") \
+            .base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    application = builder.build()
+    logger.info("[build_application:ApplicationBuilt] Application built successfully")
 
     check_status = ConversationHandler(
         entry_points=[
@@ -1684,7 +5317,7 @@ if __name__ == "__main__":
         per_user=True,
         per_chat=True,
     )
-    logger.info("[main:CheckStatusHandler] Check status conversation handler configured")
+    logger.info("[build_application:CheckStatusHandler] Check status conversation handler configured")
 
     form_handle = ConversationHandler(
         entry_points=[
@@ -1692,18 +5325,34 @@ if __name__ == "__main__":
             CallbackQueryHandler(new_appointment, pattern="^book_appointment")
         ],
         states={
-            0: [CallbackQueryHandler(ask_region_response, pattern="^region_")],
-            AFTER_START: [
-                CallbackQueryHandler(after_start, pattern="^new_appointment"),
-                CallbackQueryHandler(after_start, pattern="^passport_status"),
-                CallbackQueryHandler(after_start, pattern="^help")
+            0: [
+                CallbackQueryHandler(ask_region_response, pattern="^region_"),
+                CallbackQueryHandler(handle_page_flip, pattern=f"^{PAGINATION_PREFIX}"),
+            ],
+            1: [
+                CallbackQueryHandler(ask_city_response, pattern="^city_"),
+                CallbackQueryHandler(handle_page_flip, pattern=f"^{PAGINATION_PREFIX}"),
+            ],
+            2: [
+                CallbackQueryHandler(ask_office_response, pattern="^office_"),
+                CallbackQueryHandler(handle_page_flip, pattern=f"^{PAGINATION_PREFIX}"),
+            ],
+            3: [
+                CallbackQueryHandler(ask_branch_response, pattern="^branch_"),
+                CallbackQueryHandler(handle_page_flip, pattern=f"^{PAGINATION_PREFIX}"),
+            ],
+            4: [
+                CallbackQueryHandler(ask_date_response, pattern="^date_"),
+                CallbackQueryHandler(handle_page_flip, pattern=f"^{PAGINATION_PREFIX}"),
+            ],
+            TIME_SLOT_STATE: [
+                CallbackQueryHandler(ask_time_slot_response, pattern="^slot_"),
+                CallbackQueryHandler(handle_page_flip, pattern=f"^{PAGINATION_PREFIX}"),
+            ],
+            PERSONAL_FIRSTNAME: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_first_name),
+                CallbackQueryHandler(send_intake_template, pattern="^intake_template$"),
             ],
-            0: [CallbackQueryHandler(ask_region_response, pattern="^region_")],
-            1: [CallbackQueryHandler(ask_city_response, pattern="^city_")],
-            2: [CallbackQueryHandler(ask_office_response, pattern="^office_")],
-            3: [CallbackQueryHandler(ask_branch_response, pattern="^branch_")],
-            4: [CallbackQueryHandler(ask_date_response, pattern="^date_")],
-            PERSONAL_FIRSTNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_first_name)],
             PERSONAL_MIDDLENAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_middle_name)],
             PERSONAL_LASTNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_last_name)],
             PERSONAL_GEZZ_FIRSTNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_gez_first_name)],
@@ -1714,7 +5363,7 @@ if __name__ == "__main__":
             PERSONAL_DOB: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_dob)],
             DROPDOWN_STATE: [
                 CallbackQueryHandler(handle_dropdown_response, pattern="^dropdown_"),
-                CallbackQueryHandler(handle_dropdown_response, pattern=f"^{PAGINATION_PREFIX}"),
+                CallbackQueryHandler(handle_page_flip, pattern=f"^{PAGINATION_PREFIX}"),
             ],
             FILE_UPLOAD_ID_DOC: [
                 MessageHandler(filters.Document.ALL | filters.PHOTO, handle_file_upload),
@@ -1736,11 +5385,13 @@ if __name__ == "__main__":
                 CallbackQueryHandler(main_menu_handler)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="booking",
+        persistent=True,
         per_message=False,
         per_user=True,
         per_chat=True,
     )
-    logger.info("[main:FormHandler] Form conversation handler configured")
+    logger.info("[build_application:FormHandler] Form conversation handler configured")
 
     help_h = ConversationHandler(
         entry_points=[
@@ -1752,22 +5403,44 @@ if __name__ == "__main__":
         },
         fallbacks=[CommandHandler("cancel", cancel)]
     )
-    logger.info("[main:HelpHandler] Help conversation handler configured")
+    logger.info("[build_application:HelpHandler] Help conversation handler configured")
 
-    logger.info("[main:AddHandlers] Adding handlers to application")
+    logger.info("[build_application:LeaseSessions] Running booking and status steps under session leases")
+    for conversation in (form_handle, check_status):
+        for handler in [*conversation.entry_points, *itertools.chain(*conversation.states.values()), *conversation.fallbacks]:
+            handler.callback = leased(handler.callback)
+
+    logger.info("[build_application:AddHandlers] Adding handlers to application")
+    application.add_handler(TypeHandler(Update, drain_gate), group=-2)
+    application.add_handler(TypeHandler(Update, recovery_gate), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(form_handle)
     application.add_handler(check_status)
     application.add_handler(help_h)
     application.add_handler(CommandHandler("cancel", cancel))
+    application.add_handler(CommandHandler("lag", loop_lag_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(InlineQueryHandler(inline_status_query, block=False))
+    application.add_handler(ChosenInlineResultHandler(inline_status_chosen, block=False))
+    application.add_handler(CallbackQueryHandler(inline_status_refresh, pattern="^inline_refresh_", block=False))
 
-    async def post_init(application):
-        logger.info("[post_init:Start] Entering post_init function")
-        logger.info("[post_init:CreateCleanupTask] Creating cleanup_inactive_sessions task")
-        asyncio.create_task(cleanup_inactive_sessions())
-        logger.info("[post_init:End] Exiting post_init function")
-
-    logger.info("[main:SetPostInit] Setting post_init function")
+    logger.info("[build_application:SetPostInit] Setting post_init function")
     application.post_init = post_init
-    logger.info("[main:RunPolling] Starting application polling")
-    application.run_polling()
\ No newline at end of file
+    application.post_shutdown = post_shutdown
+    return application
+
+if __name__ == "__main__":
+    logger.info("[main:Start] Starting application")
+    startup_clock.mark("loaded")
+    if BOT_MODE == "supervisor":
+        logger.info("[main:RunSupervisor] Starting sharded supervisor")
+        asyncio.run(run_supervisor())
+        sys.exit(0)
+    application = build_application()
+    if BOT_MODE == "webhook":
+        logger.info("[main:RunWebhook] Starting application in webhook mode")
+        asyncio.run(run_webhook(application))
+    else:
+        logger.info("[main:RunPolling] Starting application polling")
+        asyncio.run(run_polling(application))
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# main.py opens its log file at import time; keep it out of the repo.
+os.environ.setdefault("BOT_LOG_FILE", os.path.join(tempfile.gettempdir(), "passport_bot.test.log"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
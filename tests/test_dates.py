@@ -0,0 +1,84 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+from ethiopian_date import EthiopianDateConverter
+
+import main
+
+
+calendar = main.ethiopian_calendar
+
+
+# Ethiopian calendar round-trip
+def test_round_trip_every_day_in_range():
+    day = date(1900, 1, 1)
+    while day <= date(2100, 12, 31):
+        ethiopian = calendar.to_ethiopian(day)
+        assert ethiopian is not None, day
+        assert calendar.to_gregorian(*ethiopian) == day
+        day += timedelta(days=1)
+
+
+@pytest.mark.parametrize("year,month,day", [(1900, 1, 1), (1992, 1, 1), (2012, 9, 12), (2015, 12, 30), (2016, 1, 1), (2092, 6, 15)])
+def test_matches_ethiopian_date_library(year, month, day):
+    assert calendar.to_gregorian(year, month, day) == EthiopianDateConverter.to_gregorian(year, month, day)
+
+
+def test_pagume_has_six_days_in_leap_years():
+    assert calendar.days_in_month(2015, 13) == 6
+    assert calendar.days_in_month(2016, 13) == 5
+    assert calendar.days_in_month(2016, 1) == 30
+    assert calendar.to_gregorian(2015, 13, 6) == date(2023, 9, 11)
+    assert calendar.to_gregorian(2016, 1, 1) == date(2023, 9, 12)
+    assert calendar.to_gregorian(2016, 13, 6) is None
+    assert calendar.to_ethiopian(date(2024, 9, 10)) == (2016, 13, 5)
+    assert calendar.to_ethiopian(date(2024, 9, 11)) == (2017, 1, 1)
+
+
+@pytest.mark.parametrize("year,month,day", [(2015, 14, 1), (2015, 0, 1), (2015, 1, 31), (2015, 1, 0)])
+def test_invalid_ethiopian_dates(year, month, day):
+    assert calendar.to_gregorian(year, month, day) is None
+
+
+def test_out_of_range_gregorian_dates():
+    assert calendar.to_ethiopian(date(1899, 12, 31)) is None
+    assert calendar.to_ethiopian(date(2101, 1, 1)) is None
+
+
+def test_dual_labels():
+    assert calendar.format_ethiopian(date(2023, 9, 12)) == "መስከረም 1, 2016"
+    assert calendar.dual_labels(["September 12, 2023"]) == ["September 12, 2023 · መስከረም 1, 2016"]
+
+
+# Date validators
+@pytest.mark.parametrize("text", ["05/21/1990", "5/21/1990", "05211990"])
+def test_validate_gregorian_date_accepts(text):
+    assert main.validate_gregorian_date(text) == datetime(1990, 5, 21)
+
+
+def test_validate_gregorian_date_leap_day():
+    assert main.validate_gregorian_date("02/29/2000") == datetime(2000, 2, 29)
+    assert main.validate_gregorian_date("02/29/2001") is False
+
+
+@pytest.mark.parametrize("text", ["1990-05-21", "21/05/1990", "13/01/1990", "01/32/1990", "01/01/1899", "abc", ""])
+def test_validate_gregorian_date_rejects(text):
+    assert main.validate_gregorian_date(text) is False
+
+
+def test_validate_gregorian_date_rejects_future_year():
+    assert main.validate_gregorian_date(f"01/01/{date.today().year + 1}") is False
+
+
+def test_convert_ethiopian_to_gregorian():
+    assert main.convert_ethiopian_to_gregorian("2012/09/12") == date(2020, 5, 20)
+    assert main.convert_ethiopian_to_gregorian("2015/13/6") == date(2023, 9, 11)
+    assert main.convert_ethiopian_to_gregorian("2016/13/6") is False
+    assert main.convert_ethiopian_to_gregorian("2012-09-12") is False
+    assert main.convert_ethiopian_to_gregorian(f"{calendar.to_ethiopian(date.today())[0] + 1}/01/01") is False
+
+
+def test_parse_date_of_birth():
+    assert main.parse_date_of_birth("05/21/1990") == ("05/21/1990", False)
+    assert main.parse_date_of_birth("2012/09/12") == ("05/20/2020", True)
+    assert main.parse_date_of_birth("not a date") is None
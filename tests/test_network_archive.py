@@ -0,0 +1,102 @@
+import json
+from types import SimpleNamespace
+
+import main
+
+
+PII_VALUES = [
+    "Abebe", "Kebede", "Abebe Kebede", "Alemu", "0911223344", "abebe@example.com",
+    "Bole 03", "H-1234", "ABC1234567", "Kirkos", "05/21/1990",
+]
+MULTIPART_BOUNDARY = "----portalform"
+MULTIPART_BODY = (
+    f"--{MULTIPART_BOUNDARY}\r\n"
+    'Content-Disposition: form-data; name="firstName"\r\n\r\nAbebe\r\n'
+    f"--{MULTIPART_BOUNDARY}\r\n"
+    'Content-Disposition: form-data; name="idScan"; filename="id.jpg"\r\n'
+    "Content-Type: image/jpeg\r\n\r\n"
+).encode() + b"\xff\xd8\xffIDSCANBYTES Abebe Kebede\xff\xd9\r\n" + f"--{MULTIPART_BOUNDARY}--\r\n".encode()
+SUMMARY_HTML = """
+<div class="summary"><ul class="list-group mb-3">
+  <li class="list-group-item"><h6>Summary</h6></li>
+  <li class="list-group-item"><h6>Full Name</h6><span>Abebe Kebede</span></li>
+  <li class="list-group-item"><h6>Application Number</h6><strong>ABC1234567</strong></li>
+  <li class="list-group-item"><h6>Date of Birth:</h6><span>05/21/1990</span></li>
+  <li class="list-group-item"><h6>Phone Number</h6><span>0911223344</span></li>
+  <li class="list-group-item"><h6>Office</h6><span>Addis Ababa Main Office</span></li>
+</ul>
+<p>Address: Bole 03</p>
+<input type="text" formcontrolname="houseNo" value="H-1234">
+<input type="text" name="officeCode" value="AA-01">
+</div>
+"""
+APPLICANT_JSON = {
+    "applicantName": "Abebe Kebede",
+    "givenName": "Abebe",
+    "surname": "Alemu",
+    "email": "abebe@example.com",
+    "address": {"woreda": "Kirkos", "houseNo": "H-1234", "street": "Bole 03"},
+    "applicationNumber": "ABC1234567",
+    "office": {"name": "Addis Ababa Main Office", "id": 7},
+}
+
+
+def record(method, url, post_mime, post_body, mime_type, body):
+    request = SimpleNamespace(
+        method=method,
+        url=url,
+        headers={"content-type": post_mime, "cookie": "session=abc"} if post_mime else {},
+        post_data_buffer=post_body,
+        timing={"startTime": 1700000000000.0, "responseEnd": 120.0},
+        resource_type="xhr",
+    )
+    response = SimpleNamespace(status=200, status_text="OK", headers={"content-type": mime_type}, body=body)
+    return main.har_entry(request, response, body)
+
+
+def round_trip(tmp_path, entries):
+    path = tmp_path / "archive.har"
+    main.write_network_archive(str(path), entries)
+    return path.read_text(encoding="utf-8"), main.load_network_archive(str(path))
+
+
+def test_archive_keeps_no_personal_data(tmp_path):
+    entries = [
+        record("POST", "https://portal.example/api/upload", f"multipart/form-data; boundary={MULTIPART_BOUNDARY}",
+               MULTIPART_BODY, "application/json", b'{"ok": true}'),
+        record("GET", "https://portal.example/summary?applicationNumber=ABC1234567&lang=en", "", None,
+               "text/html; charset=utf-8", SUMMARY_HTML.encode()),
+        record("POST", "https://portal.example/api/applicant", "application/json",
+               json.dumps(APPLICANT_JSON).encode(), "application/json", json.dumps(APPLICANT_JSON).encode()),
+        record("POST", "https://portal.example/api/status", "application/x-www-form-urlencoded",
+               b"firstName=Abebe&phone=0911223344&region=1", "text/plain", b"Contact abebe@example.com"),
+    ]
+    text, loaded = round_trip(tmp_path, entries)
+
+    for value in PII_VALUES:
+        assert value not in text
+    assert "IDSCANBYTES" not in text
+    assert "session=abc" not in text
+    assert len(loaded) == 4
+
+
+def test_multipart_body_is_replaced_by_size_and_hash(tmp_path):
+    entry = record("POST", "https://portal.example/api/upload", f"multipart/form-data; boundary={MULTIPART_BOUNDARY}",
+                   MULTIPART_BODY, "application/json", b"{}")
+    post_data = entry["request"]["postData"]
+    assert post_data["text"] == ""
+    assert post_data["_size"] == len(MULTIPART_BODY)
+    assert len(post_data["_sha256"]) == 64
+
+
+def test_non_personal_values_survive_for_replay(tmp_path):
+    _, loaded = round_trip(tmp_path, [
+        record("GET", "https://portal.example/summary?lang=en", "", None, "text/html", SUMMARY_HTML.encode()),
+        record("GET", "https://portal.example/api/applicant", "", None, "application/json", json.dumps(APPLICANT_JSON).encode()),
+    ])
+    html, applicant = loaded[0]["_body"].decode(), json.loads(loaded[1]["_body"])
+    assert "<h6>Full Name</h6><span>[redacted]</span>" in html
+    assert "Addis Ababa Main Office" in html
+    assert 'value="AA-01"' in html
+    assert applicant["office"] == {"name": "Addis Ababa Main Office", "id": 7}
+    assert loaded[0]["request"]["url"] == "https://portal.example/summary?lang=en"